@@ -7,6 +7,9 @@ N_ITERS = 50
 
 MAX_NO_PROGRESS_THRESHOLD = 3
 
+# Guard inversions per profile run, 0 to keep going until suboptimality stops decreasing.
+MAX_INVERSIONS = 0
+
 def disable_turbo_boost():
     os.system('echo "1" | sudo tee /sys/devices/system/cpu/intel_pstate/no_turbo')
 
@@ -29,7 +32,7 @@ def minimize():
     prev_suboptimal_count = float('+inf')
     times = []
     suboptimal_counts = []
-    seen_strcontent = set()
+    seen_digests = set()
     best_time_so_far = float('+inf')
     best_shapefile = "empty"
     explored_fully = [False] * N_ITERS
@@ -49,7 +52,7 @@ def minimize():
                 write_to_serialized = f"{sys.argv[1]}_{i}_serialized"
                 # mutate
                 os.system(f"PYPYLOG=jit-log-opt,jit-summary,jit-backend-counts,jit-abort-log:{write_to} {PYPY_PATH} {EXTRA_OPTS} {sys.argv[1]}.py {shapefile} profile")
-                os.system(f"pypy3 src/parser.py {write_to} before.txt after.txt {write_to_serialized}")
+                os.system(f"pypy3 src/parser.py {write_to} before.txt after.txt {write_to_serialized} --max-inversions {MAX_INVERSIONS}")
                 with open("before.txt", "r") as fp:
                     next_suboptimal_count = fp.read().count("SUBOPTIMAL")
                 suboptimal_counts.append(next_suboptimal_count)
@@ -78,15 +81,14 @@ def minimize():
                     print("COULD NOT FIND TIME")
                     assert False
                 print(i, next_suboptimal_count)
-                with open(shapefile, "r") as fp1:
-                    with open(write_to_serialized, "r") as fp2:
-                        str_contents_1 = fp1.read()
-                        str_contents_2 = fp2.read()
-                        if str_contents_2 in seen_strcontent:
-                            print("SEEN BEFORE")
-                            explored_fully[i] = True
-                            raise SeenBefore()
-                        seen_strcontent.add(str_contents_2)
+                # parser.py writes the shape digest of the whole shapefile on the first line.
+                with open(f"{write_to_serialized}.digest", "r") as fp:
+                    digest = fp.readline().strip()
+                if digest in seen_digests:
+                    print("SEEN BEFORE")
+                    explored_fully[i] = True
+                    raise SeenBefore()
+                seen_digests.add(digest)
         except FoundBetterTime:
             explored_fully[i] = True  
             shapefile = best_shapefile
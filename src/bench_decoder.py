@@ -0,0 +1,176 @@
+"""
+Benchmark and fuzz suite for the shapefile decoders in my_json_decoder.py.
+
+Usage: python src/bench_decoder.py bench [max_traces] [lookups]
+       python src/bench_decoder.py fuzz [iterations] [seed]
+
+bench generates shapefiles in the shape dump_entries writes, growing in size
+and nesting depth, and times json.loads against Decoder.parse_array, LazyDecoder
+and BinaryDecoder, then `lookups` find_loop_id calls through each of them (the
+lazy rows include the scan), with the blocks and bytes allocated (tracemalloc)
+next to every timing. fuzz throws random shapes at all decoders and checks that
+they agree with json and with each other.
+"""
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from my_json_decoder import GUARD_OPS, Decoder, LazyDecoder, BinaryDecoder
+from binary_shapefile import encode_shapes, shape_to_json
+
+
+def make_shapes(n_traces: int, depth: int, seed: int = 0, other_ops: bool = False, duplicate_uuids: bool = False) -> list[dict]:
+    """
+    A serialized forest like dump_entries makes: n_traces traces in total, with
+    bridges nested at most depth levels deep.
+    """
+    rnd = random.Random(seed)
+    uuids = iter(range(n_traces))
+    budget = [n_traces]
+    ops = GUARD_OPS + ["guard_made_up"] if other_ops else GUARD_OPS
+
+    def make_trace(level: int) -> dict:
+        budget[0] -= 1
+        uuid = rnd.randrange(n_traces) if duplicate_uuids and rnd.random() < 0.1 else next(uuids)
+        guards = []
+        for _ in range(rnd.randint(0, 8)):
+            post = rnd.choice(["", "", "", "I", "P"])
+            bridge = None
+            if level < depth and budget[0] > 0 and rnd.random() < 0.4:
+                bridge = make_trace(level + 1)
+            guards.append({f"Guard{post}:{rnd.choice(ops)}": bridge})
+        return {f"Trace:{uuid}": guards}
+
+    entries = []
+    while budget[0] > 0:
+        entries.append(make_trace(0))
+    return entries
+
+
+def trace_ids(shapes) -> list[str]:
+    ids = []
+    stack = list(shapes)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+        elif isinstance(node, dict):
+            (key, value), = node.items()
+            if key.startswith("Trace:"):
+                ids.append(key[len("Trace:"):])
+            stack.append(value)
+    return ids
+
+
+def measure(f, *args):
+    """
+    (result, seconds, blocks allocated, bytes allocated) of f(*args). Tracing
+    slows everything down, so the time comes from a second, untraced call.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    res = f(*args)
+    stats = tracemalloc.take_snapshot().compare_to(before, "filename")
+    tracemalloc.stop()
+    del res
+    gc.collect()
+    start = time.perf_counter()
+    res = f(*args)
+    elapsed = time.perf_counter() - start
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    return res, elapsed, blocks, size
+
+
+def parsed(decoder, parse):
+    # Parses a fresh copy of decoder, which find_loop_id is then called on.
+    decoder = type(decoder)(decoder.s)
+    return decoder, parse(decoder)
+
+
+def timed(f, *args) -> float:
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def bench(max_traces: int, n_lookups: int):
+    print(f"{'traces':>8} {'depth':>5} {'KiB':>7}  {'decoder':<22} {'parse ms':>9} {'blocks':>9} {'KiB':>8}  {'lookup ms':>9}")
+    n_traces = 100
+    while n_traces <= max_traces:
+        for depth in (2, 8, 32):
+            shapes = make_shapes(n_traces, depth)
+            text = json.dumps(shapes, separators=(',', ':'))
+            binary = encode_shapes(shapes).decode("latin-1")
+            indexed = encode_shapes(shapes, with_offsets=True).decode("latin-1")
+            rnd = random.Random(n_traces)
+            ids = rnd.sample(trace_ids(shapes), min(n_lookups, n_traces))
+
+            rows = []
+            _, elapsed, blocks, size = measure(json.loads, text)
+            rows.append(("json.loads", elapsed, blocks, size, None))
+            (decoder, root), elapsed, blocks, size = measure(parsed, Decoder(text), Decoder.parse_array)
+            lookup = timed(lambda: [decoder.find_loop_id(i) for i in ids])
+            rows.append(("Decoder", elapsed, blocks, size, lookup))
+            # ListOrDictOrStr.find_loop_id searches the tree.
+            recursive = timed(lambda: [root.find_loop_id(i) for i in ids[:10]]) * len(ids) / len(ids[:10])
+            rows.append(("  recursive lookup", None, None, None, recursive))
+            del root, decoder
+            _, elapsed, blocks, size = measure(lambda: [decoder.find_loop_id(i) for decoder in [LazyDecoder(text)] for i in ids])
+            rows.append(("LazyDecoder", None, blocks, size, elapsed))
+            (decoder, root), elapsed, blocks, size = measure(parsed, BinaryDecoder(binary), BinaryDecoder.parse_shapefile)
+            lookup = timed(lambda: [decoder.find_loop_id(i) for i in ids])
+            rows.append(("BinaryDecoder", elapsed, blocks, size, lookup))
+            del root, decoder
+            _, elapsed, blocks, size = measure(lambda: [decoder.find_loop_id(i) for decoder in [BinaryDecoder(indexed)] for i in ids])
+            rows.append(("  with offsets, lazily", None, blocks, size, elapsed))
+
+            for idx, (name, parse, blocks, size, lookup) in enumerate(rows):
+                head = f"{n_traces:>8} {depth:>5} {len(text) / 1024:>7.0f}" if idx == 0 else " " * 22
+                parse = f"{parse * 1000:9.1f}" if parse is not None else " " * 9
+                allocs = f"{blocks:>9} {size / 1024:>8.0f}" if blocks is not None else " " * 18
+                lookup = f"{lookup * 1000:9.2f}" if lookup is not None else ""
+                print(f"{head}  {name:<22} {parse} {allocs}  {lookup}")
+        n_traces *= 10
+
+
+def fuzz(iterations: int, seed: int):
+    rnd = random.Random(seed)
+    for iteration in range(iterations):
+        shapes = make_shapes(rnd.randint(1, 300), rnd.randint(0, 40), rnd.randrange(2**32),
+                             other_ops=rnd.random() < 0.3, duplicate_uuids=rnd.random() < 0.3)
+        text = json.dumps(shapes, separators=(',', ':'))
+        context = f"iteration {iteration} (seed {seed})"
+
+        decoder = Decoder(text)
+        root = decoder.parse_array()
+        assert shape_to_json(root) == shapes, f"Decoder disagrees with json, {context}"
+        binary = encode_shapes(shapes)
+        indexed = encode_shapes(shapes, with_offsets=True)
+        assert shape_to_json(BinaryDecoder(binary.decode("latin-1")).parse_shapefile()) == shapes, f"BinaryDecoder disagrees with json, {context}"
+        assert shape_to_json(BinaryDecoder(indexed.decode("latin-1")).parse_shapefile()) == shapes, f"BinaryDecoder with offsets disagrees with json, {context}"
+
+        lazy = LazyDecoder(text)
+        lazy_binary = BinaryDecoder(indexed.decode("latin-1"))
+        ids = trace_ids(shapes)
+        for id_str in rnd.sample(ids, min(len(ids), 50)) + ["-1"]:
+            expected = shape_to_json(root.find_loop_id(id_str))
+            for name, found in (("Decoder", decoder.find_loop_id(id_str)),
+                                ("LazyDecoder", lazy.find_loop_id(id_str)),
+                                ("BinaryDecoder", lazy_binary.find_loop_id(id_str))):
+                assert shape_to_json(found) == expected, f"{name}.find_loop_id({id_str}) disagrees, {context}"
+    print(f"{iterations} shapefiles, all decoders agree")
+
+
+if __name__ == "__main__":
+    # The recursive decoders and find_loop_id go a few levels per trace. Not at
+    # import time: run_tests.py imports this and runs at the default limit.
+    sys.setrecursionlimit(100000)
+    mode = sys.argv[1] if len(sys.argv) > 1 else "bench"
+    if mode == "fuzz":
+        fuzz(int(sys.argv[2]) if len(sys.argv) > 2 else 200, int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+    else:
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 10 ** 4, int(sys.argv[3]) if len(sys.argv) > 3 else 100)
@@ -0,0 +1,73 @@
+"""
+Microbenchmark for the jit-log-opt line tokenizer.
+
+Usage: python src/bench_tokenizer.py PYPYLOG [repeats]
+
+Collects every op line inside the "# Loop" and "# bridge out of" sections of a
+recorded log, then classifies them with the old regex cascade (strip and try every
+pattern on every line) and with tokenize_op_line, and reports lines per second.
+"""
+import re
+import sys
+import time
+
+from parser import (
+    END_LOOP_MARKER,
+    LABEL_RE,
+    GUARD_RE,
+    JUMP_RE,
+    FINISH_RE,
+    tokenize_op_line,
+)
+
+
+def collect_op_lines(fp) -> list[str]:
+    lines = []
+    in_section = False
+    for line in fp:
+        if in_section:
+            if END_LOOP_MARKER in line:
+                in_section = False
+            else:
+                lines.append(line)
+        elif line.startswith("# Loop") or line.startswith("# bridge out of"):
+            in_section = True
+    return lines
+
+
+def classify_with_regex_cascade(line: str):
+    # What parse_and_build_trace_trees used to do for every op line.
+    res = None
+    if label_match := re.match(LABEL_RE, line.strip()):
+        res = label_match
+    if guard_match := re.match(GUARD_RE, line.strip()):
+        res = guard_match
+    if jump_match := re.match(JUMP_RE, line.strip()):
+        res = jump_match
+    if finish_match := re.match(FINISH_RE, line.strip()):
+        res = finish_match
+    if "jit_debug('peeled loop')" in line:
+        res = line
+    return res
+
+
+def lines_per_second(classify, lines: list[str], repeats: int) -> float:
+    best = float('+inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for line in lines:
+            classify(line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as fp:
+        lines = collect_op_lines(fp)
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print(f"{len(lines)} op lines, best of {repeats}")
+    before = lines_per_second(classify_with_regex_cascade, lines, repeats)
+    after = lines_per_second(tokenize_op_line, lines, repeats)
+    print(f"regex cascade:    {before:14,.0f} lines/s")
+    print(f"tokenize_op_line: {after:14,.0f} lines/s")
+    print(f"speedup:          {after / before:14.2f}x")
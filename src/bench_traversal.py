@@ -0,0 +1,131 @@
+"""
+Scaling benchmark for compute_edges and count_suboptimality.
+
+Usage: python src/bench_traversal.py [max_nodes] [legacy_max_nodes]
+
+Builds synthetic forests where many entries share one big tree of bridges (the
+bad case for a per-entry traversal), from 10^3 up to max_nodes (default 10^6)
+trace nodes, and times both passes. Time per node should stay flat. The old
+per-entry, list-as-queue versions are timed next to them up to legacy_max_nodes.
+"""
+from collections import deque
+import random
+import sys
+import time
+
+from parser import (
+    Trace,
+    Bridge,
+    Guard,
+    Label,
+    Jump,
+    Edge,
+    TraceLike,
+    compute_edges,
+    count_suboptimality,
+)
+
+
+def make_forest(n_nodes: int, n_entries: int, seed: int = 0) -> list[Trace]:
+    rnd = random.Random(seed)
+    label = Label(1, 1000, 1000)
+
+    def make_trace(cls, uuid: int, n_guards: int) -> TraceLike:
+        guards = [Guard(uuid * 4 + i, "guard_true", after_count=rnd.randint(0, 1000)) for i in range(n_guards)]
+        return cls(uuid, uuid, "bench", None, [label] + guards, Jump(1, rnd.randint(0, 1000), Edge(label)), rnd.randint(1, 1000))
+
+    # A binary tree of bridges, shared by every entry.
+    shared = [make_trace(Bridge, n_entries, 2)]
+    worklist = deque([shared[0]])
+    while worklist and len(shared) < n_nodes - n_entries:
+        node = worklist.popleft()
+        for guard in node.labels_and_guards[1:]:
+            if len(shared) >= n_nodes - n_entries:
+                break
+            bridge = make_trace(Bridge, n_entries + len(shared), 2)
+            guard.bridge = Edge(bridge)
+            shared.append(bridge)
+            worklist.append(bridge)
+    entries = []
+    for uuid in range(n_entries):
+        entry = make_trace(Trace, uuid, 1)
+        entry.labels_and_guards[1].bridge = Edge(shared[0])
+        entry.is_suboptimal_cause = entry.labels_and_guards[1] if uuid % 2 else None
+        entries.append(entry)
+    return entries
+
+
+def legacy_compute_edges(all_entries):
+    # compute_edges before it became a single traversal.
+    for entry in all_entries:
+        seen = set()
+        queue = [entry]
+        while queue:
+            nxt = queue.pop(0)
+            if id(nxt) in seen:
+                continue
+            seen.add(id(nxt))
+            if isinstance(nxt, Guard):
+                if nxt.bridge is not None:
+                    nxt.bridge.weight = nxt.bridge.node.enter_count
+                    queue.append(nxt.bridge.node)
+            elif isinstance(nxt, Trace | Bridge):
+                if nxt.jump.jump_to_edge.weight != 0:
+                    continue
+                if nxt.jump.enter_count == 0:
+                    count = nxt.labels_and_guards[-1].after_count if nxt.labels_and_guards else nxt.enter_count
+                    nxt.jump.jump_to_edge.weight = nxt.jump.enter_count = count
+                else:
+                    nxt.jump.jump_to_edge.weight = nxt.jump.enter_count
+                queue.extend(nxt.labels_and_guards)
+                if isinstance(nxt.jump.jump_to_edge.node, Label):
+                    queue.append(nxt.jump.jump_to_edge.node)
+
+
+def legacy_count_suboptimality(all_entries):
+    # count_suboptimality before it became a single traversal.
+    count = 0
+    for entry in all_entries:
+        seen = set()
+        queue = [entry]
+        while queue:
+            nxt = queue.pop(0)
+            if id(nxt) in seen:
+                continue
+            seen.add(id(nxt))
+            if isinstance(nxt, Guard):
+                if nxt.bridge is not None:
+                    nxt.bridge.weight = nxt.bridge.node.enter_count
+                    queue.append(nxt.bridge.node)
+            elif isinstance(nxt, TraceLike):
+                if nxt.is_suboptimal_cause is not None:
+                    count += 1
+                nxt.jump.jump_to_edge.weight = nxt.jump.enter_count
+                queue.extend(nxt.labels_and_guards)
+                if isinstance(nxt.jump.jump_to_edge.node, Label):
+                    queue.append(nxt.jump.jump_to_edge.node)
+    return count
+
+
+def timed(f, *args) -> float:
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    max_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+    legacy_max_nodes = int(sys.argv[2]) if len(sys.argv) > 2 else 10 ** 3
+    print(f"{'nodes':>9} {'compute_edges':>14} {'count_subopt':>14} {'ns/node':>9} {'legacy':>10}")
+    n_nodes = 1000
+    while n_nodes <= max_nodes:
+        n_entries = max(1, n_nodes // 10)
+        entries = make_forest(n_nodes, n_entries)
+        edges = timed(compute_edges, entries, entries)
+        count = timed(count_suboptimality, entries)
+        legacy = ""
+        if n_nodes <= legacy_max_nodes:
+            entries = make_forest(n_nodes, n_entries)
+            legacy = f"{timed(legacy_compute_edges, entries) + timed(legacy_count_suboptimality, entries):9.3f}s"
+        print(f"{n_nodes:>9} {edges:13.3f}s {count:13.3f}s {(edges + count) / n_nodes * 1e9:9.0f} {legacy:>10}")
+        n_nodes *= 10
@@ -0,0 +1,124 @@
+"""
+Compact binary encoding of the guard-shape files that dump_entries writes as JSON.
+
+    shapefile := "GSHP" version:u8 [offset table if version == 2] varint(#entries) trace*
+    table     := varint(table size in bytes) varint(#traces) (varint(uuid) varint(offset))*
+    trace     := varint(uuid) varint(#guards) guard*
+    guard     := op:u8 [varint(len) op-name if op == GUARD_OP_OTHER] flags:u8 [trace if flags & GUARD_FLAG_BRIDGE]
+
+Varints are unsigned LEB128, op is the index in GUARD_OPS, flags hold
+inverted ("GuardI") and expected-to-be-inverted ("GuardP"). The optional offset
+table says where the first trace with each uuid starts, counted from the
+#entries varint. BinaryDecoder in my_json_decoder.py reads it back into the same
+tree Decoder builds from JSON, or with the table decodes just the trace asked for.
+
+Usage: python src/binary_shapefile.py IN OUT [--offsets]
+converts a shapefile to the other format (JSON to binary, with an offset table
+if asked, or binary to JSON).
+"""
+import json
+
+from my_json_decoder import (
+    BINARY_SHAPEFILE_MAGIC,
+    BINARY_SHAPEFILE_VERSION,
+    BINARY_SHAPEFILE_VERSION_INDEXED,
+    GUARD_OPS,
+    GUARD_OP_OTHER,
+    GUARD_FLAG_INVERTED,
+    GUARD_FLAG_EXPECTED_INVERTED,
+    GUARD_FLAG_BRIDGE,
+    BinaryDecoder,
+    ListOrDictOrStr,
+)
+
+GUARD_OP_CODES = {op: code for code, op in enumerate(GUARD_OPS)}
+
+
+def is_binary_shapefile(data: bytes) -> bool:
+    return data.startswith(BINARY_SHAPEFILE_MAGIC.encode())
+
+
+def encode_varint(out: bytearray, value: int):
+    assert value >= 0, f"Can't encode negative {value}"
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_trace(out: bytearray, trace: dict, offsets: dict[int, int]):
+    # {"Trace:uuid": [guard, ...]}, as made by TraceLike.serialize.
+    (key, guards), = trace.items()
+    uuid = int(key[len("Trace:"):])
+    offsets.setdefault(uuid, len(out))
+    encode_varint(out, uuid)
+    encode_varint(out, len(guards))
+    for guard in guards:
+        (key, bridge), = guard.items()
+        kind, op = key.split(":", 1)
+        flags = {"Guard": 0, "GuardI": GUARD_FLAG_INVERTED, "GuardP": GUARD_FLAG_EXPECTED_INVERTED}[kind]
+        if bridge is not None:
+            flags |= GUARD_FLAG_BRIDGE
+        code = GUARD_OP_CODES.get(op, GUARD_OP_OTHER)
+        out.append(code)
+        if code == GUARD_OP_OTHER:
+            encode_varint(out, len(op))
+            out += op.encode()
+        out.append(flags)
+        if bridge is not None:
+            encode_trace(out, bridge, offsets)
+
+
+def encode_shapes(serialized: list[dict], with_offsets: bool = False) -> bytes:
+    """
+    The binary shapefile for what dump_entries would write as JSON, optionally
+    with the offset table for BinaryDecoder.find_loop_id.
+    """
+    body = bytearray()
+    offsets: dict[int, int] = {}
+    encode_varint(body, len(serialized))
+    for trace in serialized:
+        encode_trace(body, trace, offsets)
+    out = bytearray(BINARY_SHAPEFILE_MAGIC.encode())
+    if with_offsets:
+        out.append(BINARY_SHAPEFILE_VERSION_INDEXED)
+        table = bytearray()
+        encode_varint(table, len(offsets))
+        for uuid, offset in offsets.items():
+            encode_varint(table, uuid)
+            encode_varint(table, offset)
+        encode_varint(out, len(table))
+        out += table
+    else:
+        out.append(BINARY_SHAPEFILE_VERSION)
+    out += body
+    return bytes(out)
+
+
+def shape_to_json(shape: ListOrDictOrStr):
+    if shape.ty == ListOrDictOrStr.LIST:
+        return [shape_to_json(item) for item in shape.lst]
+    elif shape.ty == ListOrDictOrStr.DICT:
+        return {key.st: shape_to_json(value) for key, value in shape.dct.items()}
+    elif shape.ty == ListOrDictOrStr.STR:
+        return shape.st
+    return None
+
+
+def decode_shapes(data: bytes) -> list[dict]:
+    """
+    Back to the JSON structure, through BinaryDecoder.
+    """
+    return shape_to_json(BinaryDecoder(data.decode("latin-1")).parse_shapefile())
+
+
+if __name__ == "__main__":
+    import sys
+    with open(sys.argv[1], "rb") as fp:
+        data = fp.read()
+    if is_binary_shapefile(data):
+        with open(sys.argv[2], "w") as fp:
+            json.dump(decode_shapes(data), fp, separators=(',', ':'))
+    else:
+        with open(sys.argv[2], "wb") as fp:
+            fp.write(encode_shapes(json.loads(data), with_offsets="--offsets" in sys.argv[3:]))
@@ -0,0 +1,582 @@
+"""
+Struct-of-arrays storage for trace forests.
+
+A forest of Trace/Bridge/Guard/Label objects costs a few hundred bytes per guard
+once all the int objects, Edges and list slots are counted. ForestColumns keeps
+the same information in flat `array` columns instead (a few dozen bytes per
+guard), with traces referring to their labels and guards by a range of rows.
+
+compute_edges, decide_sub_optimality and count_suboptimality have column
+versions, as ForestColumns methods. The *View classes give the usual attribute
+API on top of a row, for printing, serializing and apply_counts_section, but
+the passes in parser.py only take objects: they walk the forest with
+isinstance checks and id() sets, which views don't pass. to_trace_trees() turns
+the whole thing back into objects for those (the reorderers...).
+"""
+from array import array
+from bisect import bisect_left
+from collections import deque
+import textwrap
+
+from parser import (
+    SECTION_BRIDGE,
+    SECTION_COUNTS,
+    Trace,
+    Bridge,
+    Guard,
+    Label,
+    PeeledHeader,
+    Jump,
+    DoneWithThisFrame,
+    Edge,
+    PlaceHolderEdge,
+    SymbolTable,
+    apply_counts_section,
+    iter_log_sections,
+    open_log,
+)
+
+KIND_TRACE = 0
+KIND_BRIDGE = 1
+
+# trace_flags
+HAS_HEADER = 1
+DONE_WITH_THIS_FRAME = 2
+
+# guard_flags
+INVERTED = 1
+EXPECTED_TO_BE_INVERTED = 2
+
+NO_ROW = -1
+
+
+def label_item(label_row: int) -> int:
+    # Items of a trace are guard rows, or labels rows encoded as negative numbers.
+    return -label_row - 1
+
+
+class ForestColumns:
+    def __init__(self):
+        # Op names are interned: guard_op holds an index into ops.
+        self.ops: list[str] = []
+        self.op_codes: dict[str, int] = {}
+
+        # One row per loop or bridge, in log order.
+        self.trace_kind = array('B')
+        self.trace_uuid = array('q')
+        self.trace_id = array('q')
+        self.trace_info: list[str] = []
+        self.trace_flags = array('B')
+        self.trace_enter_count = array('q')
+        # items[header_start:items_start] is the peeled header (if HAS_HEADER),
+        # items[items_start:items_stop] the labels and guards of the trace proper.
+        self.trace_header_start = array('q')
+        self.trace_items_start = array('q')
+        self.trace_items_stop = array('q')
+        self.trace_suboptimal_cause = array('q')
+        self.trace_suboptimality_cost = array('q')
+        self.jump_id = array('q')
+        self.jump_enter_count = array('q')
+        self.jump_target = array('q')
+        self.jump_weight = array('q')
+
+        self.items = array('q')
+
+        self.guard_id = array('q')
+        self.guard_op = array('B')
+        self.guard_flags = array('B')
+        self.guard_after_count = array('q')
+        self.guard_bridge = array('q')
+        self.guard_bridge_weight = array('q')
+
+        self.label_id = array('q')
+        self.label_before_count = array('q')
+        self.label_after_count = array('q')
+
+    @classmethod
+    def from_log(cls, path) -> "ForestColumns":
+        """
+        Parses a log straight into columns. Only one trace is ever held as objects
+        at a time. Counts blocks are applied once every section has been read.
+        """
+        columns = cls()
+        counts_blocks = []
+        with open_log(path) as fp:
+            for kind, section in iter_log_sections(fp):
+                if kind == SECTION_COUNTS:
+                    counts_blocks.append(section)
+                # Sometimes pypy gives negative IDs for fake traces.
+                elif kind == SECTION_BRIDGE or section.id >= 0:
+                    columns.append_trace(section)
+        symbols = columns.symbol_table()
+        for lines in counts_blocks:
+            apply_counts_section(symbols, iter(lines))
+        columns.link(symbols)
+        return columns
+
+    def intern_op(self, op: str) -> int:
+        code = self.op_codes.get(op)
+        if code is None:
+            code = self.op_codes[op] = len(self.ops)
+            self.ops.append(op)
+        return code
+
+    def append_items(self, labels_and_guards: list[Label | Guard]):
+        for label_or_guard in labels_and_guards:
+            if isinstance(label_or_guard, Guard):
+                self.items.append(len(self.guard_id))
+                self.guard_id.append(label_or_guard.id)
+                self.guard_op.append(self.intern_op(label_or_guard.op))
+                self.guard_flags.append((INVERTED if label_or_guard.inverted else 0) | (EXPECTED_TO_BE_INVERTED if label_or_guard.expected_to_be_inverted else 0))
+                self.guard_after_count.append(label_or_guard.after_count)
+                self.guard_bridge.append(NO_ROW)
+                self.guard_bridge_weight.append(0)
+            else:
+                self.items.append(label_item(len(self.label_id)))
+                self.label_id.append(label_or_guard.id)
+                self.label_before_count.append(label_or_guard.before_count)
+                self.label_after_count.append(label_or_guard.after_count)
+
+    def append_trace(self, trace: Trace | Bridge) -> int:
+        """
+        Appends an unlinked trace, as it comes out of the parser.
+        """
+        row = len(self.trace_id)
+        self.trace_kind.append(KIND_BRIDGE if isinstance(trace, Bridge) else KIND_TRACE)
+        self.trace_uuid.append(trace.uuid)
+        self.trace_id.append(trace.id)
+        self.trace_info.append(trace.info)
+        flags = 0
+        self.trace_header_start.append(len(self.items))
+        if trace.header is not None:
+            flags |= HAS_HEADER
+            self.append_items(trace.header.labels_and_guards)
+        self.trace_items_start.append(len(self.items))
+        self.append_items(trace.labels_and_guards)
+        self.trace_items_stop.append(len(self.items))
+        self.trace_enter_count.append(trace.enter_count)
+        self.trace_suboptimal_cause.append(NO_ROW)
+        self.trace_suboptimality_cost.append(0)
+        if isinstance(trace.jump, DoneWithThisFrame):
+            flags |= DONE_WITH_THIS_FRAME
+            # The id of a DoneWithThisFrame is the trace's own id, see parse_trace_body.
+            self.jump_id.append(trace.id)
+        else:
+            self.jump_id.append(trace.jump.id)
+        self.trace_flags.append(flags)
+        self.jump_enter_count.append(trace.jump.enter_count)
+        self.jump_target.append(NO_ROW)
+        self.jump_weight.append(0)
+        return row
+
+    def symbol_table(self) -> SymbolTable:
+        """
+        A SymbolTable whose lookups go through sorted id columns and hand out views,
+        so apply_counts_section writes the counts straight into the columns.
+        """
+        entry_rows = [row for row in range(len(self.trace_id)) if self.trace_kind[row] == KIND_TRACE]
+        bridge_rows = [row for row in range(len(self.trace_id)) if self.trace_kind[row] == KIND_BRIDGE]
+        return SymbolTable(
+            entries_by_id=ColumnLookup(self, self.trace_id, entry_rows, TraceView),
+            bridges_by_guard_id=ColumnLookup(self, self.trace_id, bridge_rows, TraceView),
+            labels_by_id=ColumnLookup(self, self.label_id, range(len(self.label_id)), LabelView),
+            guards_by_id=ColumnLookup(self, self.guard_id, range(len(self.guard_id)), GuardView),
+        )
+
+    def link(self, symbols: SymbolTable | None = None):
+        """
+        Points guards at the bridges coming out of them and jumps at their target
+        labels, the same way link_trace_trees does.
+        """
+        if symbols is None:
+            symbols = self.symbol_table()
+        bridges = symbols.bridges_by_guard_id
+        for guard_row in range(len(self.guard_id)):
+            self.guard_bridge[guard_row] = bridges.row(self.guard_id[guard_row])
+        labels = symbols.labels_by_id
+        for row in range(len(self.trace_id)):
+            # is a terminator
+            if self.trace_flags[row] & DONE_WITH_THIS_FRAME:
+                continue
+            label_row = labels.row(self.jump_id[row])
+            assert label_row != NO_ROW, f"No corresponding node for label? {self.jump_id[row]}"
+            self.jump_target[row] = label_row
+
+    def entries(self) -> list["TraceView"]:
+        return [TraceView(self, row) for row in range(len(self.trace_id)) if self.trace_kind[row] == KIND_TRACE]
+
+    def all_bridges(self) -> list["TraceView"]:
+        return [TraceView(self, row) for row in range(len(self.trace_id)) if self.trace_kind[row] == KIND_BRIDGE]
+
+    def guard_rows(self, row: int) -> list[int]:
+        # The guards of the trace proper, which the passes walk (not the peeled header).
+        return [item for item in self.items[self.trace_items_start[row]:self.trace_items_stop[row]] if item >= 0]
+
+    def reachable_rows(self) -> list[int]:
+        """
+        The traces reachable from the entries through the bridges of their guards,
+        each once, in the order compute_edges visits them.
+        """
+        seen = bytearray(len(self.trace_id))
+        res = []
+        queue = deque(row for row in range(len(self.trace_id)) if self.trace_kind[row] == KIND_TRACE)
+        while queue:
+            row = queue.popleft()
+            if seen[row]:
+                continue
+            seen[row] = 1
+            res.append(row)
+            for guard_row in self.guard_rows(row):
+                if self.guard_bridge[guard_row] != NO_ROW:
+                    queue.append(self.guard_bridge[guard_row])
+        return res
+
+    def compute_edges(self):
+        """
+        parser.compute_edges on the columns, same weights.
+        """
+        for row in self.reachable_rows():
+            if self.jump_weight[row] == 0:
+                # Same workaround for the missing jump counts.
+                if self.jump_enter_count[row] == 0:
+                    if self.trace_items_stop[row] > self.trace_items_start[row]:
+                        item = self.items[self.trace_items_stop[row] - 1]
+                        count = self.guard_after_count[item] if item >= 0 else self.label_after_count[label_item(item)]
+                    else:
+                        count = self.trace_enter_count[row]
+                    self.jump_enter_count[row] = count
+                self.jump_weight[row] = self.jump_enter_count[row]
+            for guard_row in self.guard_rows(row):
+                bridge_row = self.guard_bridge[guard_row]
+                if bridge_row != NO_ROW:
+                    self.guard_bridge_weight[guard_row] = self.trace_enter_count[bridge_row]
+
+    def decide_sub_optimality(self):
+        """
+        parser.decide_sub_optimality on the columns: sets the cause and the cost of
+        every reachable trace.
+        """
+        for row in self.reachable_rows():
+            jump_weight = self.jump_weight[row]
+            cause = NO_ROW
+            cost = 0
+            for guard_row in self.guard_rows(row):
+                if self.guard_bridge[guard_row] != NO_ROW and self.guard_bridge_weight[guard_row] > jump_weight:
+                    cause = guard_row
+                    cost += self.guard_bridge_weight[guard_row]
+            self.trace_suboptimal_cause[row] = cause
+            self.trace_suboptimality_cost[row] = cost
+
+    def count_suboptimality(self) -> int:
+        """
+        parser.count_suboptimality on the columns. The object forest gives every
+        guard its own copy of the bridge, so a bridge counts once per guard leading
+        to it here too.
+        """
+        count = 0
+        for row in self.reachable_rows():
+            if self.trace_kind[row] == KIND_TRACE and self.trace_suboptimal_cause[row] != NO_ROW:
+                count += 1
+            self.jump_weight[row] = self.jump_enter_count[row]
+            for guard_row in self.guard_rows(row):
+                bridge_row = self.guard_bridge[guard_row]
+                if bridge_row != NO_ROW:
+                    self.guard_bridge_weight[guard_row] = self.trace_enter_count[bridge_row]
+                    if self.trace_suboptimal_cause[bridge_row] != NO_ROW:
+                        count += 1
+        return count
+
+    def terminator_id(self, row: int) -> int | str:
+        if self.trace_flags[row] & DONE_WITH_THIS_FRAME:
+            # Like the parser, the loop id or guard address as it appeared in the header.
+            return str(self.trace_id[row]) if self.trace_kind[row] == KIND_TRACE else hex(self.trace_id[row])
+        return self.jump_id[row]
+
+    def item_view(self, item: int) -> "GuardView | LabelView":
+        if item >= 0:
+            return GuardView(self, item)
+        return LabelView(self, label_item(item))
+
+    def to_trace_trees(self) -> tuple[list[Trace], list[Bridge]]:
+        """
+        Materializes the forest as the objects parse_and_build_trace_trees returns,
+        including the copy of each bridge hanging off its guard.
+        """
+        guards = [
+            Guard(self.guard_id[row], self.ops[self.guard_op[row]], None,
+                  bool(self.guard_flags[row] & INVERTED), bool(self.guard_flags[row] & EXPECTED_TO_BE_INVERTED),
+                  self.guard_after_count[row])
+            for row in range(len(self.guard_id))
+        ]
+        labels = [
+            Label(self.label_id[row], self.label_before_count[row], self.label_after_count[row])
+            for row in range(len(self.label_id))
+        ]
+
+        def item(item: int) -> Guard | Label:
+            return guards[item] if item >= 0 else labels[label_item(item)]
+
+        traces = []
+        for row in range(len(self.trace_id)):
+            header = None
+            if self.trace_flags[row] & HAS_HEADER:
+                header = PeeledHeader([item(i) for i in self.items[self.trace_header_start[row]:self.trace_items_start[row]]])
+            if self.trace_flags[row] & DONE_WITH_THIS_FRAME:
+                jump = DoneWithThisFrame(self.terminator_id(row), self.jump_enter_count[row], PlaceHolderEdge(None, self.jump_weight[row]))
+            else:
+                jump = Jump(self.jump_id[row], self.jump_enter_count[row], Edge(labels[self.jump_target[row]], self.jump_weight[row]))
+            cls = Trace if self.trace_kind[row] == KIND_TRACE else Bridge
+            cause = self.trace_suboptimal_cause[row]
+            traces.append(cls(
+                self.trace_uuid[row], self.trace_id[row], self.trace_info[row], header,
+                [item(i) for i in self.items[self.trace_items_start[row]:self.trace_items_stop[row]]],
+                jump, self.trace_enter_count[row], None if cause == NO_ROW else guards[cause],
+                self.trace_suboptimality_cost[row],
+            ))
+        for row, guard in enumerate(guards):
+            bridge_row = self.guard_bridge[row]
+            if bridge_row != NO_ROW:
+                # Same as link_trace_trees, the tree gets its own copy of the bridge.
+                bridge = traces[bridge_row]
+                guard.bridge = Edge(Bridge(bridge.uuid, bridge.id, bridge.info, bridge.header, bridge.labels_and_guards,
+                                           bridge.jump, bridge.enter_count, bridge.is_suboptimal_cause, bridge.suboptimality_cost),
+                                    self.guard_bridge_weight[row])
+        entries = [trace for trace in traces if type(trace) is Trace]
+        all_bridges = [trace for trace in traces if type(trace) is Bridge]
+        return entries, all_bridges
+
+    def nbytes(self) -> int:
+        """
+        Bytes held by the columns themselves (not counting trace_info and ops).
+        """
+        return sum(column.itemsize * len(column) for column in vars(self).values() if isinstance(column, array))
+
+
+class ColumnLookup:
+    """
+    Read-only id -> view mapping over an id column, for the rows in rows. Backed
+    by a sorted copy of the ids, so it costs two array slots per row instead of
+    a dict entry. When an id shows up more than once, the first row wins.
+    """
+    def __init__(self, columns: ForestColumns, ids: array, rows, view_class):
+        self.columns = columns
+        self.view_class = view_class
+        # sorted() is stable, so equal ids stay in row order.
+        order = sorted(rows, key=ids.__getitem__)
+        self.sorted_ids = array('q', (ids[row] for row in order))
+        self.rows = array('q', order)
+
+    def row(self, key: int) -> int:
+        idx = bisect_left(self.sorted_ids, key)
+        if idx == len(self.sorted_ids) or self.sorted_ids[idx] != key:
+            return NO_ROW
+        return self.rows[idx]
+
+    def get(self, key: int, default=None):
+        row = self.row(key)
+        return default if row == NO_ROW else self.view_class(self.columns, row)
+
+    def __contains__(self, key: int) -> bool:
+        return self.row(key) != NO_ROW
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+def column_property(name: str, row_attr: str = "row"):
+    def get(self):
+        return getattr(self.columns, name)[getattr(self, row_attr)]
+
+    def set(self, value):
+        getattr(self.columns, name)[getattr(self, row_attr)] = value
+
+    return property(get, set)
+
+
+def flag_property(name: str, flag: int):
+    def get(self) -> bool:
+        return bool(getattr(self.columns, name)[self.row] & flag)
+
+    def set(self, value: bool):
+        column = getattr(self.columns, name)
+        column[self.row] = (column[self.row] | flag) if value else (column[self.row] & ~flag)
+
+    return property(get, set)
+
+
+class ColumnView:
+    """
+    A row of a ForestColumns. Views are created on every access, so compare them
+    with ==, not `is` or id(). That, and not being Trace/Guard/... instances, is
+    why the passes in parser.py don't work on them, see the module docstring.
+    """
+    __slots__ = ("columns", "row")
+
+    def __init__(self, columns: ForestColumns, row: int):
+        self.columns = columns
+        self.row = row
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.columns is other.columns and self.row == other.row
+
+    def __hash__(self):
+        return hash((type(self), id(self.columns), self.row))
+
+
+class LabelView(ColumnView):
+    __slots__ = ()
+    id = column_property("label_id")
+    before_count = column_property("label_before_count")
+    after_count = column_property("label_after_count")
+
+    __str__ = Label.__str__
+
+
+class GuardView(ColumnView):
+    __slots__ = ()
+    id = column_property("guard_id")
+    inverted = flag_property("guard_flags", INVERTED)
+    expected_to_be_inverted = flag_property("guard_flags", EXPECTED_TO_BE_INVERTED)
+    after_count = column_property("guard_after_count")
+
+    @property
+    def op(self) -> str:
+        return self.columns.ops[self.columns.guard_op[self.row]]
+
+    @op.setter
+    def op(self, op: str):
+        self.columns.guard_op[self.row] = self.columns.intern_op(op)
+
+    @property
+    def bridge(self) -> "BridgeEdgeView | None":
+        if self.columns.guard_bridge[self.row] == NO_ROW:
+            return None
+        return BridgeEdgeView(self.columns, self.row)
+
+    __str__ = Guard.__str__
+    invert_guard = Guard.invert_guard
+    serialize = Guard.serialize
+
+
+class BridgeEdgeView(ColumnView):
+    # The edge from a guard (the row) to its bridge.
+    __slots__ = ()
+    weight = column_property("guard_bridge_weight")
+
+    @property
+    def node(self) -> "TraceView":
+        return TraceView(self.columns, self.columns.guard_bridge[self.row])
+
+    __str__ = Edge.__str__
+
+
+class JumpEdgeView(ColumnView):
+    # The edge from the jump of a trace (the row) to its target label.
+    __slots__ = ()
+    weight = column_property("jump_weight")
+
+    @property
+    def node(self) -> LabelView | None:
+        label_row = self.columns.jump_target[self.row]
+        return None if label_row == NO_ROW else LabelView(self.columns, label_row)
+
+    __str__ = Edge.__str__
+
+
+class JumpView(ColumnView):
+    # The terminator of a trace (the row).
+    __slots__ = ()
+    enter_count = column_property("jump_enter_count")
+
+    @property
+    def id(self) -> int | str:
+        return self.columns.terminator_id(self.row)
+
+    @property
+    def jump_to_edge(self) -> JumpEdgeView:
+        return JumpEdgeView(self.columns, self.row)
+
+    def __str__(self):
+        # Print exactly like the dataclass would.
+        columns = self.columns
+        label = self.jump_to_edge.node
+        if columns.trace_flags[self.row] & DONE_WITH_THIS_FRAME:
+            return str(DoneWithThisFrame(self.id, self.enter_count, PlaceHolderEdge(None, self.jump_to_edge.weight)))
+        return str(Jump(self.id, self.enter_count, Edge(Label(label.id, label.before_count, label.after_count), self.jump_to_edge.weight)))
+
+
+class HeaderView(ColumnView):
+    __slots__ = ()
+
+    @property
+    def labels_and_guards(self) -> list[GuardView | LabelView]:
+        columns = self.columns
+        return [columns.item_view(item) for item in columns.items[columns.trace_header_start[self.row]:columns.trace_items_start[self.row]]]
+
+
+class TraceView(ColumnView):
+    __slots__ = ()
+    uuid = column_property("trace_uuid")
+    id = column_property("trace_id")
+    enter_count = column_property("trace_enter_count")
+    suboptimality_cost = column_property("trace_suboptimality_cost")
+
+    @property
+    def info(self) -> str:
+        return self.columns.trace_info[self.row]
+
+    @property
+    def header(self) -> HeaderView | None:
+        if self.columns.trace_flags[self.row] & HAS_HEADER:
+            return HeaderView(self.columns, self.row)
+        return None
+
+    @property
+    def labels_and_guards(self) -> list[GuardView | LabelView]:
+        columns = self.columns
+        return [columns.item_view(item) for item in columns.items[columns.trace_items_start[self.row]:columns.trace_items_stop[self.row]]]
+
+    @property
+    def jump(self) -> JumpView:
+        return JumpView(self.columns, self.row)
+
+    @property
+    def is_suboptimal_cause(self) -> GuardView | None:
+        guard_row = self.columns.trace_suboptimal_cause[self.row]
+        return None if guard_row == NO_ROW else GuardView(self.columns, guard_row)
+
+    @is_suboptimal_cause.setter
+    def is_suboptimal_cause(self, guard: GuardView | None):
+        self.columns.trace_suboptimal_cause[self.row] = NO_ROW if guard is None else guard.row
+
+    def __str__(self):
+        res = []
+        for lab in self.labels_and_guards:
+            if isinstance(lab, GuardView) and lab.bridge is None:
+                continue
+            res.append(str(lab))
+        res.append(str(self.jump))
+        indented = textwrap.indent('\n'.join(res), '    ')
+        suboptimality_trailer = f" [!!!!!*SUBOPTIMAL ID={self.is_suboptimal_cause.id}*!!!!!]" if self.is_suboptimal_cause else ""
+        name = "Trace" if self.columns.trace_kind[self.row] == KIND_TRACE else "Bridge"
+        return f"{name}<{self.id}, enters={self.enter_count}>{suboptimality_trailer}\n{indented}"
+
+    def serialize(self):
+        # Same as TraceLike.serialize.
+        return {f"Trace:{self.uuid}": [guard.serialize() for guard in self.labels_and_guards if isinstance(guard, GuardView)]}
+
+
+if __name__ == "__main__":
+    import sys
+    import tracemalloc
+    from parser import parse_and_build_trace_trees
+    tracemalloc.start()
+    columns = ForestColumns.from_log(sys.argv[1])
+    print(f"columns: {len(columns.trace_id)} traces, {len(columns.guard_id)} guards, {len(columns.label_id)} labels")
+    print(f"columns: {tracemalloc.get_traced_memory()[0] / 2**20:.1f} MiB ({columns.nbytes() / 2**20:.1f} MiB in arrays)")
+    del columns
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    with open_log(sys.argv[1]) as fp:
+        forest = parse_and_build_trace_trees(fp)
+    print(f"objects: {(tracemalloc.get_traced_memory()[0] - before) / 2**20:.1f} MiB")
@@ -0,0 +1,163 @@
+"""
+Vectorized analytics over a trace forest, with NumPy.
+
+ForestCSR flattens the Trace/Bridge tree that parse_and_build_trace_trees
+returns into a compressed-sparse-row adjacency structure: node i's bridges are
+indices[indptr[i]:indptr[i+1]], one edge per guard that has a bridge. Counts,
+weights and kinds live in NumPy arrays next to it, so edge weights, the
+suboptimality verdicts and hotness rankings are whole-array operations instead
+of a Python loop over every object.
+
+Usage: python src/forest_csr.py PYPYLOG
+checks the vectorized passes against compute_edges and decide_sub_optimality.
+"""
+from collections import deque
+
+import numpy as np
+
+from parser import (
+    Trace,
+    Guard,
+    TraceLike,
+    compute_edges,
+    decide_sub_optimality,
+    open_log,
+    parse_and_build_trace_trees,
+)
+
+KIND_TRACE = 0
+KIND_BRIDGE = 1
+
+NO_EDGE = -1
+
+
+class ForestCSR:
+    def __init__(self, entries: list[Trace]):
+        """
+        Numbers every node reachable from entries in BFS order (a node shared by
+        several entries gets one row). The counts are read as they are now, so
+        build it before compute_edges to redo that pass with compute_edge_weights.
+        """
+        self.nodes: list[TraceLike] = []
+        # edge_guards[e] is the guard of edge e.
+        self.edge_guards: list[Guard] = []
+        row_of: dict[int, int] = {}
+        indptr = [0]
+        indices = []
+        kind, enter_count, jump_count, fallback_jump_count = [], [], [], []
+
+        queue = deque()
+        for entry in entries:
+            if id(entry) not in row_of:
+                row_of[id(entry)] = len(self.nodes)
+                self.nodes.append(entry)
+                queue.append(entry)
+        while queue:
+            node = queue.popleft()
+            kind.append(KIND_TRACE if isinstance(node, Trace) else KIND_BRIDGE)
+            enter_count.append(node.enter_count)
+            jump_count.append(node.jump.enter_count)
+            # compute_edges' guess for a missing jump count.
+            fallback_jump_count.append(node.labels_and_guards[-1].after_count if node.labels_and_guards else node.enter_count)
+            for guard in node.labels_and_guards:
+                if isinstance(guard, Guard) and guard.bridge is not None:
+                    bridge = guard.bridge.node
+                    if id(bridge) not in row_of:
+                        row_of[id(bridge)] = len(self.nodes)
+                        self.nodes.append(bridge)
+                        queue.append(bridge)
+                    indices.append(row_of[id(bridge)])
+                    self.edge_guards.append(guard)
+            indptr.append(len(indices))
+
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.kind = np.array(kind, dtype=np.int8)
+        self.enter_count = np.array(enter_count, dtype=np.int64)
+        self.jump_count = np.array(jump_count, dtype=np.int64)
+        self.fallback_jump_count = np.array(fallback_jump_count, dtype=np.int64)
+        self.after_count = np.array([guard.after_count for guard in self.edge_guards], dtype=np.int64)
+        # The node each edge starts from.
+        self.edge_source = np.repeat(np.arange(len(self.nodes), dtype=np.int64), np.diff(self.indptr))
+        self.edge_weight = np.array([guard.bridge.weight for guard in self.edge_guards], dtype=np.int64)
+        self.jump_weight = np.array([node.jump.jump_to_edge.weight for node in self.nodes], dtype=np.int64)
+        self.suboptimal_cause = np.full(len(self.nodes), NO_EDGE, dtype=np.int64)
+        self.suboptimality_cost = np.zeros(len(self.nodes), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def compute_edge_weights(self):
+        """
+        compute_edges: a bridge edge weighs its bridge's enter count, a jump its
+        count, or the guess for it when it's missing.
+        """
+        self.edge_weight = self.enter_count[self.indices]
+        self.jump_count = np.where(self.jump_count == 0, self.fallback_jump_count, self.jump_count)
+        self.jump_weight = self.jump_count.copy()
+
+    def decide_sub_optimality(self):
+        """
+        decide_sub_optimality: a node is suboptimal if one of its bridge edges is
+        heavier than its jump, and the cause is the last such guard.
+        """
+        hotter = self.edge_weight > self.jump_weight[self.edge_source]
+        cause = np.full(len(self.nodes), NO_EDGE, dtype=np.int64)
+        np.maximum.at(cause, self.edge_source[hotter], np.flatnonzero(hotter))
+        self.suboptimal_cause = cause
+        self.suboptimality_cost = np.bincount(self.edge_source, weights=np.where(hotter, self.edge_weight, 0), minlength=len(self.nodes)).astype(np.int64)
+
+    def count_suboptimality(self) -> int:
+        return int(np.count_nonzero(self.suboptimal_cause != NO_EDGE))
+
+    def hottest(self, k: int) -> np.ndarray:
+        """
+        Rows of the k most entered nodes, hottest first.
+        """
+        k = min(k, len(self.nodes))
+        top = np.argpartition(-self.enter_count, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        return top[np.argsort(-self.enter_count[top], kind="stable")]
+
+    def most_suboptimal(self, k: int) -> np.ndarray:
+        """
+        Rows of the k nodes with the highest suboptimality cost, worst first.
+        """
+        k = min(k, len(self.nodes))
+        top = np.argpartition(-self.suboptimality_cost, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        return top[np.argsort(-self.suboptimality_cost[top], kind="stable")]
+
+    def cause(self, row: int) -> Guard | None:
+        edge = self.suboptimal_cause[row]
+        return None if edge == NO_EDGE else self.edge_guards[edge]
+
+    def mismatches(self) -> list[TraceLike]:
+        """
+        The nodes whose is_suboptimal_cause (from the object passes) disagrees
+        with the vectorized verdict.
+        """
+        return [node for row, node in enumerate(self.nodes) if self.cause(row) is not node.is_suboptimal_cause]
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    with open_log(sys.argv[1]) as fp:
+        entries, all_bridges = parse_and_build_trace_trees(fp)
+    start = time.perf_counter()
+    csr = ForestCSR(entries)
+    built = time.perf_counter()
+    csr.compute_edge_weights()
+    csr.decide_sub_optimality()
+    vectorized = time.perf_counter()
+    compute_edges(entries, entries + all_bridges)
+    decide_sub_optimality(entries)
+    objects = time.perf_counter()
+    print(f"{len(csr)} nodes, {len(csr.indices)} bridge edges")
+    print(f"build {built - start:.3f}s, vectorized passes {vectorized - built:.3f}s, object passes {objects - vectorized:.3f}s")
+    assert (csr.edge_weight == [guard.bridge.weight for guard in csr.edge_guards]).all()
+    assert (csr.jump_weight == [node.jump.jump_to_edge.weight for node in csr.nodes]).all()
+    assert (csr.suboptimality_cost == [node.suboptimality_cost for node in csr.nodes]).all()
+    mismatches = csr.mismatches()
+    print(f"{csr.count_suboptimality()} suboptimal, {len(mismatches)} verdicts differ from decide_sub_optimality")
+    for row in csr.most_suboptimal(5):
+        print(f"  cost {csr.suboptimality_cost[row]:>12}  {type(csr.nodes[row]).__name__}<{csr.nodes[row].id}>")
@@ -50,6 +50,22 @@ class Decoder:
     def __init__(self, s):
         self.s = s
         self.pos = 0
+        # Trace id -> subtree, filled while parsing so find_loop_id is a lookup.
+        self.loops = {}
+
+    @jit.dont_look_inside
+    def find_loop_id(self, id_str):
+        """
+        Same result as find_loop_id on the root parse_array returns, without
+        searching the tree. Parses the whole string first if that hasn't been
+        done yet.
+        """
+        if self.pos == 0:
+            self.parse_array()
+        res = self.loops.get(id_str, None)
+        if res is None:
+            return ListOrDictOrStr(ListOrDictOrStr.NONE, [], {}, "")
+        return res
 
     @jit.dont_look_inside
     def parse_array(self):
@@ -72,7 +88,18 @@ class Decoder:
         key = self.parse_str()
         assert self.s[self.pos] == ':'
         self.pos += 1
+        # The first trace with an id wins, like in find_loop_id's search,
+        # so claim the id before parsing the nested ones.
+        loop_id = ""
+        if key.st.startswith("Trace:"):
+            loop_id = key.st[len("Trace:"):].strip()
+            if loop_id in self.loops:
+                loop_id = ""
+            else:
+                self.loops[loop_id] = key
         value = self.parse_any()
+        if loop_id:
+            self.loops[loop_id] = value
         assert self.s[self.pos] == '}'
         self.pos += 1
         return ListOrDictOrStr(ListOrDictOrStr.DICT, [], {key : value}, "")
@@ -110,5 +137,280 @@ class Decoder:
         print("Unrecognized token %d %s" % (self.pos, nxt))
         assert False
 
+
+
+"""
+This is actually for copying into RPython.
+Lazy version of Decoder: the first find_loop_id scans the shapefile once,
+only matching brackets to find where the guard list of every trace starts and
+ends, and each find_loop_id then decodes just that list. Nodes share the empty
+containers and the NONE node, and equal strings share their STR node, so a
+decoded guard costs one DICT node and its dict.
+"""
+EMPTY_LST = []
+EMPTY_DCT = {}
+
+class LazyDecoder(Decoder):
+    def __init__(self, s):
+        Decoder.__init__(self, s)
+        # Trace id -> where its guard list starts (-1 while still being scanned).
+        self.spans = {}
+        self.scanned = False
+        self.found = {}
+        self.none = ListOrDictOrStr(ListOrDictOrStr.NONE, EMPTY_LST, EMPTY_DCT, "")
+        self.strs = {}
+
+    @jit.dont_look_inside
+    def scan(self):
+        # The id owning each open bracket, "" if none.
+        open_ids = []
+        pending = ""
+        s = self.s
+        i = 0
+        while i < len(s):
+            c = s[i]
+            if c == '"':
+                end = s.find('"', i + 1)
+                assert end != -1
+                if s[i + 1:i + 1 + len("Trace:")] == "Trace:":
+                    loop_id = s[i + 1 + len("Trace:"):end].strip()
+                    # The first trace with an id wins, see Decoder.parse_obj.
+                    if loop_id not in self.spans:
+                        self.spans[loop_id] = -1
+                        pending = loop_id
+                i = end
+            elif c == '[' or c == '{':
+                if pending:
+                    self.spans[pending] = i
+                open_ids.append(pending)
+                pending = ""
+            elif c == ']' or c == '}':
+                open_ids.pop()
+            elif c == ',':
+                pending = ""
+            i += 1
+        assert not open_ids
+        self.scanned = True
+
+    @jit.dont_look_inside
+    def find_loop_id(self, id_str):
+        if not self.scanned:
+            self.scan()
+        res = self.found.get(id_str, None)
+        if res is None:
+            start = self.spans.get(id_str, -1)
+            if start == -1:
+                return self.none
+            self.pos = start
+            res = self.parse_array()
+            self.found[id_str] = res
+        return res
+
+    @jit.dont_look_inside
+    def parse_array(self):
+        assert self.s[self.pos] == '['
+        self.pos += 1
+        result = []
+        while self.s[self.pos] != ']':
+            result.append(self.parse_any())
+            if self.s[self.pos] != ']':
+                assert self.s[self.pos] == ','
+                self.pos += 1
+        self.pos += 1
+        return ListOrDictOrStr(ListOrDictOrStr.LIST, result, EMPTY_DCT, "")
+
+    @jit.dont_look_inside
+    def parse_obj(self):
+        assert self.s[self.pos] == '{'
+        self.pos += 1
+        key = self.parse_str()
+        assert self.s[self.pos] == ':'
+        self.pos += 1
+        value = self.parse_any()
+        assert self.s[self.pos] == '}'
+        self.pos += 1
+        return ListOrDictOrStr(ListOrDictOrStr.DICT, EMPTY_LST, {key : value}, "")
+
+    @jit.dont_look_inside
+    def parse_str(self):
+        assert self.s[self.pos] == '"'
+        start = self.pos + 1
+        end = self.s.find('"', start)
+        assert end != -1
+        self.pos = end + 1
+        st = self.s[start:end]
+        res = self.strs.get(st, None)
+        if res is None:
+            res = ListOrDictOrStr(ListOrDictOrStr.STR, EMPTY_LST, EMPTY_DCT, st)
+            self.strs[st] = res
+        return res
+
+    @jit.dont_look_inside
+    def parse_null(self):
+        assert self.s[self.pos] == 'n'
+        self.pos += len("null")
+        return self.none
+
+
+"""
+This is actually for copying into RPython.
+Decoder for the binary shapefile format, see src/binary_shapefile.py.
+
+Gives the same ListOrDictOrStr tree as Decoder on the JSON shapefile. Expects a
+str with one character per byte (in CPython: data.decode("latin-1")).
+"""
+BINARY_SHAPEFILE_MAGIC = "GSHP"
+BINARY_SHAPEFILE_VERSION = 1
+# Same, with a table of where each trace starts right after the version:
+# varint(table size in bytes) varint(#traces) (varint(uuid) varint(offset in the body))*
+BINARY_SHAPEFILE_VERSION_INDEXED = 2
+
+# One-byte guard op codes: the index in this list.
+GUARD_OPS = [
+    "guard_true", "guard_false", "guard_value", "guard_class", "guard_nonnull",
+    "guard_isnull", "guard_nonnull_class", "guard_gc_type", "guard_is_object",
+    "guard_subclass", "guard_no_exception", "guard_exception", "guard_no_overflow",
+    "guard_overflow", "guard_not_forced", "guard_not_forced_2", "guard_not_invalidated",
+    "guard_future_condition", "guard_always_fails",
+]
+# Followed by the op name as a varint length and its bytes.
+GUARD_OP_OTHER = 255
+
+GUARD_FLAG_INVERTED = 1
+GUARD_FLAG_EXPECTED_INVERTED = 2
+GUARD_FLAG_BRIDGE = 4
+
+class BinaryDecoder:
+    def __init__(self, s):
+        self.s = s
+        self.pos = 0
+        # Shared, so a guard costs one dict and one list slot.
+        self.none = ListOrDictOrStr(ListOrDictOrStr.NONE, [], {}, "")
+        self.guard_keys = [None] * (len(GUARD_OPS) * 4)
+        self.loops = {}
+        # From the offset table, if the file has one.
+        self.offsets = {}
+        self.body_start = -1
+        # What find_loop_id decoded so far.
+        self.found = {}
+
+    @jit.dont_look_inside
+    def parse_varint(self):
+        res = 0
+        shift = 0
+        while True:
+            byte = ord(self.s[self.pos])
+            self.pos += 1
+            res |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return res
+            shift += 7
+
+    @jit.dont_look_inside
+    def parse_guard_key(self):
+        code = ord(self.s[self.pos])
+        self.pos += 1
+        op = ""
+        if code == GUARD_OP_OTHER:
+            # The op name comes before the flags.
+            length = self.parse_varint()
+            start = self.pos
+            self.pos += length
+            op = self.s[start:self.pos]
+        flags = ord(self.s[self.pos])
+        self.pos += 1
+        post = ""
+        if flags & GUARD_FLAG_INVERTED:
+            post = "I"
+        if flags & GUARD_FLAG_EXPECTED_INVERTED:
+            post = "P"
+        if code == GUARD_OP_OTHER:
+            return ListOrDictOrStr(ListOrDictOrStr.STR, [], {}, "Guard" + post + ":" + op), flags
+        assert code < len(GUARD_OPS)
+        idx = code * 4 + (flags & (GUARD_FLAG_INVERTED | GUARD_FLAG_EXPECTED_INVERTED))
+        key = self.guard_keys[idx]
+        if key is None:
+            key = ListOrDictOrStr(ListOrDictOrStr.STR, [], {}, "Guard" + post + ":" + GUARD_OPS[code])
+            self.guard_keys[idx] = key
+        return key, flags
+
+    @jit.dont_look_inside
+    def parse_trace(self):
+        uuid = self.parse_varint()
+        n_guards = self.parse_varint()
+        # The first trace with an id wins, see Decoder.parse_obj.
+        loop_id = "%d" % uuid
+        if loop_id in self.loops:
+            loop_id = ""
+        else:
+            self.loops[loop_id] = self.none
+        guards = [self.none] * n_guards
+        for i in range(n_guards):
+            key, flags = self.parse_guard_key()
+            if flags & GUARD_FLAG_BRIDGE:
+                value = self.parse_trace()
+            else:
+                value = self.none
+            guards[i] = ListOrDictOrStr(ListOrDictOrStr.DICT, [], {key: value}, "")
+        key = ListOrDictOrStr(ListOrDictOrStr.STR, [], {}, "Trace:%d" % uuid)
+        value = ListOrDictOrStr(ListOrDictOrStr.LIST, guards, {}, "")
+        if loop_id:
+            self.loops[loop_id] = value
+        return ListOrDictOrStr(ListOrDictOrStr.DICT, [], {key: value}, "")
+
+    @jit.dont_look_inside
+    def parse_header(self):
+        assert self.s[0:len(BINARY_SHAPEFILE_MAGIC)] == BINARY_SHAPEFILE_MAGIC
+        self.pos = len(BINARY_SHAPEFILE_MAGIC)
+        version = ord(self.s[self.pos])
+        self.pos += 1
+        if version == BINARY_SHAPEFILE_VERSION_INDEXED:
+            table_size = self.parse_varint()
+            self.body_start = self.pos + table_size
+            n_traces = self.parse_varint()
+            for i in range(n_traces):
+                uuid = self.parse_varint()
+                self.offsets["%d" % uuid] = self.parse_varint()
+            assert self.pos == self.body_start
+        else:
+            assert version == BINARY_SHAPEFILE_VERSION
+            self.body_start = self.pos
+
+    @jit.dont_look_inside
+    def parse_shapefile(self):
+        self.parse_header()
+        n_entries = self.parse_varint()
+        entries = [self.none] * n_entries
+        for i in range(n_entries):
+            entries[i] = self.parse_trace()
+        return ListOrDictOrStr(ListOrDictOrStr.LIST, entries, {}, "")
+
+    @jit.dont_look_inside
+    def find_loop_id(self, id_str):
+        """
+        With an offset table, decodes just the subtree of that trace, without
+        parsing the rest of the file. Same result as find_loop_id on the root.
+        """
+        if self.body_start == -1:
+            self.parse_header()
+        if not self.offsets:
+            # No offset table, parse it all.
+            if not self.loops:
+                self.parse_shapefile()
+            res = self.loops.get(id_str, None)
+        else:
+            res = self.found.get(id_str, None)
+            if res is None:
+                offset = self.offsets.get(id_str, -1)
+                if offset == -1:
+                    return self.none
+                self.pos = self.body_start + offset
+                for value in self.parse_trace().dct.values():
+                    res = value
+                self.found[id_str] = res
+        if res is None:
+            return self.none
+        return res
+
 if __name__ == "__main__":
     print(Decoder(open("src/test/pyperformance/bm_go_guided_2_serialized").read()).parse_array())
\ No newline at end of file
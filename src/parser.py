@@ -1,7 +1,12 @@
 from __future__ import annotations
 
 
+from collections import deque
+from contextlib import contextmanager
 from dataclasses import dataclass, replace, field, asdict
+import io
+import mmap
+import os
 import re
 import textwrap
 
@@ -27,6 +32,10 @@ class TraceLike:
     enter_count: int = -1
 
     is_suboptimal_cause: "Guard | None" = None
+    # Executions leaving this trace through bridges hotter than its jump.
+    suboptimality_cost: int = 0
+    # Set by the reorderers on nodes they rewrote, until redecide_sub_optimality runs.
+    dirty: bool = False
 
     def __str__(self):
         res = []
@@ -172,97 +181,219 @@ AFTER_GUARD_RE = re.compile(AFTER_GUARD_PAT)
 AFTER_EXPECTED_INVERTED_GUARD_PAT = "AfterExpectedInvertedGuardAt\((\d+)\):(\d+)"
 AFTER_EXPECTED_INVERTED_GUARD_RE = re.compile(AFTER_EXPECTED_INVERTED_GUARD_PAT)
 
-
-def find_jump_containing_trace(all_nodes: list[Bridge | Trace], jump: Jump):
-    for node in all_nodes:
-        if jump.id == node.jump.id:
-            return node
+# Anchored extractors used by the tokenizer below. Unlike the *_RE patterns above
+# these don't start with a greedy ".*", and only ever run on a line whose op name
+# already told us what it is.
+GUARD_DESCR_PAT = f"descr=<Guard({HEX_PAT})>"
+GUARD_DESCR_RE = re.compile(GUARD_DESCR_PAT)
+TARGET_TOKEN_PAT = "descr=TargetToken\((\d+)\)\)"
+TARGET_TOKEN_RE = re.compile(TARGET_TOKEN_PAT)
+DONE_WITH_THIS_FRAME_DESCR = "descr=<DoneWithThisFrameDescr"
+PEELED_LOOP_MARKER = "'peeled loop'"
+
+# Kinds of op lines tokenize_op_line cares about.
+OP_LABEL = 1
+OP_GUARD = 2
+OP_JUMP = 3
+OP_FINISH = 4
+OP_PEELED_LOOP = 5
+
+
+def tokenize_op_line(line: str) -> tuple[int, "int | tuple[int, str] | None"] | None:
+    """
+    Classifies a single jit-log-opt line by its op name, then runs only the
+    extractor for that kind of op.
+
+    Returns None for everything we don't care about, which is most lines of a trace
+    (arithmetic, getfields, debug_merge_points...). Otherwise returns (kind, value):
+        OP_LABEL        -> TargetToken id
+        OP_GUARD        -> (guard id, guard op)
+        OP_JUMP         -> TargetToken id
+        OP_FINISH       -> None
+        OP_PEELED_LOOP  -> None
+    """
+    # "+123: i5 = int_add(i3, 1)" -> "int_add"
+    paren = line.find('(')
+    if paren == -1:
+        return None
+    op = line[line.rfind(' ', 0, paren) + 1:paren]
+    if op.startswith("guard_"):
+        if guard_match := GUARD_DESCR_RE.search(line, paren):
+            return OP_GUARD, (int(guard_match.group(1), base=16), op)
+    elif op == "label":
+        if label_match := TARGET_TOKEN_RE.search(line, paren):
+            return OP_LABEL, int(label_match.group(1))
+    elif op == "jump":
+        if jump_match := TARGET_TOKEN_RE.search(line, paren):
+            return OP_JUMP, int(jump_match.group(1))
+    elif op == "finish":
+        if DONE_WITH_THIS_FRAME_DESCR in line:
+            return OP_FINISH, None
+    elif op == "jit_debug":
+        if PEELED_LOOP_MARKER in line:
+            return OP_PEELED_LOOP, None
     return None
 
 
-def find_bridge(all_bridges: list[Bridge], from_guard: Guard):
-    for bridge in all_bridges:
-        if bridge.id == from_guard.id:
-            return bridge
-    return None
+def parse_trace_body(fp, terminator_id: str) -> tuple["PeeledHeader | None", list["Label | Guard"], "Jump | None", str]:
+    """
+    Reads the ops of a single "# Loop" or "# bridge out of" section, up to and
+    including its "--end of the loop--" marker.
 
-def find_label_obj_via_label(all_nodes: list[Label | Guard], label: int):
-    for node in all_nodes:
-        for label_obj in node.labels_and_guards:
-            if isinstance(label_obj, Label):
-                if label_obj.id == label:
-                    return label_obj
-    assert False, f"No corresponding node for label? {label}"
-
-def find_bridge_via_label(all_nodes: list[Bridge | Trace], label: int) -> Bridge:
-    visited = set()
-    worklist = list(all_nodes)
-    while worklist:
-        node = worklist.pop()
-        if id(node) in visited:
+    Returns the peeled header (if the loop was peeled), the labels and guards of the
+    trace proper, the terminator and the last line read.
+    """
+    peeled_loop_label_and_guard_idx = -1
+    peeled_loop_seen = 0
+    labels_and_guards = []
+    peeled_header = None
+    jump = None
+    line = ""
+    for line in fp:
+        if END_LOOP_MARKER in line:
+            break
+        token = tokenize_op_line(line)
+        if token is None:
             continue
-        visited.add(id(node))
-        if isinstance(node, Guard) and node.id == label:
-            return node
-        if isinstance(node, Bridge) or isinstance(node, Trace):
-            for node in node.labels_and_guards:
-                worklist.append(node)
-    assert False, f"Cannot find guard with label {label}"
+        kind, value = token
+        if kind == OP_GUARD:
+            labels_and_guards.append(Guard(value[0], value[1]))
+        elif kind == OP_LABEL:
+            labels_and_guards.append(Label(value))
+        elif kind == OP_JUMP:
+            jump = Jump(value)
+        elif kind == OP_FINISH:
+            jump = DoneWithThisFrame(terminator_id, 0, PlaceHolderEdge(None, 0))
+        elif kind == OP_PEELED_LOOP:
+            # Saw a peeled loop. Reset everything, as loop peeling is done by
+            # the loop optimizer in pypy, not the trace recorder.Tthus, the trace
+            # recorder has no knowledge of this and we would inform the trace recorder
+            # wrongly if we were to feed the peeled loop preheader in.
+            # This does give up some inversion possibilities. However, the assumption
+            # is that most of the interesting guard failures are going to happen
+            # in the peeled loop, as that part is hotter than the preheader.
+            if peeled_loop_seen == 0:
+                peeled_loop_label_and_guard_idx = len(labels_and_guards)
+            peeled_loop_seen += 1
+    # Peeled a loop.
+    if peeled_loop_seen >= 2:
+        assert peeled_loop_label_and_guard_idx != -1
+        peeled_header = PeeledHeader(labels_and_guards[:peeled_loop_label_and_guard_idx])
+        labels_and_guards = labels_and_guards[peeled_loop_label_and_guard_idx:]
+    return peeled_header, labels_and_guards, jump, line
 
 
-def add_entry_count(all_entries: list[Trace], entry_id: int, count: int):
+@dataclass(slots=True)
+class SymbolTable:
+    """
+    Hash indexes over everything parsed so far, filled in as the sections of the
+    log are read. The counts and linking passes go through these instead of
+    scanning lists, so building the forest stays linear in the size of the log.
+
+    When an id shows up more than once, the first one seen wins, same as the
+    old linear scans.
+    """
+    entries: list[Trace] = field(default_factory=list)
+    all_bridges: list[Bridge] = field(default_factory=list)
+    # Trace id -> entry trace.
+    entries_by_id: dict[int, Trace] = field(default_factory=dict)
+    # Id of the guard a bridge comes out of -> bridge.
+    bridges_by_guard_id: dict[int, Bridge] = field(default_factory=dict)
+    # TargetToken id -> label.
+    labels_by_id: dict[int, Label] = field(default_factory=dict)
+    # Guard descr address -> guard.
+    guards_by_id: dict[int, Guard] = field(default_factory=dict)
+    # Only the hot traces were parsed, the rest are stubs without labels or guards
+    # (see LogIndex.build_trace_trees). Counts for labels and guards we never saw
+    # are dropped, and jumps into cold traces get a stand-in label.
+    partial: bool = False
+
+    def add_entry(self, entry: Trace):
+        self.entries.append(entry)
+        self.entries_by_id.setdefault(entry.id, entry)
+        self.add_tracelike_labels_and_guards(entry)
+
+    def add_bridge(self, bridge: Bridge):
+        self.all_bridges.append(bridge)
+        self.bridges_by_guard_id.setdefault(bridge.id, bridge)
+        self.add_tracelike_labels_and_guards(bridge)
+
+    def add_label(self, label: Label):
+        self.labels_by_id.setdefault(label.id, label)
+
+    def add_guard(self, guard: Guard):
+        self.guards_by_id.setdefault(guard.id, guard)
+
+    def add_labels_and_guards(self, labels_and_guards: list[Label | Guard]):
+        for label_or_guard in labels_and_guards:
+            if isinstance(label_or_guard, Guard):
+                self.add_guard(label_or_guard)
+            else:
+                self.add_label(label_or_guard)
+
+    def add_tracelike_labels_and_guards(self, tracelike: TraceLike):
+        if tracelike.header is not None:
+            self.add_labels_and_guards(tracelike.header.labels_and_guards)
+        self.add_labels_and_guards(tracelike.labels_and_guards)
+
+
+def find_bridge(symbols: SymbolTable, from_guard: Guard):
+    return symbols.bridges_by_guard_id.get(from_guard.id)
+
+def find_label_obj_via_label(symbols: SymbolTable, label: int, allow_missing: bool = False):
+    label_obj = symbols.labels_by_id.get(label)
+    if label_obj is None and (allow_missing or symbols.partial):
+        # Not registered: the real label might still turn up.
+        return Label(label)
+    assert label_obj is not None, f"No corresponding node for label? {label}"
+    return label_obj
+
+def add_entry_count(symbols: SymbolTable, entry_id: int, count: int):
     if count == 0:
-        return    
-    for entry in all_entries:
-        if entry.id == entry_id:
-            entry.enter_count = count
-            return
-    assert False, f"Could not find entry trace {entry_id}"
+        return
+    entry = symbols.entries_by_id.get(entry_id)
+    assert entry is not None, f"Could not find entry trace {entry_id}"
+    entry.enter_count = count
 
-def add_bridge_count(all_entries: list[Bridge], guard_id: int, count: int):
+def add_bridge_count(symbols: SymbolTable, guard_id: int, count: int):
     if count == 0:
         return
-    for bridge in all_entries:
-        if bridge.id == guard_id:
-            bridge.enter_count = count
-            return
-    assert False, f"Could not find bridge trace {guard_id}"
+    bridge = symbols.bridges_by_guard_id.get(guard_id)
+    assert bridge is not None, f"Could not find bridge trace {guard_id}"
+    bridge.enter_count = count
 
-def add_label_before_count(all_entries: list[Label], label_id: int, count: int):
-    for label in all_entries:
-        if label.id == label_id:
-            label.before_count = count
-            return
-    assert False, "Could not find label"
+def add_label_before_count(symbols: SymbolTable, label_id: int, count: int):
+    label = symbols.labels_by_id.get(label_id)
+    if label is None and symbols.partial:
+        return
+    assert label is not None, "Could not find label"
+    label.before_count = count
 
-def add_label_after_count(all_entries: list[Label], label_id: int, count: int):
-    for label in all_entries:
-        if label.id == label_id:
-            label.after_count = count
-            return
-    assert False, "Could not find label"
+def add_label_after_count(symbols: SymbolTable, label_id: int, count: int):
+    label = symbols.labels_by_id.get(label_id)
+    if label is None and symbols.partial:
+        return
+    assert label is not None, "Could not find label"
+    label.after_count = count
 
-def add_jump_count(all_entries: list[TraceLike], jump_id: int, count: int):
+def add_jump_count(symbols: SymbolTable, jump_id: int, count: int):
     if count == 0:
-        return    
+        return
     if jump_id < 0:
         return
-    for trace in all_entries:
-        if trace.id == jump_id:
-            trace.jump.enter_count = count
-            return
-    assert False, f"Could not find jump {jump_id}"
+    trace = symbols.entries_by_id.get(jump_id) or symbols.bridges_by_guard_id.get(jump_id)
+    assert trace is not None, f"Could not find jump {jump_id}"
+    trace.jump.enter_count = count
 
-def add_guard_after_count(all_guards: list[Guard], guard_id: int, count: int, expected_inversion: bool = False):
+def add_guard_after_count(symbols: SymbolTable, guard_id: int, count: int, expected_inversion: bool = False):
     if count == 0:
         return
-    for guard in all_guards:
-        if guard.id == guard_id:
-            guard.after_count = count
-            guard.expected_to_be_inverted = expected_inversion
-            return
-    print(all_guards)
-    assert False, f"Could not find guard {guard_id}"
+    guard = symbols.guards_by_id.get(guard_id)
+    if guard is None and symbols.partial:
+        return
+    assert guard is not None, f"Could not find guard {guard_id}"
+    guard.after_count = count
+    guard.expected_to_be_inverted = expected_inversion
 
 
 def compute_edges(all_entries: list[Trace], all_nodes: list):
@@ -270,44 +401,206 @@ def compute_edges(all_entries: list[Trace], all_nodes: list):
     For a guard, the edge weight is just the guard entry count. Simple!
 
     Likewise for a backwards edge.
+
+    This is a single BFS over the whole forest: a node reachable from several
+    entries is only visited once.
     """
-    for entry in all_entries:
-        seen: set[int] = set()
+    seen: set[int] = set()
 
-        queue = [entry]
-        while queue:
-            nxt = queue.pop(0)
-            if id(nxt) in seen:
+    queue = deque(all_entries)
+    while queue:
+        nxt = queue.popleft()
+        if id(nxt) in seen:
+            continue
+        seen.add(id(nxt))
+        if isinstance(nxt, Guard):
+            if nxt.bridge is not None:
+                nxt.bridge.weight = nxt.bridge.node.enter_count
+                queue.append(nxt.bridge.node)
+        elif isinstance(nxt, Trace | Bridge):
+            # We should not be recomputing things!
+            if nxt.jump.jump_to_edge.weight != 0:
+                # print("Warning: wasteful recomputation")
                 continue
-            seen.add(id(nxt))
-            if isinstance(nxt, Guard):
-                if nxt.bridge is not None:
-                    nxt.bridge.weight = nxt.bridge.node.enter_count
-                    queue.append(nxt.bridge.node)
-            elif isinstance(nxt, Trace | Bridge):
-                # We should not be recomputing things!
-                if nxt.jump.jump_to_edge.weight != 0:
-                    # print("Warning: wasteful recomputation")
-                    continue
-                # Bug in our instrumentation. TODO Fix me. For now, just
-                # get it from the "afters" of the last guard before this jump
-                if nxt.jump.enter_count == 0:
-                    if nxt.labels_and_guards:
-                        count = nxt.labels_and_guards[-1].after_count
-                    else:
-                        count = nxt.enter_count
-                    nxt.jump.jump_to_edge.weight = nxt.jump.enter_count = count
+            # Bug in our instrumentation. TODO Fix me. For now, just
+            # get it from the "afters" of the last guard before this jump
+            if nxt.jump.enter_count == 0:
+                if nxt.labels_and_guards:
+                    count = nxt.labels_and_guards[-1].after_count
                 else:
-                    nxt.jump.jump_to_edge.weight = nxt.jump.enter_count
-                queue.extend(nxt.labels_and_guards)
-                if isinstance(nxt.jump.jump_to_edge.node, Label):
-                    queue.append(nxt.jump.jump_to_edge.node)
-            elif isinstance(nxt, Label):
-                pass
-            elif isinstance(nxt, type(None)):
-                pass
+                    count = nxt.enter_count
+                nxt.jump.jump_to_edge.weight = nxt.jump.enter_count = count
             else:
-                assert False, f"Unknown node type {nxt}"
+                nxt.jump.jump_to_edge.weight = nxt.jump.enter_count
+            queue.extend(nxt.labels_and_guards)
+            if isinstance(nxt.jump.jump_to_edge.node, Label):
+                queue.append(nxt.jump.jump_to_edge.node)
+        elif isinstance(nxt, Label):
+            pass
+        elif isinstance(nxt, type(None)):
+            pass
+        else:
+            assert False, f"Unknown node type {nxt}"
+
+
+@dataclass(slots=True)
+class FlowSolution:
+    equations: int
+    unknowns: int
+    iterations: int
+    # ||Ax - b|| with the counts as measured (missing ones guessed like compute_edges does), and after solving.
+    initial_residual: float
+    residual: float
+    # residual / ||b||: how far the profile is from conserving flow.
+    relative_residual: float
+    filled_jumps: int = 0
+    filled_enter_counts: int = 0
+
+
+def solve_flow_counts(entries: list[Trace], all_bridges: list[Bridge], overwrite: bool = False,
+                      max_iterations: int = 1000, tolerance: float = 1e-9) -> FlowSolution:
+    """
+    Reconstructs missing jump and enter counts from flow conservation, instead of
+    compute_edges' guess of copying the last guard's count.
+
+    Every trace gets one unknown per point between its labels and guards: the
+    number of executions passing there, starting with the enter count and ending
+    with the jump count. Then, in the least squares sense:
+    - measured counts (enter, guard afters, label befores/afters, jumps) hold,
+    - what doesn't pass a guard enters its bridge,
+    - what a label adds to the flow comes from the jumps targeting it.
+    Guards without a bridge leak an unknown amount, so they only get the first.
+
+    Missing counts (0, or -1 for an enter count) get the solution, and with
+    overwrite the measured ones too. Run it before compute_edges. Uses NumPy
+    when it is installed, plain lists otherwise.
+    """
+    # Linked bridges are copies, but they share their jump with the original.
+    traces = entries + all_bridges
+    first_unknown = {}
+    rows, cols, vals, b = [], [], [], []
+    guess = []
+
+    def equation(terms, rhs):
+        for col, val in terms:
+            rows.append(len(b))
+            cols.append(col)
+            vals.append(val)
+        b.append(float(rhs))
+
+    for trace in traces:
+        first_unknown[id(trace.jump)] = len(guess)
+        flow = max(trace.enter_count, 0)
+        guess.append(flow)
+        for item in trace.labels_and_guards:
+            if isinstance(item, Guard) and item.after_count > 0:
+                flow = item.after_count
+            elif isinstance(item, Label) and (item.before_count or item.after_count):
+                flow = item.after_count
+            guess.append(flow)
+        if trace.jump.enter_count > 0:
+            guess[-1] = trace.jump.enter_count
+
+    label_inflow = {}
+    for trace in traces:
+        target = trace.jump.jump_to_edge.node if trace.jump.jump_to_edge is not None else None
+        if isinstance(target, Label):
+            label_inflow.setdefault(id(target), []).append(first_unknown[id(trace.jump)] + len(trace.labels_and_guards))
+
+    for trace in traces:
+        start = first_unknown[id(trace.jump)]
+        if trace.enter_count > 0 and trace.header is None:
+            equation([(start, 1.0)], trace.enter_count)
+        for idx, item in enumerate(trace.labels_and_guards):
+            before, after = start + idx, start + idx + 1
+            if isinstance(item, Guard):
+                if item.after_count > 0:
+                    equation([(after, 1.0)], item.after_count)
+                if item.bridge is not None:
+                    bridge_start = first_unknown[id(item.bridge.node.jump)]
+                    equation([(before, 1.0), (after, -1.0), (bridge_start, -1.0)], 0)
+            elif item.before_count or item.after_count:
+                equation([(before, 1.0)], item.before_count)
+                equation([(after, 1.0)], item.after_count)
+                equation([(after, 1.0), (before, -1.0)] + [(jump, -1.0) for jump in label_inflow.get(id(item), [])], 0)
+        if trace.jump.enter_count > 0:
+            equation([(start + len(trace.labels_and_guards), 1.0)], trace.jump.enter_count)
+
+    n, m = len(guess), len(b)
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is not None:
+        rows, cols, vals = np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp), np.array(vals)
+        b, x = np.array(b), np.array(guess, dtype=float)
+        matvec = lambda v: np.bincount(rows, weights=vals * v[cols], minlength=m)
+        rmatvec = lambda v: np.bincount(cols, weights=vals * v[rows], minlength=n)
+        dot = lambda u, v: float(u @ v)
+        axpy = lambda a, u, v: a * u + v
+    else:
+        x = [float(flow) for flow in guess]
+        coo = list(zip(rows, cols, vals))
+        def matvec(v):
+            res = [0.0] * m
+            for row, col, val in coo:
+                res[row] += val * v[col]
+            return res
+        def rmatvec(v):
+            res = [0.0] * n
+            for row, col, val in coo:
+                res[col] += val * v[row]
+            return res
+        dot = lambda u, v: sum(a * c for a, c in zip(u, v))
+        axpy = lambda a, u, v: [a * c + d for c, d in zip(u, v)]
+
+    # CGLS: conjugate gradients on the normal equations, starting from the guess.
+    r = axpy(-1.0, matvec(x), b)
+    initial_residual = dot(r, r) ** 0.5
+    s = rmatvec(r)
+    p = s
+    gamma = dot(s, s)
+    stop = tolerance * dot(rmatvec(b), rmatvec(b)) ** 0.5
+    iterations = 0
+    while iterations < max_iterations and gamma ** 0.5 > stop:
+        q = matvec(p)
+        alpha = gamma / dot(q, q)
+        x = axpy(alpha, p, x)
+        r = axpy(-alpha, q, r)
+        s = rmatvec(r)
+        gamma, prev_gamma = dot(s, s), gamma
+        p = axpy(gamma / prev_gamma, p, s)
+        iterations += 1
+    residual = dot(r, r) ** 0.5
+    norm_b = dot(b, b) ** 0.5
+
+    solution = FlowSolution(m, n, iterations, initial_residual, residual, residual / norm_b if norm_b else 0.0)
+    solved_enter_counts = {}
+    for trace in traces:
+        start = first_unknown[id(trace.jump)]
+        jump_count = max(0, round(float(x[start + len(trace.labels_and_guards)])))
+        if overwrite or trace.jump.enter_count <= 0:
+            solution.filled_jumps += trace.jump.enter_count != jump_count
+            trace.jump.enter_count = jump_count
+        solved_enter_counts[id(trace.jump)] = max(0, round(float(x[start])))
+    # The enter count is copied into every linked bridge, so fix them all up.
+    originals = {id(trace) for trace in traces}
+    seen = set()
+    stack = list(traces)
+    while stack:
+        trace = stack.pop()
+        if id(trace) in seen:
+            continue
+        seen.add(id(trace))
+        if overwrite or trace.enter_count <= 0:
+            enter_count = solved_enter_counts[id(trace.jump)]
+            if id(trace) in originals:
+                solution.filled_enter_counts += trace.enter_count != enter_count
+            trace.enter_count = enter_count
+        for guard in trace.labels_and_guards:
+            if isinstance(guard, Guard) and guard.bridge is not None:
+                stack.append(guard.bridge.node)
+    return solution
 
 
 def find_previous_label(labels_or_guards, idx):
@@ -318,7 +611,24 @@ def find_previous_label(labels_or_guards, idx):
         idx -= 1
     return None, None
 
-def decide_sub_optimality_for_single_entry(entry: TraceLike, node: TraceLike | None):
+def decide_node_sub_optimality(node: TraceLike):
+    """
+    Decides the verdict of a single trace from its own guards and jump.
+
+    Besides the flag, the cost says how bad it is: the total weight of the
+    bridges that are hotter than the jump, i.e. how many executions leave the
+    trunk where the loop should have gone.
+    """
+    node.is_suboptimal_cause = None
+    node.suboptimality_cost = 0
+    jump_weight = node.jump.jump_to_edge.weight
+    for guard in node.labels_and_guards:
+        if isinstance(guard, Guard) and guard.bridge is not None:
+            if guard.bridge.weight > jump_weight:
+                node.is_suboptimal_cause = guard
+                node.suboptimality_cost += guard.bridge.weight
+
+def decide_sub_optimality_for_single_entry(entry: TraceLike, node: TraceLike | None, seen: set[int] | None = None):
     """
     Decides if a trace is sub-optimal.
 
@@ -326,91 +636,223 @@ def decide_sub_optimality_for_single_entry(entry: TraceLike, node: TraceLike | N
     If the heaviest weighted edge of a trace is not the terminator but rather a bridge.
     Then the trace is suboptimal.
 
-    
+    Walks the bridges with an explicit stack, so deep bridge-out-of-bridge chains
+    do not hit the recursion limit. The verdict only depends on the node itself,
+    so every node is decided once; pass the same `seen` set to share that across entries.
     """
-    if not node:
-        return
-    if isinstance(node, TraceLike):
-        node.is_suboptimal_cause = None
-        jump_weight = node.jump.jump_to_edge.weight
+    if seen is None:
+        seen = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Edge):
+            node = node.node
+        if not isinstance(node, TraceLike) or id(node) in seen:
+            continue
+        seen.add(id(node))
+        node.dirty = False
+        decide_node_sub_optimality(node)
         for guard in node.labels_and_guards:
             if isinstance(guard, Guard) and guard.bridge is not None:
-                if guard.bridge.weight > jump_weight:
-                    node.is_suboptimal_cause = guard
-                decide_sub_optimality_for_single_entry(entry, guard.bridge.node)
-    elif isinstance(node, Edge):
-        decide_sub_optimality_for_single_entry(entry, node.node)
+                stack.append(guard.bridge.node)
 
 def decide_sub_optimality(entries: list[TraceLike]):
+    seen: set[int] = set()
     for entry in entries:
-        decide_sub_optimality_for_single_entry(entry, entry)
+        decide_sub_optimality_for_single_entry(entry, entry, seen)
+
+def mark_dirty(node: TraceLike, dirty: list[TraceLike] | None):
+    node.dirty = True
+    if dirty is not None:
+        dirty.append(node)
+
+def redecide_sub_optimality(dirty: list[TraceLike]):
+    """
+    Re-decides only the nodes a reorder rewrote, instead of clearing and deciding
+    the whole forest again.
+
+    A verdict only depends on the node's own guard and jump edges, and an
+    inversion keeps the weight of the edge into the rewritten node, so the
+    verdicts of untouched nodes (its ancestors included) cannot change.
+    """
+    for node in dirty:
+        if node.dirty:
+            node.dirty = False
+            decide_node_sub_optimality(node)
+    dirty.clear()
 
 def count_suboptimality(all_entries: list[Trace]):
     """
     Count number of suboptimal nodes.
+
+    Like compute_edges, a single BFS over the whole forest, so a node reachable
+    from several entries is only counted once.
     """
     count = 0
-    for entry in all_entries:
-        seen: set[int] = set()
+    seen: set[int] = set()
 
-        queue = [entry]
-        while queue:
-            nxt = queue.pop(0)
-            if id(nxt) in seen:
-                continue
-            seen.add(id(nxt))
-            if isinstance(nxt, Guard):
-                if nxt.bridge is not None:
-                    nxt.bridge.weight = nxt.bridge.node.enter_count
-                    queue.append(nxt.bridge.node)
-            elif isinstance(nxt, TraceLike):
-                if nxt.is_suboptimal_cause is not None:
-                    count += 1
-                nxt.jump.jump_to_edge.weight = nxt.jump.enter_count
-                queue.extend(nxt.labels_and_guards)
-                # Find the jump label in the labels and guards
-                # deduct the backedge weight to eventually find the initial entry for that label.
-                if isinstance(nxt.jump.jump_to_edge.node, Label):
-                    queue.append(nxt.jump.jump_to_edge.node)
-            elif isinstance(nxt, Label):
-                pass
-            elif isinstance(nxt, type(None)):
-                pass
-            else:
-                assert False, f"Unknown node type {nxt}"
+    queue = deque(all_entries)
+    while queue:
+        nxt = queue.popleft()
+        if id(nxt) in seen:
+            continue
+        seen.add(id(nxt))
+        if isinstance(nxt, Guard):
+            if nxt.bridge is not None:
+                nxt.bridge.weight = nxt.bridge.node.enter_count
+                queue.append(nxt.bridge.node)
+        elif isinstance(nxt, TraceLike):
+            if nxt.is_suboptimal_cause is not None:
+                count += 1
+            nxt.jump.jump_to_edge.weight = nxt.jump.enter_count
+            queue.extend(nxt.labels_and_guards)
+            # Find the jump label in the labels and guards
+            # deduct the backedge weight to eventually find the initial entry for that label.
+            if isinstance(nxt.jump.jump_to_edge.node, Label):
+                queue.append(nxt.jump.jump_to_edge.node)
+        elif isinstance(nxt, Label):
+            pass
+        elif isinstance(nxt, type(None)):
+            pass
+        else:
+            assert False, f"Unknown node type {nxt}"
     return count
 
 
-def clear_sub_optimality_for_single_entry(entry: TraceLike, node: TraceLike | None):
+@dataclass(slots=True)
+class HotPath:
+    # Executions that can have taken the whole path: its coldest edge.
+    count: int
+    traces: list[TraceLike]
+    # steps[i] leads from traces[i] to traces[i+1]: a guard with a bridge, or the
+    # jump of traces[i] to a label in traces[i+1].
+    steps: list["Guard | Jump"]
+    # Back to a label earlier on the path, or a finish.
+    jump: Jump
+
+    def __str__(self):
+        steps = [f"{type(self.traces[0]).__name__}<{self.traces[0].id}>"]
+        for step, trace in zip(self.steps, self.traces[1:]):
+            if isinstance(step, Guard):
+                steps.append(f"{step.op}({step.id}) {type(trace).__name__}<{trace.id}>")
+            else:
+                steps.append(f"jump Label<{step.jump_to_edge.node.id}> {type(trace).__name__}<{trace.id}>")
+        target = self.jump.jump_to_edge.node if self.jump.jump_to_edge is not None else None
+        steps.append(f"jump Label<{target.id}>" if isinstance(target, Label) else "finish")
+        return f"{self.count:>12}  " + " -> ".join(steps)
+
+
+def hottest_paths(entries: list[Trace], k: int) -> list[HotPath]:
     """
-    Decides if a trace is sub-optimal.
+    The k hottest paths from an entry, through guard bridges and jumps into
+    labels of other traces, until a jump back to a label already on the path (or
+    a finish), using the edge weights from compute_edges.
+
+    A path starts with the flow through its entry: its enter count, or the after
+    count of its label, as a loop is usually entered a few times and then
+    iterates through its label. A path can't be hotter than its coldest edge, and
+    extending a path never makes it hotter, so a best-first search on a priority
+    queue pops complete paths hottest first and stops after k of them, only
+    expanding the hot part of the forest.
+    """
+    import heapq
+    # Label -> (trace, index) it's in, to follow jumps into other traces.
+    label_owners: dict[int, tuple[TraceLike, int]] = {}
+    seen = set()
+    stack = list(entries)
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for idx, item in enumerate(node.labels_and_guards):
+            if isinstance(item, Label):
+                label_owners.setdefault(id(item), (node, idx))
+            elif isinstance(item, Guard) and item.bridge is not None:
+                stack.append(item.bridge.node)
+
+    # (-count, tiebreak, node, index to start at, ids of the labels passed, finished, (step, node, previous) chain)
+    queue = []
+    for idx, entry in enumerate(entries):
+        flow = max([entry.enter_count, 0] + [item.after_count for item in entry.labels_and_guards if isinstance(item, Label)])
+        queue.append((-flow, idx, entry, 0, frozenset(), False, (None, entry, None)))
+    heapq.heapify(queue)
+    tiebreak = len(queue)
+    res = []
+    while queue and len(res) < k:
+        neg_count, _, node, start, on_path, finished, chain = heapq.heappop(queue)
+        if finished:
+            traces, steps = [], []
+            while chain is not None:
+                step, trace, chain = chain
+                traces.append(trace)
+                if step is not None:
+                    steps.append(step)
+            res.append(HotPath(-neg_count, traces[::-1], steps[::-1], node.jump))
+            continue
+        count = -neg_count
+        for idx in range(start, len(node.labels_and_guards)):
+            item = node.labels_and_guards[idx]
+            if isinstance(item, Label):
+                on_path = on_path | {id(item)}
+            elif isinstance(item, Guard) and item.bridge is not None:
+                bridge = item.bridge.node
+                heapq.heappush(queue, (-min(count, item.bridge.weight), tiebreak, bridge, 0, on_path, False, (item, bridge, chain)))
+                tiebreak += 1
+        edge = node.jump.jump_to_edge
+        if edge is None:
+            continue
+        count = min(count, edge.weight)
+        if isinstance(edge.node, Label) and id(edge.node) not in on_path and id(edge.node) in label_owners:
+            trace, idx = label_owners[id(edge.node)]
+            heapq.heappush(queue, (-count, tiebreak, trace, idx, on_path, False, (node.jump, trace, chain)))
+        else:
+            heapq.heappush(queue, (-count, tiebreak, node, 0, on_path, True, chain))
+        tiebreak += 1
+    return res
 
-    The heuristic:
-    If the heaviest weighted edge of a trace is not the terminator but rather a bridge.
-    Then the trace is suboptimal.
 
-    
+def clear_sub_optimality_for_single_entry(entry: TraceLike, node: TraceLike | None, seen: set[int] | None = None):
     """
-    if not node:
-        return
-    if isinstance(node, TraceLike):
+    Clears the sub-optimality verdicts and costs of a trace and all of its bridges.
+
+    Same explicit-stack walk as decide_sub_optimality_for_single_entry.
+    """
+    if seen is None:
+        seen = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Edge):
+            node = node.node
+        if not isinstance(node, TraceLike) or id(node) in seen:
+            continue
+        seen.add(id(node))
         node.is_suboptimal_cause = None
-        jump_weight = node.jump.jump_to_edge.weight
+        node.suboptimality_cost = 0
         for guard in node.labels_and_guards:
             if isinstance(guard, Guard) and guard.bridge is not None:
-                clear_sub_optimality_for_single_entry(entry, guard.bridge.node)
-    elif isinstance(node, Edge):
-        clear_sub_optimality_for_single_entry(entry, node.node)
+                stack.append(guard.bridge.node)
 
 def clear_sub_optimality(entries: list[TraceLike]):
+    seen: set[int] = set()
     for entry in entries:
-        clear_sub_optimality_for_single_entry(entry, entry)
+        clear_sub_optimality_for_single_entry(entry, entry, seen)
 
-DID_REORDER = False
-
-def reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, edge: Edge, requires_invertible_guard: bool):
-    global DID_REORDER
-    if DID_REORDER:
+@dataclass(slots=True)
+class ReorderContext:
+    """
+    The state of a single reorder call, so several forests can be reordered
+    at the same time, or one forest over and over, in one process.
+    """
+    requires_invertible_guard: bool = False
+    # Nodes rewritten so far, for redecide_sub_optimality.
+    dirty: list[TraceLike] | None = None
+    # We stop after inverting a single guard.
+    did_reorder: bool = False
+
+def reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, edge: Edge, ctx: ReorderContext):
+    if ctx.did_reorder:
         return edge
     # Trivial (base) case: this is a single node,
     # it is trivially optimal.
@@ -424,18 +866,20 @@ def reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, edge: Edge, r
     
 
     node = replace(node)
+    # The copy's cause still points at the original guard.
+    mark_dirty(node, ctx.dirty)
     # Recurse in on the sub-traces to make them optimal first.
     res = []
     for guard in node.labels_and_guards:
         if isinstance(guard, Guard) and guard.bridge is not None:
             copy = replace(guard)
-            copy.bridge = reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, guard.bridge, requires_invertible_guard)
+            copy.bridge = reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, guard.bridge, ctx)
             res.append(copy)
         else:
             res.append(guard)
     node.labels_and_guards = res
 
-    if DID_REORDER:
+    if ctx.did_reorder:
         return Edge(node, weight=edge.weight)
 
 
@@ -459,7 +903,7 @@ def reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, edge: Edge, r
         assert isinstance(label_or_guard, Guard) or isinstance(label_or_guard, Label)
         if isinstance(label_or_guard, Guard) and label_or_guard.bridge is not None:
             if label_or_guard.bridge.weight > jump_hotness and label_or_guard.bridge.weight > worst_bridge_hotness:
-                if requires_invertible_guard and label_or_guard.invert_guard() is not None:
+                if ctx.requires_invertible_guard and label_or_guard.invert_guard() is not None:
                     # We can only swap if there are no already inverted guards AFTER this bridge.
                     # The reason is that we want to steadily decrease the number of suboptimal guards,
                     # not thrash around!                    
@@ -488,6 +932,7 @@ def reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, edge: Edge, r
         worst_guard.bridge.node.uuid,
         worst_guard.id,
         f"swapped of {worst_guard.bridge.node.info}",
+        header=None,
         labels_and_guards=after_bridge_labels_and_guards,
         jump=node.jump,
         enter_count=incoming_weight
@@ -513,11 +958,30 @@ def reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, edge: Edge, r
     worst_guard.bridge.node = new_bridge
     # print(incoming_weight, outgoing)
     worst_guard.bridge.weight =  incoming_weight
+    mark_dirty(better_node, ctx.dirty)
+    mark_dirty(new_bridge, ctx.dirty)
 
-    DID_REORDER = True
+    ctx.did_reorder = True
     return Edge(better_node, weight=edge.weight)
 
-def reorder_subtree_to_decrease_suboptimality_top_down(start_edge: Edge, requires_invertible_guard: bool) -> tuple[Edge, bool]:
+def find_worst_guard(node: TraceLike, requires_invertible_guard: bool) -> int:
+    """
+    Greedy choice (decrease suboptimality): the index of the guard with the hottest
+    bridge that is hotter than the jump, or -1 if there is none to invert.
+    """
+    split = -1
+    worst_bridge_hotness = -1
+    jump_hotness = node.jump.enter_count
+    for idx, label_or_guard in enumerate(node.labels_and_guards):
+        assert isinstance(label_or_guard, Guard) or isinstance(label_or_guard, Label)
+        if isinstance(label_or_guard, Guard) and label_or_guard.bridge is not None:
+            if label_or_guard.bridge.weight > jump_hotness and label_or_guard.bridge.weight > worst_bridge_hotness:
+                if requires_invertible_guard and label_or_guard.invert_guard() is not None:
+                    worst_bridge_hotness = label_or_guard.bridge.weight
+                    split = idx
+    return split
+
+def reorder_subtree_to_decrease_suboptimality_top_down(start_edge: Edge, ctx: ReorderContext) -> tuple[Edge, bool]:
     worklist = [start_edge] # bfs order
     seen = set()
     while worklist:
@@ -536,23 +1000,7 @@ def reorder_subtree_to_decrease_suboptimality_top_down(start_edge: Edge, require
         if not node.is_suboptimal_cause:
             continue
 
-        # Greedy choice (decrease suboptimality): Now try swapping with the bridge that is most suboptimal
-        # We just take the hottest bridge.
-        worst_guard = None
-        split = -1
-        worst_bridge_hotness = -1
-        incoming_weight = -1
-        jump_hotness = node.jump.enter_count
-        for idx, label_or_guard in enumerate(node.labels_and_guards):
-            assert isinstance(label_or_guard, Guard) or isinstance(label_or_guard, Label)
-            if isinstance(label_or_guard, Guard) and label_or_guard.bridge is not None:
-                if label_or_guard.bridge.weight > jump_hotness and label_or_guard.bridge.weight > worst_bridge_hotness:
-                    if requires_invertible_guard and label_or_guard.invert_guard() is not None:
-                        worst_bridge_hotness = label_or_guard.bridge.weight
-                        worst_guard = label_or_guard
-                        split = idx
-                        incoming_weight = label_or_guard.after_count
-
+        split = find_worst_guard(node, ctx.requires_invertible_guard)
         if split == -1:
             # Non-invertible. In theory, we could still invert them by swapping out the guards and their identities
             # the problem however is that the identities are dependent on pypy addresses, which make them near impossible
@@ -560,7 +1008,8 @@ def reorder_subtree_to_decrease_suboptimality_top_down(start_edge: Edge, require
             # Still, it's useful to know if "in theory" we could make these more optimal, as a higher-tier optimizing
             # compiler should still be able to make use of this information.
             continue
-        assert incoming_weight != -1
+        worst_guard = node.labels_and_guards[split]
+        incoming_weight = worst_guard.after_count
         before_bridge_labels_and_guards = node.labels_and_guards[:split]
         after_bridge_labels_and_guards = node.labels_and_guards[split+1:]
 
@@ -585,6 +1034,7 @@ def reorder_subtree_to_decrease_suboptimality_top_down(start_edge: Edge, require
         tmp = better_node.jump
         better_node.jump = replace(worst_guard.bridge.node.jump)
         worst_guard.bridge.node.jump = replace(tmp)
+        mark_dirty(worst_guard.bridge.node, ctx.dirty)
 
         # invert the guard op
         worst_guard.op = worst_guard.invert_guard()
@@ -598,27 +1048,36 @@ def reorder_subtree_to_decrease_suboptimality_top_down(start_edge: Edge, require
         worst_guard.bridge.node = new_bridge
         # print(incoming_weight, outgoing)
         worst_guard.bridge.weight =  incoming_weight
+        mark_dirty(better_node, ctx.dirty)
+        mark_dirty(new_bridge, ctx.dirty)
 
         # stop after inverting a single guard.
+        ctx.did_reorder = True
         return start_edge, True
     return start_edge, False
 
 
-def reorder_to_decrease_suboptimality_bottom_up(all_nodes, entries: list[Trace], requires_invertible_guard: bool=False):
+def reorder_to_decrease_suboptimality_bottom_up(all_nodes, entries: list[Trace], requires_invertible_guard: bool=False, dirty: list[TraceLike] | None = None):
     """
     Tries to swap the offending suboptimal bridge with the main trace to see if it makes things
     more optimal.
+
+    Every node rewritten or copied on the way is appended to `dirty`, for redecide_sub_optimality.
     """
-    return [reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, Edge(entry, entry.enter_count), requires_invertible_guard).node for entry in entries]
+    ctx = ReorderContext(requires_invertible_guard, dirty)
+    return [reorder_subtree_to_decrease_suboptimality_bottom_up(all_nodes, Edge(entry, entry.enter_count), ctx).node for entry in entries]
 
-def reorder_to_decrease_suboptimality_top_down(entries: list[Trace], requires_invertible_guard: bool=False):
+def reorder_to_decrease_suboptimality_top_down(entries: list[Trace], requires_invertible_guard: bool=False, dirty: list[TraceLike] | None = None):
     """
     Tries to swap the offending suboptimal bridge with the main trace to see if it makes things
     more optimal.
+
+    Every node rewritten on the way is appended to `dirty`, for redecide_sub_optimality.
     """
+    ctx = ReorderContext(requires_invertible_guard, dirty)
     res = []
     for idx, entry in enumerate(entries):
-        pair = reorder_subtree_to_decrease_suboptimality_top_down(Edge(entry, entry.enter_count), requires_invertible_guard)
+        pair = reorder_subtree_to_decrease_suboptimality_top_down(Edge(entry, entry.enter_count), ctx)
         res.append(pair[0].node)
         if pair[1]:
             res.extend(entries[idx+1:])
@@ -626,172 +1085,1318 @@ def reorder_to_decrease_suboptimality_top_down(entries: list[Trace], requires_in
     return res
 
 
-def parse_and_build_trace_trees(fp):
-    entries = []
-    all_bridges = []
-    all_labels = []
-    all_guards = []
-    all_peeled_headers = []
-    tracelike_uuid = 0
-    for line in fp:
-        peeled_loop_label_and_guard_idx = -1
-        peeled_loop_seen = 0
-        labels_and_guards = []
-        peeled_header = None
-        if line.startswith("# Loop"):
-            match = re.match(LOOP_RE, line)
-            jump = None
-            while END_LOOP_MARKER not in line:
-                line = next(fp)
-                if label_match := re.match(LABEL_RE, line.strip()):
-                    lab = Label(int(label_match.group(1)))
-                    all_labels.append(lab)
-                    labels_and_guards.append(lab)
-                if guard_match := re.match(GUARD_RE, line.strip()):
-                    guard = Guard(int(guard_match.group(2), base=16), guard_match.group(1))
-                    assert guard_match.group(1) is not None, guard_match
-                    labels_and_guards.append(guard)
-                    all_guards.append(guard)
-                if jump_match := re.match(JUMP_RE, line.strip()):
-                    jump = Jump(int(jump_match.group(1)))
-                if finish_match := re.match(FINISH_RE, line.strip()):
-                    jump = DoneWithThisFrame(match.group(1), 0, PlaceHolderEdge(None, 0))
-                # Saw a peeled loop. Reset everything, as loop peeling is done by
-                # the loop optimizer in pypy, not the trace recorder.Tthus, the trace
-                # recorder has no knowledge of this and we would inform the trace recorder
-                # wrongly if we were to feed the peeled loop preheader in.
-                # This does give up some inversion possibilities. However, the assumption
-                # is that most of the interesting guard failures are going to happen
-                # in the peeled loop, as that part is hotter than the preheader.
-                if "jit_debug('peeled loop')" in line:
-                    if peeled_loop_seen == 0:
-                        peeled_loop_label_and_guard_idx = len(labels_and_guards)
-                    peeled_loop_seen += 1
-
-            assert jump is not None, f"No jump at end of loop? {line}"
-            # Sometimes pypy gives negative IDs for fake traces.
-            if int(match.group(1)) >= 0:
-                # Peeled a loop.
-                if peeled_loop_seen >= 2:
-                    assert peeled_loop_label_and_guard_idx != -1
-                    peeled_header = PeeledHeader(labels_and_guards[:peeled_loop_label_and_guard_idx])
-                    labels_and_guards = labels_and_guards[peeled_loop_label_and_guard_idx:]
-                    all_peeled_headers.append(peeled_header)
-                entries.append(Trace(tracelike_uuid, int(match.group(1)), match.group(2), peeled_header, labels_and_guards, jump))
-            tracelike_uuid += 1
-        elif line.startswith("# bridge out of"):
-            match = re.match(BRIDGE_RE, line)       
-            while END_LOOP_MARKER not in line:
-                line = next(fp)
-                if label_match := re.match(LABEL_RE, line.strip()):
-                    lab = Label(int(label_match.group(1)))
-                    all_labels.append(lab)
-                    labels_and_guards.append(lab)
-                if guard_match := re.match(GUARD_RE, line.strip()):
-                    guard = Guard(int(guard_match.group(2), base=16), guard_match.group(1))
-                    assert guard_match.group(1) is not None, line
-                    labels_and_guards.append(guard)
-                    all_guards.append(guard)
-                if jump_match := re.match(JUMP_RE, line.strip()):
-                    jump = Jump(int(jump_match.group(1)))
-                if finish_match := re.match(FINISH_RE, line.strip()):
-                    jump = DoneWithThisFrame(match.group(1), 0, PlaceHolderEdge(None, 0))
-                if "jit_debug('peeled loop')" in line:
-                    if peeled_loop_seen == 0:
-                        peeled_loop_label_and_guard_idx = len(labels_and_guards)
-                    peeled_loop_seen += 1
-            assert jump is not None, f"No jump at end of bridge? {line}"
-            # Peeled a loop.
-            if peeled_loop_seen >= 2:
-                assert peeled_loop_label_and_guard_idx != -1
-                peeled_header = PeeledHeader(labels_and_guards[:peeled_loop_label_and_guard_idx])
-                labels_and_guards = labels_and_guards[peeled_loop_label_and_guard_idx:]            
-                all_peeled_headers.append(peeled_header)
-            all_bridges.append(Bridge(tracelike_uuid, int(match.group(1), base=16), match.group(2), peeled_header, labels_and_guards, jump))
-            tracelike_uuid += 1
-        elif "jit-backend-counts" in line:
-            line = next(fp)
-            while "jit-backend-counts" not in line:
-                if line.startswith("entry"):
-                    entry = re.match(ENTRY_COUNT_RE, line)
-                    if int(entry.group(1)) >= 0:
-                        add_entry_count(entries, int(entry.group(1)), int(entry.group(2)))
-                if int(entry.group(1)) >= 0:
-                    if line.startswith("bridge"):
-                        entry = re.match(BRIDGE_COUNT_RE, line)
-                        add_bridge_count(all_bridges, int(entry.group(1)), int(entry.group(2)))   
-                    elif line.startswith("TargetToken"):
-                        entry = re.match(LABEL_COUNT_RE, line)
-                        add_label_after_count(all_labels, int(entry.group(1)), int(entry.group(2))) 
-                    elif line.startswith("PriorToTargetToken"):
-                        entry = re.match(LABEL_PRIOR_COUNT_RE, line)
-                        add_label_before_count(all_labels, int(entry.group(1)), int(entry.group(2))) 
-                    elif line.startswith("ExitOfToken"):
-                        entry = re.match(JUMP_COUNT_RE, line)
-                        add_jump_count(entries + all_bridges, int(entry.group(1)), int(entry.group(3)))
-                    elif line.startswith("AfterGuardAt"):
-                        entry = re.match(AFTER_GUARD_RE, line)
-                        add_guard_after_count(all_guards, int(entry.group(1)), int(entry.group(2)))
-                    elif line.startswith("AfterExpectedInvertedGuardAt"):
-                        entry = re.match(AFTER_EXPECTED_INVERTED_GUARD_RE, line)
-                        add_guard_after_count(all_guards, int(entry.group(1)), int(entry.group(2)), expected_inversion=True)                        
-                line = next(fp)
+def inversion_candidates(entries: list[Trace], requires_invertible_guard: bool = True, breadth_first: bool = False):
+    """
+    Yields (path, split) for every suboptimal node that has a guard to invert, an
+    entry at a time, in depth-first order (or breadth-first, the order the
+    top-down reorderer tries them in). The path is the entry's index followed by
+    the index of each guard whose bridge leads to the node; split is the guard to
+    invert, as chosen by find_worst_guard.
+    """
+    for entry_idx, entry in enumerate(entries):
+        worklist = deque([((entry_idx,), entry)])
+        seen = set()
+        while worklist:
+            path, node = worklist.popleft() if breadth_first else worklist.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            if node.is_suboptimal_cause:
+                split = find_worst_guard(node, requires_invertible_guard)
+                if split != -1:
+                    yield path, split
+            bridges = [(path + (idx,), guard.bridge.node) for idx, guard in enumerate(node.labels_and_guards) if isinstance(guard, Guard) and guard.bridge is not None]
+            worklist.extend(bridges if breadth_first else reversed(bridges))
+
+def invert_guard_persistently(entries: list[Trace], path: tuple[int, ...], split: int) -> list[Trace]:
+    """
+    Returns a new forest where the guard at split of the node at path is inverted
+    the same way the top-down reorderer does it, without touching entries.
+
+    Only the nodes on the path get copied (O(depth) nodes), everything else is
+    shared between both forests. So neither may be mutated afterwards: no more
+    compute_edges or in-place reorders, explore further with this function.
+    The copied nodes get their verdicts decided here.
+    """
+    nodes = [entries[path[0]]]
+    for idx in path[1:]:
+        nodes.append(nodes[-1].labels_and_guards[idx].bridge.node)
+    node = nodes[-1]
+    worst_guard = node.labels_and_guards[split]
+    bridge = worst_guard.bridge.node
+    incoming_weight = worst_guard.after_count
+
+    # The rest of the trace becomes the new bridge, the old bridge the new trunk.
+    new_bridge = Bridge(
+        bridge.uuid,
+        worst_guard.id,
+        f"swapped of {bridge.info}",
+        header=None,
+        labels_and_guards=node.labels_and_guards[split+1:],
+        jump=node.jump,
+        enter_count=incoming_weight
+    )
+    inverted_guard = replace(worst_guard, op=worst_guard.invert_guard(), inverted=True, bridge=Edge(new_bridge, incoming_weight))
+    new_node = replace(node, labels_and_guards=node.labels_and_guards[:split] + [inverted_guard], jump=replace(bridge.jump), dirty=False)
+    decide_node_sub_optimality(new_bridge)
+    decide_node_sub_optimality(new_node)
+
+    # Copy the path back up to the entry.
+    for parent, idx in zip(reversed(nodes[:-1]), reversed(path[1:])):
+        guard = parent.labels_and_guards[idx]
+        labels_and_guards = list(parent.labels_and_guards)
+        labels_and_guards[idx] = replace(guard, bridge=Edge(new_node, guard.bridge.weight))
+        new_node = replace(parent, labels_and_guards=labels_and_guards, dirty=False)
+        decide_node_sub_optimality(new_node)
+    res = list(entries)
+    res[path[0]] = new_node
+    return res
+
+
+def subtree_suboptimality_cost(root: TraceLike, memo: dict[int, tuple[TraceLike, int]] | None = None) -> int:
+    """
+    Sum of the suboptimality_cost of root and every node under it.
+
+    memo maps id(node) to (node, cost) and may be shared between forests made
+    by invert_guard_persistently, as their nodes never change; scoring a new
+    forest then only visits the nodes it copied.
+    """
+    if memo is None:
+        memo = {}
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in memo:
+            continue
+        bridges = [guard.bridge.node for guard in node.labels_and_guards if isinstance(guard, Guard) and guard.bridge is not None]
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((bridge, False) for bridge in bridges if id(bridge) not in memo)
+            continue
+        memo[id(node)] = (node, node.suboptimality_cost + sum(memo[id(bridge)][1] for bridge in bridges))
+    return memo[id(root)][1]
+
+def suboptimality_report(entries: list[Trace]) -> dict:
+    """
+    The suboptimality costs of a forest, per entry and per suboptimal trace, as
+    something json.dump can write. The forest cost is the sum of the entry costs.
+    """
+    report_entries = []
+    for entry in entries:
+        traces = []
+        stack = [entry]
+        while stack:
+            node = stack.pop()
+            if node.is_suboptimal_cause is not None:
+                traces.append({
+                    "kind": type(node).__name__,
+                    "uuid": node.uuid,
+                    "id": node.id,
+                    "cost": node.suboptimality_cost,
+                    "cause": node.is_suboptimal_cause.id,
+                })
+            for guard in node.labels_and_guards:
+                if isinstance(guard, Guard) and guard.bridge is not None:
+                    stack.append(guard.bridge.node)
+        report_entries.append({
+            "uuid": entry.uuid,
+            "id": entry.id,
+            "cost": sum(trace["cost"] for trace in traces),
+            "suboptimal": len(traces),
+            "traces": traces,
+        })
+    return {
+        "cost": sum(entry["cost"] for entry in report_entries),
+        "suboptimal": sum(entry["suboptimal"] for entry in report_entries),
+        "entries": report_entries,
+    }
+
+@dataclass(slots=True)
+class InversionCandidate:
+    # Lower is better, see subtree_suboptimality_cost.
+    cost: int
+    entries: list[Trace]
+    # (path, split) of every inversion applied, in order.
+    inversions: tuple
+
+def beam_search_inversions(entries: list[Trace], beam_width: int = 8, depth: int = 3, top_k: int = 4,
+                           requires_invertible_guard: bool = True) -> list[InversionCandidate]:
+    """
+    Instead of greedily inverting one guard at a time, tries every candidate
+    inversion (see inversion_candidates) of every forest in the beam, keeps the
+    beam_width forests with the lowest suboptimality cost and repeats that up
+    to depth times. Returns the top_k forests seen, best first, without
+    duplicate shapes. entries itself is ranked too, ahead of the forests that
+    cost as much, so the first one is never worse than it.
+
+    Expects compute_edges and the verdicts to be done, and entries not to be
+    mutated afterwards: the forests share their nodes with it.
+    """
+    import heapq
+    memo: dict[int, tuple[TraceLike, int]] = {}
+
+    def expand(candidate: InversionCandidate):
+        for path, split in inversion_candidates(candidate.entries, requires_invertible_guard):
+            forest = invert_guard_persistently(candidate.entries, path, split)
+            root = path[0]
+            cost = candidate.cost - subtree_suboptimality_cost(candidate.entries[root], memo) + subtree_suboptimality_cost(forest[root], memo)
+            yield InversionCandidate(cost, forest, candidate.inversions + ((path, split),))
+
+    start = InversionCandidate(sum(subtree_suboptimality_cost(entry, memo) for entry in entries), entries, ())
+    beam = [start]
+    seen = [start]
+    for _ in range(depth):
+        beam = heapq.nsmallest(beam_width, (new for candidate in beam for new in expand(candidate)), key=lambda c: c.cost)
+        if not beam:
+            break
+        seen.extend(beam)
+
+    res = []
+    shapes = set()
+    # The forests share most of their nodes, so their digests mostly come from the memo.
+    digests: dict[int, tuple[TraceLike, bytes]] = {}
+    for candidate in sorted(seen, key=lambda c: (c.cost, len(c.inversions))):
+        shape, _ = shape_digests(candidate.entries, digests)
+        if shape in shapes:
+            continue
+        shapes.add(shape)
+        res.append(candidate)
+        if len(res) == top_k:
+            break
+    return res
+
+def reorder_to_fixpoint(entries: list[Trace], max_inversions: int | None = None, time_budget: float | None = None,
+                        requires_invertible_guard: bool = True, report=None,
+                        only_improvements: bool = False) -> tuple[list[Trace], list[int]]:
+    """
+    Keeps inverting guards with the top-down reorderer until the number of
+    suboptimal nodes stops decreasing, no guard can be inverted any more, or the
+    budget runs out: at most max_inversions inversions and time_budget seconds
+    (either unlimited if None). The forest is rewritten in place, and the last
+    inversion stays in it even if it didn't lower the count.
+
+    With only_improvements, every inversion is tried on a new forest instead (see
+    invert_guard_persistently) and only kept if it lowered the count. entries is
+    then left alone, and shares nodes with the forest returned.
+
+    Expects verdicts to be decided already. Returns the new entries and the
+    suboptimality count before the first and after every kept step; report, if
+    given, is called with (step, count) for every step tried, as they come.
+    """
+    import time
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    counts = [count_suboptimality(entries)]
+    if report is not None:
+        report(0, counts[0])
+    dirty = []
+    while max_inversions is None or len(counts) <= max_inversions:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        if only_improvements:
+            candidate = next(inversion_candidates(entries, requires_invertible_guard, breadth_first=True), None)
+            if candidate is None:
+                # Nothing left to invert.
+                break
+            forest = invert_guard_persistently(entries, *candidate)
+            count = count_suboptimality(forest)
+            if report is not None:
+                report(len(counts), count)
+            if count >= counts[-1]:
+                break
+            entries = forest
+            counts.append(count)
+            continue
+        entries = reorder_to_decrease_suboptimality_top_down(entries, requires_invertible_guard, dirty)
+        if not dirty:
+            # Nothing left to invert.
+            break
+        redecide_sub_optimality(dirty)
+        counts.append(count_suboptimality(entries))
+        if report is not None:
+            report(len(counts) - 1, counts[-1])
+        if counts[-1] >= counts[-2]:
+            break
+    return entries, counts
+
+
+def parse_loop_section(header_line: str, fp, tracelike_uuid: int) -> Trace | None:
+    """
+    None if fp ends before the end of the loop.
+    """
+    match = re.match(LOOP_RE, header_line)
+    peeled_header, labels_and_guards, jump, line = parse_trace_body(fp, match.group(1))
+    if END_LOOP_MARKER not in line:
+        return None
+    assert jump is not None, f"No jump at end of loop? {line}"
+    return Trace(tracelike_uuid, int(match.group(1)), match.group(2), peeled_header, labels_and_guards, jump)
+
+
+def parse_bridge_section(header_line: str, fp, tracelike_uuid: int) -> Bridge | None:
+    """
+    None if fp ends before the end of the bridge.
+    """
+    match = re.match(BRIDGE_RE, header_line)
+    peeled_header, labels_and_guards, jump, line = parse_trace_body(fp, match.group(1))
+    if END_LOOP_MARKER not in line:
+        return None
+    assert jump is not None, f"No jump at end of bridge? {line}"
+    return Bridge(tracelike_uuid, int(match.group(1), base=16), match.group(2), peeled_header, labels_and_guards, jump)
+
+
+def apply_counts_section(symbols: SymbolTable, fp):
+    """
+    Reads a jit-backend-counts block (the opening marker line has already been
+    consumed) and applies the counts to everything parsed so far.
+    """
+    line = next(fp)
+    while "jit-backend-counts" not in line:
+        if line.startswith("entry"):
+            entry = re.match(ENTRY_COUNT_RE, line)
+            if int(entry.group(1)) >= 0:
+                add_entry_count(symbols, int(entry.group(1)), int(entry.group(2)))
+        if int(entry.group(1)) >= 0:
+            if line.startswith("bridge"):
+                entry = re.match(BRIDGE_COUNT_RE, line)
+                add_bridge_count(symbols, int(entry.group(1)), int(entry.group(2)))   
+            elif line.startswith("TargetToken"):
+                entry = re.match(LABEL_COUNT_RE, line)
+                add_label_after_count(symbols, int(entry.group(1)), int(entry.group(2))) 
+            elif line.startswith("PriorToTargetToken"):
+                entry = re.match(LABEL_PRIOR_COUNT_RE, line)
+                add_label_before_count(symbols, int(entry.group(1)), int(entry.group(2))) 
+            elif line.startswith("ExitOfToken"):
+                entry = re.match(JUMP_COUNT_RE, line)
+                add_jump_count(symbols, int(entry.group(1)), int(entry.group(3)))
+            elif line.startswith("AfterGuardAt"):
+                entry = re.match(AFTER_GUARD_RE, line)
+                add_guard_after_count(symbols, int(entry.group(1)), int(entry.group(2)))
+            elif line.startswith("AfterExpectedInvertedGuardAt"):
+                entry = re.match(AFTER_EXPECTED_INVERTED_GUARD_RE, line)
+                add_guard_after_count(symbols, int(entry.group(1)), int(entry.group(2)), expected_inversion=True)                        
+        line = next(fp)
+
+
+def link_trace_trees(symbols: SymbolTable, allow_missing_labels: bool = False) -> tuple[list[Trace], list[Bridge]]:
     # Match labels to bridges.
-    for entry in entries + all_bridges:
+    for entry in symbols.entries + symbols.all_bridges:
         for guard in entry.labels_and_guards:
             if isinstance(guard, Guard):
-                if bridge := find_bridge(all_bridges, guard):
+                if bridge := find_bridge(symbols, guard):
                     guard.bridge = Edge(replace(bridge))
 
     # Match jumps to labels/traces
-    for loop in entries + all_bridges:
+    for loop in symbols.entries + symbols.all_bridges:
         jump = loop.jump
         # is a terminator
         if isinstance(jump, DoneWithThisFrame):        
             continue
-        target_trace = find_label_obj_via_label(entries + all_bridges + all_peeled_headers, jump.id)
+        target_trace = find_label_obj_via_label(symbols, jump.id, allow_missing_labels)
         # loop.jump = Jump(jump.id, Edge(replace(target_trace)))
         loop.jump.jump_to_edge = Edge(target_trace)
         assert loop.jump.jump_to_edge is not None
 
+    return symbols.entries, symbols.all_bridges
+
+
+def parse_and_build_trace_trees(fp, workers: int = 1, hot_threshold: int | None = None, hot_top_k: int | None = None):
+    """
+    Builds the trace forest from a PYPYLOG. Returns the entry traces and all bridges.
+
+    fp can be opened in text or in binary mode, see log_text.
+
+    With workers > 1, fp has to be a file on disk: the log is split at section
+    boundaries and parsed in that many processes. Same for hot_threshold/hot_top_k,
+    which only fully parse the hot loops and bridges and leave stubs for the rest.
+    See LogIndex.build_trace_trees.
+    """
+    if workers > 1 or hot_threshold is not None or hot_top_k is not None:
+        with LogIndex(fp.name) as index:
+            return index.build_trace_trees(workers, hot_threshold, hot_top_k)
+    forest = StreamingTraceForest()
+    with log_text(fp) as lines:
+        for _ in forest.consume(lines):
+            pass
+    return forest.trace_trees()
+
+
+def starts_log_section(line: str) -> bool:
+    # What iter_log_sections looks for.
+    return line.startswith("# Loop") or line.startswith("# bridge out of") or "jit-backend-counts" in line
+
+def iter_log_sections(fp, tracelike_uuid: int = 0):
+    """
+    Splits a log into its sections, in log order. Yields (SECTION_LOOP, Trace),
+    (SECTION_BRIDGE, Bridge) or (SECTION_COUNTS, lines of the jit-backend-counts
+    block after its opening marker, up to and including the closing one). The
+    traces aren't registered or linked anywhere.
+
+    If the log ends halfway through a section (it's still being written), that
+    section is dropped.
+    """
+    for line in fp:
+        if line.startswith("# Loop"):
+            if (trace := parse_loop_section(line, fp, tracelike_uuid)) is None:
+                return
+            yield SECTION_LOOP, trace
+            tracelike_uuid += 1
+        elif line.startswith("# bridge out of"):
+            if (bridge := parse_bridge_section(line, fp, tracelike_uuid)) is None:
+                return
+            yield SECTION_BRIDGE, bridge
+            tracelike_uuid += 1
+        elif "jit-backend-counts" in line:
+            lines = []
+            for line in fp:
+                lines.append(line)
+                if "jit-backend-counts" in line:
+                    break
+            else:
+                return
+            yield SECTION_COUNTS, lines
+
+
+class StreamingTraceForest:
+    """
+    Builds the forest a section at a time, from a log that may still be being
+    written (see follow_log_lines). Loops and bridges are added as soon as their
+    "--end of the loop--" marker arrives, counts as soon as the jit-backend-counts
+    block is complete.
+    """
+    def __init__(self):
+        self.symbols = SymbolTable()
+        self.tracelike_uuid = 0
+        self.counts_blocks_seen = 0
+        # Lines of the section the last consume call ran out of log in.
+        self.unfinished: list[str] = []
+
+    def consume(self, fp):
+        """
+        Parses everything fp has to offer. Yields each new Trace or Bridge as soon
+        as it's been added, and None after each jit-backend-counts block.
+
+        If fp ends halfway through a section, the next call picks it up from
+        where this one stopped, so the log can be fed in pieces.
+        """
+        for kind, section in iter_log_sections(self.recording(fp), self.tracelike_uuid):
+            self.unfinished = []
+            if kind == SECTION_COUNTS:
+                apply_counts_section(self.symbols, iter(section))
+                self.counts_blocks_seen += 1
+                yield None
+                continue
+            self.tracelike_uuid = section.uuid + 1
+            if kind == SECTION_BRIDGE:
+                self.symbols.add_bridge(section)
+                yield section
+            # Sometimes pypy gives negative IDs for fake traces.
+            elif section.id >= 0:
+                self.symbols.add_entry(section)
+                yield section
+
+    def recording(self, fp):
+        """
+        The unfinished lines, then fp, keeping every line from the start of a
+        section on in self.unfinished until consume clears it.
+        """
+        unfinished, self.unfinished = self.unfinished, []
+        for lines in (unfinished, fp):
+            for line in lines:
+                if self.unfinished or starts_log_section(line):
+                    self.unfinished.append(line)
+                yield line
+
+    def trace_trees(self, complete: bool = True) -> tuple[list[Trace], list[Bridge]]:
+        """
+        Links what has been parsed so far. Can be called again after consuming more
+        of the log, every call relinks from scratch. Pass complete=False for a
+        snapshot while the log is still being written: jumps to labels that haven't
+        arrived yet then point at stand-in labels instead of failing.
+        """
+        return link_trace_trees(self.symbols, allow_missing_labels=not complete)
+
+
+def follow_log_lines(fp, poll_interval: float = 0.1, idle_timeout: float | None = None):
+    """
+    Yields the complete lines of a log that is still being written, like tail -f.
+
+    For a FIFO this ends when the writer closes it. For a regular file, reaching
+    the end just means PyPy hasn't written more yet, so we keep polling; it ends
+    once nothing has been written for idle_timeout seconds (never, if None), and
+    a last line without a newline is dropped, PyPy may be halfway through it.
+    """
+    import stat
+    import time
+    is_fifo = stat.S_ISFIFO(os.fstat(fp.fileno()).st_mode)
+    partial = ""
+    idle_since = time.monotonic()
+    while True:
+        line = fp.readline()
+        if line:
+            idle_since = time.monotonic()
+            # PyPy might be halfway through writing this one.
+            if not line.endswith("\n"):
+                partial += line
+                continue
+            yield partial + line
+            partial = ""
+            continue
+        if is_fifo:
+            # The writer is done, so the last line is complete without a newline too.
+            if partial:
+                yield partial
+            break
+        if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+            break
+        time.sleep(poll_interval)
+
+
+# Magic bytes -> module that decompresses it.
+COMPRESSED_LOG_MAGICS = {
+    b"\x1f\x8b": "gzip",
+    b"\xfd7zXZ\x00": "lzma",
+    b"BZh": "bz2",
+}
+COMPRESSED_LOG_HEAD_SIZE = max(len(magic) for magic in COMPRESSED_LOG_MAGICS)
+DECOMPRESS_CHUNK_SIZE = 1 << 20
+DECOMPRESS_QUEUE_CHUNKS = 16
+
+
+def log_compression(path) -> str | None:
+    """
+    Name of the stdlib module that can decompress the log at path, or None if it's
+    plain text.
+    """
+    with open(path, "rb") as fp:
+        return head_compression(fp.read(COMPRESSED_LOG_HEAD_SIZE))
+
+
+def head_compression(head: bytes) -> str | None:
+    for magic, module in COMPRESSED_LOG_MAGICS.items():
+        if head.startswith(magic):
+            return module
+    return None
+
+
+@contextmanager
+def log_text(fp):
+    """
+    The lines of the PYPYLOG in fp as text. A file opened in text mode is used as
+    it is. One opened in binary mode is decompressed if it starts with one of
+    COMPRESSED_LOG_MAGICS and decoded otherwise, from where it is now; either
+    way fp stays open.
+    """
+    if not isinstance(fp, (io.RawIOBase, io.BufferedIOBase)):
+        yield fp
+        return
+    if fp.seekable():
+        pos = fp.tell()
+        head = fp.read(COMPRESSED_LOG_HEAD_SIZE)
+        fp.seek(pos)
+    else:
+        # A pipe, but then it's buffered.
+        head = fp.peek(COMPRESSED_LOG_HEAD_SIZE)[:COMPRESSED_LOG_HEAD_SIZE]
+    if (compression := head_compression(head)) is not None:
+        with DecompressedLogReader(fp, compression) as lines:
+            yield lines
+        return
+    lines = io.TextIOWrapper(fp)
+    try:
+        yield lines
+    finally:
+        lines.detach()
+
+
+class DecompressedLogReader:
+    """
+    Iterates over the lines of a compressed log. A background thread decompresses
+    it in big chunks into a bounded queue, so decompression (which releases the
+    GIL) overlaps with parsing, and at most DECOMPRESS_QUEUE_CHUNKS chunks are
+    ever held in memory.
+
+    path can also be a file opened in binary mode, which close() leaves open.
+    """
+    def __init__(self, path, compression: str):
+        import importlib
+        import queue
+        import threading
+        self.name = getattr(path, "name", path)
+        self._compressed = importlib.import_module(compression).open(path, "rb")
+        self._chunks = queue.Queue(maxsize=DECOMPRESS_QUEUE_CHUNKS)
+        self._stop = threading.Event()
+        self._lines = iter(())
+        self._partial = b""
+        self._done = False
+        self._thread = threading.Thread(target=self._decompress, daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        import queue
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self):
+        # read() would drop what it decompressed if the stream turns out truncated,
+        # read1() returns it first, so queue it and only then the error.
+        chunk = bytearray()
+        try:
+            while data := self._compressed.read1(DECOMPRESS_CHUNK_SIZE):
+                chunk += data
+                if len(chunk) >= DECOMPRESS_CHUNK_SIZE:
+                    if not self._put(bytes(chunk)):
+                        return
+                    chunk.clear()
+            if chunk and not self._put(bytes(chunk)):
+                return
+            self._put(None)
+        except Exception as e:
+            if chunk and not self._put(bytes(chunk)):
+                return
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        while True:
+            line = next(self._lines, None)
+            if line is not None:
+                return line
+            if self._done:
+                raise StopIteration
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception):
+                # The thread is gone, nothing else will ever be queued.
+                self._done = True
+                raise chunk
+            if chunk is None:
+                self._done = True
+                chunk = self._partial
+            else:
+                chunk = self._partial + chunk
+            # Only decode whole lines, so a multi-byte character is never cut in two.
+            cut = len(chunk) if self._done else chunk.rfind(b"\n") + 1
+            self._partial = chunk[cut:]
+            # Same newline handling as open() in text mode.
+            self._lines = iter(io.StringIO(chunk[:cut].decode(), newline=None))
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._compressed.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_log(path):
+    """
+    Opens a PYPYLOG for parse_and_build_trace_trees, transparently decompressing
+    gzip, xz and bz2 logs (detected from their magic bytes, not the file name).
+    """
+    compression = log_compression(path)
+    if compression is None:
+        return open(path)
+    return DecompressedLogReader(path, compression)
+
+
+SECTION_LOOP = 1
+SECTION_BRIDGE = 2
+SECTION_COUNTS = 3
+
+SECTION_START_RE = re.compile(b"^# Loop|^# bridge out of|jit-backend-counts", re.MULTILINE)
+SECTION_ENTER_COUNT_RE = re.compile(b"^(entry|bridge) (-?\d+):(\d+)", re.MULTILINE)
+SECTION_JUMP_COUNT_RE = re.compile(b"^ExitOfToken\((-?\d+):\d+\):(\d+)", re.MULTILINE)
+SECTION_LABEL_COUNT_RE = re.compile(b"^TargetToken\((\d+)\):(\d+)", re.MULTILINE)
+SECTION_LABEL_RE = re.compile(b" label\(.*descr=TargetToken\((\d+)\)\)")
+SECTION_GUARD_RE = re.compile(b"descr=<Guard(0x\w+)>")
+
+
+@dataclass(slots=True)
+class LogSection:
+    kind: int
+    # Loop id for SECTION_LOOP, id of the guard it comes out of for SECTION_BRIDGE.
+    # Unused for SECTION_COUNTS.
+    key: int
+    # The tracelike_uuid parse_and_build_trace_trees would give it.
+    uuid: int
+    # Byte offsets of the header line and just past the closing line.
+    start: int
+    end: int
+
+
+PARALLEL_CHUNKS_PER_WORKER = 4
+
+
+def log_section_lines(mm, section: LogSection) -> list[str]:
+    # Not str.splitlines: that also splits on \x0c, \x1c-\x1e, \x85, \u2028 and
+    # \u2029, which may show up in the ops, while a file object only splits on \n.
+    return list(io.StringIO(mm[section.start:section.end].decode()))
+
+
+def parse_log_section(mm, section: LogSection) -> Trace | Bridge:
+    lines = log_section_lines(mm, section)
+    if section.kind == SECTION_LOOP:
+        return parse_loop_section(lines[0], iter(lines[1:]), section.uuid)
+    assert section.kind == SECTION_BRIDGE
+    return parse_bridge_section(lines[0], iter(lines[1:]), section.uuid)
+
+
+def cold_stub(mm, section: LogSection) -> Trace | Bridge:
+    """
+    Stand-in for a loop or bridge that was too cold to be worth parsing. Only the
+    header line is decoded: the stub has the right ids, uuid and info, so counts and
+    bridges still attach to it, but no labels or guards, and it ends in a
+    DoneWithThisFrame.
+    """
+    header_line = mm[section.start:mm.find(b"\n", section.start)].decode()
+    if section.kind == SECTION_LOOP:
+        match = re.match(LOOP_RE, header_line)
+        return Trace(section.uuid, section.key, match.group(2), None, [], DoneWithThisFrame(match.group(1), 0, PlaceHolderEdge(None, 0)))
+    assert section.kind == SECTION_BRIDGE
+    match = re.match(BRIDGE_RE, header_line)
+    return Bridge(section.uuid, section.key, match.group(2), None, [], DoneWithThisFrame(match.group(1), 0, PlaceHolderEdge(None, 0)))
+
+
+def _parse_log_sections_from_path(path, sections: list[LogSection]) -> list[Trace | Bridge]:
+    # Runs in a worker process, which maps the log itself rather than being sent the bytes.
+    with open(path, "rb") as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return [parse_log_section(mm, section) for section in sections]
+
+
+class LogIndex:
+    """
+    Memory-maps a PYPYLOG and indexes the byte offsets of every "# Loop",
+    "# bridge out of" and jit-backend-counts block in a single pass.
+
+    Nothing is decoded up front: sections are only turned into text (and into
+    Trace/Bridge objects) when asked for, so single traces can be looked up
+    without reading the whole log, and only the pages that are actually
+    touched get paged in.
+    """
+    def __init__(self, path):
+        if (compression := log_compression(path)) is not None:
+            raise ValueError(f"{path} is compressed ({compression}), it can't be memory-mapped")
+        self.path = path
+        self._file = open(path, "rb")
+        self.mm = None
+        self.sections: list[LogSection] = []
+        self.loops_by_id: dict[int, LogSection] = {}
+        self.bridges_by_guard_id: dict[int, LogSection] = {}
+        # mmap refuses to map empty files.
+        if os.fstat(self._file.fileno()).st_size == 0:
+            return
+        self.mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._build()
+
+    def _line_end(self, pos: int) -> int:
+        end = self.mm.find(b"\n", pos)
+        return len(self.mm) if end == -1 else end + 1
+
+    def _build(self):
+        mm = self.mm
+        tracelike_uuid = 0
+        pos = 0
+        while match := SECTION_START_RE.search(mm, pos):
+            start = mm.rfind(b"\n", 0, match.start()) + 1
+            header_end = self._line_end(match.start())
+            if match.group() == b"jit-backend-counts":
+                close = mm.find(b"jit-backend-counts", header_end)
+                assert close != -1, f"Unterminated jit-backend-counts block at {start}"
+                section = LogSection(SECTION_COUNTS, -1, -1, start, self._line_end(close))
+            else:
+                close = mm.find(END_LOOP_MARKER.encode(), header_end)
+                assert close != -1, f"No end of the loop for section at {start}"
+                header_line = mm[start:header_end].decode()
+                if match.group() == b"# Loop":
+                    section = LogSection(SECTION_LOOP, int(re.match(LOOP_RE, header_line).group(1)), tracelike_uuid, start, self._line_end(close))
+                    self.loops_by_id.setdefault(section.key, section)
+                else:
+                    section = LogSection(SECTION_BRIDGE, int(re.match(BRIDGE_RE, header_line).group(1), base=16), tracelike_uuid, start, self._line_end(close))
+                    self.bridges_by_guard_id.setdefault(section.key, section)
+                tracelike_uuid += 1
+            self.sections.append(section)
+            pos = section.end
+
+    def section_lines(self, section: LogSection) -> list[str]:
+        return log_section_lines(self.mm, section)
+
+    def parse_section(self, section: LogSection) -> Trace | Bridge:
+        """
+        Decodes and parses a single loop or bridge. The result is not linked to
+        anything: guards have no bridges and jumps have no edges yet.
+        """
+        return parse_log_section(self.mm, section)
+
+    def loop(self, loop_id: int) -> Trace | None:
+        section = self.loops_by_id.get(loop_id)
+        return None if section is None else self.parse_section(section)
+
+    def bridge(self, guard_id: int) -> Bridge | None:
+        section = self.bridges_by_guard_id.get(guard_id)
+        return None if section is None else self.parse_section(section)
+
+    def enter_counts(self) -> dict[tuple[int, int], int]:
+        """
+        Enter counts of loops and bridges, keyed by (section kind, section key),
+        read straight out of the jit-backend-counts blocks without parsing any
+        trace. These usually sit at the very end of the log.
+        """
+        res = {}
+        for section in self.sections:
+            if section.kind != SECTION_COUNTS:
+                continue
+            for match in SECTION_ENTER_COUNT_RE.finditer(self.mm, section.start, section.end):
+                count = int(match.group(3))
+                # Same as add_entry_count/add_bridge_count: zero counts are ignored.
+                if count == 0:
+                    continue
+                kind = SECTION_LOOP if match.group(1) == b"entry" else SECTION_BRIDGE
+                res[kind, int(match.group(2))] = count
+        return res
+
+    def flow_counts(self) -> dict[tuple[int, int], int]:
+        """
+        How often each loop and bridge ran, keyed like enter_counts: the highest of
+        its enter count, its jump count and the after counts of its labels. A loop
+        is typically entered a handful of times and then iterates millions of times
+        through its label, so its enter count alone says nothing.
+
+        Only the label lines of each section are searched, nothing is parsed.
+        """
+        enter_counts = self.enter_counts()
+        jump_counts, label_counts = {}, {}
+        for section in self.sections:
+            if section.kind != SECTION_COUNTS:
+                continue
+            for match in SECTION_JUMP_COUNT_RE.finditer(self.mm, section.start, section.end):
+                jump_counts[int(match.group(1))] = max(jump_counts.get(int(match.group(1)), 0), int(match.group(2)))
+            for match in SECTION_LABEL_COUNT_RE.finditer(self.mm, section.start, section.end):
+                label_counts[int(match.group(1))] = int(match.group(2))
+        res = {}
+        for section in self.sections:
+            if section.kind == SECTION_COUNTS:
+                continue
+            flow = enter_counts.get((section.kind, section.key), -1)
+            # Same lookup as add_jump_count: loop ids win over guard ids.
+            if section.kind == SECTION_LOOP or section.key not in self.loops_by_id:
+                flow = max(flow, jump_counts.get(section.key, -1))
+            for match in SECTION_LABEL_RE.finditer(self.mm, section.start, section.end):
+                flow = max(flow, label_counts.get(int(match.group(1)), -1))
+            res[section.kind, section.key] = max(flow, res.get((section.kind, section.key), -1))
+        return res
+
+    def guard_owners(self) -> dict[int, LogSection]:
+        """
+        Guard id -> the loop or bridge the guard is in (the first one, like
+        SymbolTable), from the guard descrs in each section.
+        """
+        res = {}
+        for section in self.sections:
+            if section.kind == SECTION_COUNTS:
+                continue
+            for match in SECTION_GUARD_RE.finditer(self.mm, section.start, section.end):
+                res.setdefault(int(match.group(1), base=16), section)
+        return res
+
+    def hot_sections(self, hot_threshold: int | None = None, hot_top_k: int | None = None) -> list[LogSection]:
+        """
+        Loops and bridges that ran at least hot_threshold times, plus the hot_top_k
+        hottest ones (see flow_counts), plus every loop and bridge a hot bridge
+        hangs off, up to its loop. With neither given, everything is hot.
+        """
+        trace_sections = [section for section in self.sections if section.kind != SECTION_COUNTS]
+        if hot_threshold is None and hot_top_k is None:
+            return trace_sections
+        counts = self.flow_counts()
+        def flow_count(section: LogSection) -> int:
+            return counts.get((section.kind, section.key), -1)
+        hot = set()
+        if hot_threshold is not None:
+            hot.update(section.uuid for section in trace_sections if flow_count(section) >= hot_threshold)
+        if hot_top_k is not None:
+            by_hotness = sorted(trace_sections, key=lambda section: (-flow_count(section), section.uuid))
+            hot.update(section.uuid for section in by_hotness[:hot_top_k])
+        # A bridge is only linked in through the guard it comes out of, which a
+        # cold stub doesn't have.
+        owners = self.guard_owners()
+        worklist = [section for section in trace_sections if section.uuid in hot]
+        while worklist:
+            section = worklist.pop()
+            if section.kind != SECTION_BRIDGE:
+                continue
+            parent = owners.get(section.key)
+            if parent is not None and parent.uuid not in hot:
+                hot.add(parent.uuid)
+                worklist.append(parent)
+        return [section for section in trace_sections if section.uuid in hot]
+
+    def build_trace_trees(self, workers: int = 1, hot_threshold: int | None = None, hot_top_k: int | None = None) -> tuple[list[Trace], list[Bridge]]:
+        """
+        Same result as parse_and_build_trace_trees, decoding one section at a time.
+
+        With workers > 1 the loops and bridges are parsed in that many processes,
+        then registered in log order so uuids and the order of entries/all_bridges
+        are the same as a sequential parse. Counts are always applied here, after
+        the merge.
+
+        With hot_threshold and/or hot_top_k, the counts are read first and only the
+        hot loops and bridges (see hot_sections) are parsed; the rest become cold
+        stubs. Verdicts for hot traces don't change, as they only depend on their
+        own guards and jump, and the enter counts of the bridges hanging off them;
+        the traces a hot bridge hangs off are parsed too, so it stays linked in.
+        """
+        hot = self.hot_sections(hot_threshold, hot_top_k)
+        if workers > 1:
+            parsed = iter(self._parse_sections_in_parallel(hot, workers))
+        else:
+            parsed = (self.parse_section(section) for section in hot)
+        hot_uuids = {section.uuid for section in hot}
+        symbols = SymbolTable(partial=hot_threshold is not None or hot_top_k is not None)
+        for section in self.sections:
+            if section.kind == SECTION_COUNTS:
+                apply_counts_section(symbols, iter(self.section_lines(section)[1:]))
+                continue
+            if section.uuid in hot_uuids:
+                trace = next(parsed)
+            else:
+                trace = cold_stub(self.mm, section)
+            if section.kind == SECTION_BRIDGE:
+                symbols.add_bridge(trace)
+            # Sometimes pypy gives negative IDs for fake traces.
+            elif trace.id >= 0:
+                symbols.add_entry(trace)
+        return link_trace_trees(symbols)
+
+    def _parse_sections_in_parallel(self, trace_sections: list[LogSection], workers: int) -> list[Trace | Bridge]:
+        from concurrent.futures import ProcessPoolExecutor
+        if not trace_sections:
+            return []
+        # A few chunks per worker, cut by bytes rather than by section count, so one
+        # worker stuck with the huge loops doesn't hold up the rest.
+        chunk_bytes = max(1, sum(section.end - section.start for section in trace_sections) // (workers * PARALLEL_CHUNKS_PER_WORKER))
+        chunks = [[]]
+        size = 0
+        for section in trace_sections:
+            if size >= chunk_bytes:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(section)
+            size += section.end - section.start
+        res = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map() hands results back in submission order, which is log order.
+            for traces in executor.map(_parse_log_sections_from_path, [self.path] * len(chunks), chunks):
+                res.extend(traces)
+        return res
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+FOREST_CACHE_MAGIC = b"TRACEFOREST"
+FOREST_CACHE_VERSION = 2
+FOREST_CACHE_SUFFIX = ".forest"
+LOG_HASH_BLOCK_SIZE = 1 << 20
+
+# Row tags of a flattened forest. Every object gets one row in a table and refers
+# to others by row number (-1 for None), so sharing between nodes survives the
+# round trip and nothing needs to recurse. Rows look like:
+#   Trace/Bridge         (tag, uuid, id, info, header, labels_and_guards, jump, enter_count, is_suboptimal_cause, suboptimality_cost)
+#   Guard                (tag, id, op, bridge, inverted, expected_to_be_inverted, after_count)
+#   Label                (tag, id, before_count, after_count)
+#   PeeledHeader         (tag, labels_and_guards)
+#   Jump/DoneWithThisFrame (tag, id, enter_count, jump_to_edge)
+#   Edge/PlaceHolderEdge (tag, node, weight)
+#   list                 (tag, [items])
+ROW_TRACE = 0
+ROW_BRIDGE = 1
+ROW_GUARD = 2
+ROW_LABEL = 3
+ROW_PEELED_HEADER = 4
+ROW_JUMP = 5
+ROW_DONE_WITH_THIS_FRAME = 6
+ROW_EDGE = 7
+ROW_PLACEHOLDER_EDGE = 8
+ROW_LIST = 9
+
+
+class StaleForestCache(Exception):
+    pass
+
+
+def flatten_forest(entries: list[Trace], all_bridges: list[Bridge]) -> tuple[list[int], list[int], list[tuple]]:
+    rows = []
+    row_of: dict[int, int] = {}
+    worklist = []
+
+    def ref(obj) -> int:
+        if obj is None:
+            return -1
+        row = row_of.get(id(obj))
+        if row is None:
+            row = row_of[id(obj)] = len(rows)
+            rows.append(None)
+            worklist.append((row, obj))
+        return row
+
+    entry_rows = [ref(entry) for entry in entries]
+    bridge_rows = [ref(bridge) for bridge in all_bridges]
+    while worklist:
+        row, obj = worklist.pop()
+        ty = type(obj)
+        if ty is Trace or ty is Bridge:
+            rows[row] = (ROW_TRACE if ty is Trace else ROW_BRIDGE, obj.uuid, obj.id, obj.info, ref(obj.header),
+                         ref(obj.labels_and_guards), ref(obj.jump), obj.enter_count, ref(obj.is_suboptimal_cause),
+                         obj.suboptimality_cost)
+        elif ty is Guard:
+            rows[row] = (ROW_GUARD, obj.id, obj.op, ref(obj.bridge), obj.inverted, obj.expected_to_be_inverted, obj.after_count)
+        elif ty is Label:
+            rows[row] = (ROW_LABEL, obj.id, obj.before_count, obj.after_count)
+        elif ty is PeeledHeader:
+            rows[row] = (ROW_PEELED_HEADER, ref(obj.labels_and_guards))
+        elif ty is Jump or ty is DoneWithThisFrame:
+            rows[row] = (ROW_JUMP if ty is Jump else ROW_DONE_WITH_THIS_FRAME, obj.id, obj.enter_count, ref(obj.jump_to_edge))
+        elif ty is Edge or ty is PlaceHolderEdge:
+            rows[row] = (ROW_EDGE if ty is Edge else ROW_PLACEHOLDER_EDGE, ref(obj.node), obj.weight)
+        elif ty is list:
+            rows[row] = (ROW_LIST, [ref(item) for item in obj])
+        else:
+            assert False, f"Unknown node type {obj}"
+    return entry_rows, bridge_rows, rows
+
+
+def unflatten_forest(entry_rows: list[int], bridge_rows: list[int], rows: list[tuple]) -> tuple[list[Trace], list[Bridge]]:
+    classes = {
+        ROW_TRACE: Trace,
+        ROW_BRIDGE: Bridge,
+        ROW_GUARD: Guard,
+        ROW_LABEL: Label,
+        ROW_PEELED_HEADER: PeeledHeader,
+        ROW_JUMP: Jump,
+        ROW_DONE_WITH_THIS_FRAME: DoneWithThisFrame,
+        ROW_EDGE: Edge,
+        ROW_PLACEHOLDER_EDGE: PlaceHolderEdge,
+    }
+    # Allocate everything first so rows can point forwards, then fill in the fields.
+    objs = [[] if row[0] == ROW_LIST else classes[row[0]].__new__(classes[row[0]]) for row in rows]
+
+    def deref(row: int):
+        return None if row == -1 else objs[row]
+
+    for obj, row in zip(objs, rows):
+        tag = row[0]
+        if tag == ROW_TRACE or tag == ROW_BRIDGE:
+            _, obj.uuid, obj.id, obj.info, header, labels_and_guards, jump, obj.enter_count, cause, obj.suboptimality_cost = row
+            # Only meaningful while a reorder is running, see redecide_sub_optimality.
+            obj.dirty = False
+            obj.header = deref(header)
+            obj.labels_and_guards = deref(labels_and_guards)
+            obj.jump = deref(jump)
+            obj.is_suboptimal_cause = deref(cause)
+        elif tag == ROW_GUARD:
+            _, obj.id, obj.op, bridge, obj.inverted, obj.expected_to_be_inverted, obj.after_count = row
+            obj.bridge = deref(bridge)
+        elif tag == ROW_LABEL:
+            _, obj.id, obj.before_count, obj.after_count = row
+        elif tag == ROW_PEELED_HEADER:
+            obj.labels_and_guards = deref(row[1])
+        elif tag == ROW_JUMP or tag == ROW_DONE_WITH_THIS_FRAME:
+            _, obj.id, obj.enter_count, edge = row
+            obj.jump_to_edge = deref(edge)
+        elif tag == ROW_EDGE or tag == ROW_PLACEHOLDER_EDGE:
+            _, node, obj.weight = row
+            obj.node = deref(node)
+        elif tag == ROW_LIST:
+            obj.extend(objs[item] for item in row[1])
+        else:
+            assert False, f"Unknown row tag {tag}"
+    return [objs[row] for row in entry_rows], [objs[row] for row in bridge_rows]
+
+
+def log_cache_key(path) -> tuple[int, int, str]:
+    """
+    (size, mtime, content hash) of a log. A cached forest is only reused if all
+    three still match.
+    """
+    import hashlib
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fp:
+        while block := fp.read(LOG_HASH_BLOCK_SIZE):
+            digest.update(block)
+    return stat.st_size, stat.st_mtime_ns, digest.hexdigest()
+
+
+def forest_cache_path(cache_dir, key: tuple) -> str:
+    # Hot-only forests of the same log are different forests.
+    options = "".join(f"-{option}" for option in key[3:])
+    return os.path.join(cache_dir, key[2] + options + FOREST_CACHE_SUFFIX)
+
+
+def save_forest_cache(cache_path, key: tuple, entries: list[Trace], all_bridges: list[Bridge]):
+    import marshal
+    entry_rows, bridge_rows, rows = flatten_forest(entries, all_bridges)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(FOREST_CACHE_MAGIC)
+        marshal.dump((FOREST_CACHE_VERSION, key, entry_rows, bridge_rows, rows), fp)
+    # Readers never see a half-written cache.
+    os.replace(tmp_path, cache_path)
+
+
+def load_forest_cache(cache_path, key: tuple) -> tuple[list[Trace], list[Bridge]]:
+    """
+    Raises StaleForestCache if the cache is for a different log, from an older
+    version of this format, or unreadable.
+    """
+    import marshal
+    try:
+        with open(cache_path, "rb") as fp:
+            data = fp.read()
+        if not data.startswith(FOREST_CACHE_MAGIC):
+            raise StaleForestCache(f"{cache_path} is not a forest cache")
+        # marshal.load on the file itself reads in tiny chunks, and is several times slower.
+        version, cached_key, entry_rows, bridge_rows, rows = marshal.loads(memoryview(data)[len(FOREST_CACHE_MAGIC):])
+        if version != FOREST_CACHE_VERSION or tuple(cached_key) != tuple(key):
+            raise StaleForestCache(f"{cache_path} is stale")
+        return unflatten_forest(entry_rows, bridge_rows, rows)
+    except StaleForestCache:
+        raise
+    except (OSError, EOFError, ValueError, TypeError, IndexError, KeyError, AttributeError) as e:
+        raise StaleForestCache(f"{cache_path} is corrupted: {e}") from e
+
+
+def load_or_build_trace_trees(path, cache_dir, workers: int = 1, hot_threshold: int | None = None, hot_top_k: int | None = None) -> tuple[list[Trace], list[Bridge]]:
+    """
+    parse_and_build_trace_trees + compute_edges, going through an on-disk cache
+    in cache_dir keyed by the log's size, mtime and content hash (and the hot-only
+    options). Stale or corrupted caches are rebuilt.
+    """
+    key = log_cache_key(path) + (hot_threshold, hot_top_k)
+    cache_path = forest_cache_path(cache_dir, key)
+    if os.path.exists(cache_path):
+        try:
+            return load_forest_cache(cache_path, key)
+        except StaleForestCache:
+            pass
+    with open_log(path) as fp:
+        entries, all_bridges = parse_and_build_trace_trees(fp, workers, hot_threshold, hot_top_k)
+    compute_edges(entries, entries + all_bridges)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_forest_cache(cache_path, key, entries, all_bridges)
     return entries, all_bridges
 
 
-def dump_entries(entries: list[TraceLike], file) -> None:
-    import json
+def serialize_entries(entries: list[TraceLike]) -> list[dict]:
     new_list = []
     entry_id = 0
     for entry in entries:
         entry.id = entry_id
         entry_id += 1
         new_list.append(entry.serialize())
-    json.dump(new_list, file, separators=(',', ':'))
+    return new_list
+
+def dump_entries(entries: list[TraceLike], file) -> None:
+    import json
+    json.dump(serialize_entries(entries), file, separators=(',', ':'))
+
+SHAPE_DIGEST_SIZE = 16
+SHAPE_DIGEST_SUFFIX = ".digest"
+
+def shape_digest(root: TraceLike, memo: dict[int, tuple[TraceLike, bytes]] | None = None) -> bytes:
+    """
+    Merkle hash of the shape root.serialize() writes: its uuid, then per guard
+    the op, the inversion flags and the digest of its bridge, if any. Two nodes
+    have the same digest iff they serialize the same (up to collisions).
+
+    memo maps id(node) to (node, digest) like in subtree_suboptimality_cost, and
+    may be shared between forests that don't change in place.
+    """
+    import hashlib
+    if memo is None:
+        memo = {}
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in memo:
+            continue
+        guards = [guard for guard in node.labels_and_guards if isinstance(guard, Guard)]
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((guard.bridge.node, False) for guard in guards if guard.bridge is not None and id(guard.bridge.node) not in memo)
+            continue
+        digest = hashlib.blake2b(f"Trace:{node.uuid}".encode(), digest_size=SHAPE_DIGEST_SIZE)
+        for guard in guards:
+            post = "P" if guard.expected_to_be_inverted else "I" if guard.inverted else ""
+            digest.update(f"\0Guard{post}:{guard.op}\0".encode())
+            digest.update(b"\0" if guard.bridge is None else memo[id(guard.bridge.node)][1])
+        memo[id(node)] = (node, digest.digest())
+    return memo[id(root)][1]
+
+def shape_digests(entries: list[TraceLike], memo: dict[int, tuple[TraceLike, bytes]] | None = None) -> tuple[bytes, dict[int, bytes]]:
+    """
+    The digest of the whole shapefile dump_entries writes for entries, and the
+    digest of every trace in it by uuid (the first one with a uuid wins, as in
+    the decoders), to see which subtrees differ between two candidates.
+    """
+    import hashlib
+    if memo is None:
+        memo = {}
+    forest = hashlib.blake2b(digest_size=SHAPE_DIGEST_SIZE)
+    for entry in entries:
+        forest.update(shape_digest(entry, memo))
+    by_uuid = {}
+    seen = set()
+    stack = list(reversed(entries))
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        by_uuid.setdefault(node.uuid, memo[id(node)][1])
+        stack.extend(reversed([guard.bridge.node for guard in node.labels_and_guards if isinstance(guard, Guard) and guard.bridge is not None]))
+    return forest.digest(), by_uuid
+
+def dump_digests(entries: list[TraceLike], file) -> None:
+    """
+    shape_digests as text: the forest digest on the first line, then one
+    "uuid digest" line per trace, in the order dump_entries writes them.
+    """
+    forest, by_uuid = shape_digests(entries)
+    print(forest.hex(), file=file)
+    for uuid, digest in by_uuid.items():
+        print(uuid, digest.hex(), file=file)
+
+def load_digests(file) -> tuple[bytes, dict[int, bytes]]:
+    forest = bytes.fromhex(file.readline())
+    by_uuid = {}
+    for line in file:
+        uuid, digest = line.split()
+        by_uuid[int(uuid)] = bytes.fromhex(digest)
+    return forest, by_uuid
+
+def dump_entries_binary(entries: list[TraceLike], file, with_offsets: bool = True) -> None:
+    """
+    Like dump_entries, in the binary shapefile format (file opened in binary mode),
+    by default with the offset table for constant time loop lookups.
+    """
+    from binary_shapefile import encode_shapes
+    file.write(encode_shapes(serialize_entries(entries), with_offsets))
 
 
 if __name__ == "__main__":
+    import argparse
     import sys
-    with open(sys.argv[1]) as fp:
-        entries, all_bridges = parse_and_build_trace_trees(fp)
-    compute_edges(entries, entries + all_bridges)
+    argparser = argparse.ArgumentParser(description="Find suboptimal traces in a PYPYLOG and reorder guards to fix them.")
+    argparser.add_argument("log", help="PYPYLOG with jit-log-opt and jit-backend-counts, optionally gzip/xz/bz2 compressed")
+    argparser.add_argument("before", help="where to print the forest before reordering")
+    argparser.add_argument("after", help="where to print the forest after reordering")
+    argparser.add_argument("shapefile", help="where to write the serialized guard shapes")
+    argparser.add_argument("--mmap", action="store_true", help="mmap the log and decode it section by section")
+    argparser.add_argument("--workers", type=int, default=1, help="parse the log in this many processes (implies --mmap)")
+    argparser.add_argument("--cache-dir", help="reuse (or save) the parsed forest for this log from this directory")
+    argparser.add_argument("--hot-threshold", type=int, help="only fully parse loops and bridges that ran at least this many times, and what they hang off (implies --mmap)")
+    argparser.add_argument("--hot-top-k", type=int, help="only fully parse the K most run loops and bridges, and what they hang off (implies --mmap)")
+    argparser.add_argument("--follow", action="store_true", help="parse the log (a file or FIFO) while PyPy is still writing it, until its jit-backend-counts arrive; a compressed log is read as far as it has been written")
+    argparser.add_argument("--follow-timeout", type=float, help="with --follow, give up after this many seconds without new output")
+    argparser.add_argument("--max-inversions", type=int, default=1, help="keep inverting guards until suboptimality stops decreasing, at most this many times (0 for no limit)")
+    argparser.add_argument("--time-budget", type=float, help="stop inverting guards after this many seconds")
+    argparser.add_argument("--only-improvements", action="store_true", help="only keep the inversions that decrease suboptimality, instead of stopping after the first one that doesn't")
+    argparser.add_argument("--solve-flow", action="store_true", help="reconstruct missing jump and enter counts from flow conservation, and report how well the profile conserves flow")
+    argparser.add_argument("--hot-paths", type=int, metavar="K", help="print the K hottest paths through the forest before reordering")
+    argparser.add_argument("--binary-shapefile", action="store_true", help="write the shapefiles in the compact binary format instead of JSON")
+    argparser.add_argument("--cost-json", help="write the suboptimality cost of the forest before and after reordering, per entry and per trace, to this JSON file")
+    argparser.add_argument("--beam-top-k", type=int, help="beam search over guard inversions instead, and also write the K best shapes to SHAPEFILE.0 ... SHAPEFILE.K-1")
+    argparser.add_argument("--beam-width", type=int, default=8, help="with --beam-top-k, forests kept per step")
+    argparser.add_argument("--beam-depth", type=int, default=3, help="with --beam-top-k, inversions per forest at most")
+    args = argparser.parse_args()
+    if args.solve_flow and args.cache_dir:
+        argparser.error("--solve-flow needs the counts as measured, but --cache-dir caches the forest after compute_edges")
+    hot_only = args.hot_threshold is not None or args.hot_top_k is not None
+    if args.follow:
+        forest = StreamingTraceForest()
+        with open_log(args.log) as fp:
+            # A compressed log can't be polled for more like a text file, it's read as far as it goes.
+            lines = fp if isinstance(fp, DecompressedLogReader) else follow_log_lines(fp, idle_timeout=args.follow_timeout)
+            try:
+                for _ in forest.consume(lines):
+                    # PyPy dumps the counts as it exits, nothing we need comes after them.
+                    if forest.counts_blocks_seen:
+                        break
+            except EOFError:
+                # The compressor hasn't finished the stream yet.
+                pass
+        entries, all_bridges = forest.trace_trees(complete=forest.counts_blocks_seen > 0)
+    elif args.cache_dir:
+        entries, all_bridges = load_or_build_trace_trees(args.log, args.cache_dir, args.workers, args.hot_threshold, args.hot_top_k)
+    else:
+        if args.mmap or args.workers > 1 or hot_only:
+            with LogIndex(args.log) as index:
+                entries, all_bridges = index.build_trace_trees(args.workers, args.hot_threshold, args.hot_top_k)
+        else:
+            with open_log(args.log) as fp:
+                entries, all_bridges = parse_and_build_trace_trees(fp)
+    if not args.cache_dir:
+        if args.solve_flow:
+            flow = solve_flow_counts(entries, all_bridges)
+            print(f"flow: residual {flow.initial_residual:.0f} -> {flow.residual:.0f} (relative {flow.relative_residual:.3g}) "
+                  f"after {flow.iterations} iterations, filled {flow.filled_jumps} jump and {flow.filled_enter_counts} enter counts", file=sys.stderr)
+        compute_edges(entries, entries + all_bridges)
     decide_sub_optimality(entries)
-    with open(sys.argv[2], "w") as fp:
+    with open(args.before, "w") as fp:
         for entry in entries:
             print(entry, file=fp)
+    if args.cost_json:
+        costs = {"before": suboptimality_report(entries)}
+    if args.hot_paths:
+        for path in hottest_paths(entries, args.hot_paths):
+            print(path)
     # Run to fixpoint.
-    prev_count = float('+inf')
-    # for _ in range(11):
-    #     prev_count = count_suboptimality(entries)
-    #     entries = reorder_to_decrease_suboptimality(entries + all_bridges, entries, requires_invertible_guard=True)
-    #     clear_sub_optimality(entries)
-    #     decide_sub_optimality(entries)
-    # compute_edges(entries, entries + all_bridges)
-    # entries = reorder_to_decrease_suboptimality_bottom_up(entries + all_bridges, entries, requires_invertible_guard=True)
-    entries = reorder_to_decrease_suboptimality_top_down(entries, requires_invertible_guard=True)
-    clear_sub_optimality(entries)
-    decide_sub_optimality(entries)
-    with open(sys.argv[3], "w") as fp:
+    def report(step, count):
+        print(f"step {step}: {count} suboptimal", file=sys.stderr)
+    ranked = []
+    if args.beam_top_k:
+        ranked = beam_search_inversions(entries, args.beam_width, args.beam_depth, args.beam_top_k)
+        for rank, candidate in enumerate(ranked):
+            print(f"rank {rank}: cost {candidate.cost} after {len(candidate.inversions)} inversions", file=sys.stderr)
+        entries = ranked[0].entries
+    else:
+        entries, _ = reorder_to_fixpoint(entries, args.max_inversions or None, args.time_budget, report=report,
+                                         only_improvements=args.only_improvements)
+    with open(args.after, "w") as fp:
         for entry in entries:
             print(entry, file=fp)
-
-    with open(sys.argv[4], "w") as fp:
-        dump_entries(entries, fp)
\ No newline at end of file
+    if args.cost_json:
+        import json
+        costs["after"] = suboptimality_report(entries)
+        print(f"suboptimality cost: {costs['before']['cost']} before, {costs['after']['cost']} after", file=sys.stderr)
+        with open(args.cost_json, "w") as fp:
+            json.dump(costs, fp, indent=1)
+
+    # Shapefiles last, dump_entries renumbers the entries.
+    for rank, candidate in enumerate(ranked):
+        with open(f"{args.shapefile}.{rank}", "wb" if args.binary_shapefile else "w") as fp:
+            (dump_entries_binary if args.binary_shapefile else dump_entries)(candidate.entries, fp)
+        with open(f"{args.shapefile}.{rank}{SHAPE_DIGEST_SUFFIX}", "w") as fp:
+            dump_digests(candidate.entries, fp)
+    with open(args.shapefile, "wb" if args.binary_shapefile else "w") as fp:
+        (dump_entries_binary if args.binary_shapefile else dump_entries)(entries, fp)
+    with open(f"{args.shapefile}{SHAPE_DIGEST_SUFFIX}", "w") as fp:
+        dump_digests(entries, fp)
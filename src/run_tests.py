@@ -1,5 +1,13 @@
+import gzip
+import importlib.util
+import io
+import json
+import sys
+import tempfile
+import textwrap
 import unittest
 import pathlib
+from unittest import mock
 
 from parser import (
     Trace,
@@ -10,13 +18,65 @@ from parser import (
     Bridge,
     Edge,
     Jump,
+    DoneWithThisFrame,
+    LogIndex,
+    SECTION_LOOP,
     parse_and_build_trace_trees,
+    load_or_build_trace_trees,
     compute_edges,
     decide_sub_optimality,
-    reorder_to_decrease_suboptimality,
+    clear_sub_optimality,
+    subtree_suboptimality_cost,
+    count_suboptimality,
+    solve_flow_counts,
+    hottest_paths,
+    beam_search_inversions,
+    inversion_candidates,
+    invert_guard_persistently,
+    reorder_to_fixpoint,
+    StreamingTraceForest,
+    follow_log_lines,
+    DecompressedLogReader,
+    reorder_to_decrease_suboptimality_bottom_up,
+    reorder_to_decrease_suboptimality_top_down,
+    redecide_sub_optimality,
+    shape_digests,
+    dump_digests,
+    load_digests,
 )
+from forest_columns import ForestColumns
+from my_json_decoder import Decoder, LazyDecoder, BinaryDecoder
+from binary_shapefile import encode_shapes, decode_shapes, shape_to_json
 
 PARENT_DIR = pathlib.Path("./src/test")
+# Made up by a generator, not by PyPy: 8 loops and 24 bridges with random guards
+# and counts, some loops peeled, and a short bridge-out-of-bridge chain.
+SYNTHETIC_LOG = PARENT_DIR / "synthetic.log"
+HAVE_NUMPY = importlib.util.find_spec("numpy") is not None
+SHAPEFILES = [
+    PARENT_DIR / "bad_benchmark_guided_GOLD_serialized",
+    PARENT_DIR / "bad_benchmark_2_guided_GOLD_serialized",
+    PARENT_DIR / "pyperformance" / "bm_go_guided_final_GOLDEN_serialized",
+]
+
+
+def write_log(directory, text: str) -> pathlib.Path:
+    path = pathlib.Path(directory) / "log"
+    path.write_text(textwrap.dedent(text).lstrip())
+    return path
+
+
+def nodes_by_uuid(entries: list[TraceLike]) -> dict[int, TraceLike]:
+    # The first node with each uuid reachable from the entries.
+    res = {}
+    stack = list(reversed(entries))
+    while stack:
+        node = stack.pop()
+        if node.uuid in res:
+            continue
+        res[node.uuid] = node
+        stack.extend(reversed([guard.bridge.node for guard in node.labels_and_guards if isinstance(guard, Guard) and guard.bridge is not None]))
+    return res
 
 class Test(unittest.TestCase):
     def build_from_log(self, infile) -> list[TraceLike]:
@@ -61,6 +121,7 @@ class Test(unittest.TestCase):
 
             assert len(worklist1) == len(worklist2)
 
+    @unittest.skipUnless((PARENT_DIR / "bad_input").exists(), "needs the PYPYLOG of running src/test/bad_input.py on PyPy")
     def test_bad_input(self):
         """
         See src/test/bad_input.py
@@ -82,10 +143,12 @@ class Test(unittest.TestCase):
         """
         entries, all_bridges = self.build_from_log(PARENT_DIR / "bad_input")
         side_exit = Guard(
-            129081921693024, bridge=Edge(
+            129081921693024, "guard_true", bridge=Edge(
             node=Bridge(
+                1,
                 129081921693024,
                 "side exit for branch",
+                None,
                 labels_and_guards=[],
                 # To top of the loop! We defeated loop peeling!
                 jump=Jump(129081921749408),
@@ -95,8 +158,10 @@ class Test(unittest.TestCase):
             entries,
             [
                 Trace(
+                    0,
                     1,
                     "entry",
+                    None,
                     labels_and_guards=[
                         # Top of the loop
                         Label(129081921749408),
@@ -110,14 +175,16 @@ class Test(unittest.TestCase):
                 )
             ]
         )
-        reordered_entries = reorder_to_decrease_suboptimality(entries+all_bridges, entries)
+        reordered_entries = reorder_to_decrease_suboptimality_bottom_up(entries+all_bridges, entries)
         decide_sub_optimality(reordered_entries)
         # swapped the bad side exit
         new_side_exit = Guard(
-            129081921693024, bridge=Edge(
+            129081921693024, "guard_true", bridge=Edge(
             node=Bridge(
+                1,
                 129081921693024,
                 "side exit for branch",
+                None,
                 labels_and_guards=[
                     # Peeled loop 1
                     Label(129081921749472),
@@ -130,8 +197,10 @@ class Test(unittest.TestCase):
             reordered_entries,
             [
                 Trace(
+                    0,
                     1,
                     "entry",
+                    None,
                     labels_and_guards=[
                         Label(129081921749408),
                         new_side_exit,
@@ -141,6 +210,617 @@ class Test(unittest.TestCase):
                     is_suboptimal_cause=None,
                 )
             ]
-        )        
+        )
+
+    def decided(self, entries: list[Trace], all_bridges: list[Bridge], edges_computed: bool = False) -> list[str]:
+        if not edges_computed:
+            compute_edges(entries, entries + all_bridges)
+        decide_sub_optimality(entries)
+        return [str(node) for node in entries + all_bridges]
+
+    def test_symbol_table_links_like_linear_scans(self):
+        entries, all_bridges = self.build_from_log(SYNTHETIC_LOG)
+        self.assertGreater(count_suboptimality(entries), 0)
+        traces = sorted(entries + all_bridges, key=lambda trace: trace.uuid)
+        labels = []
+        for trace in traces:
+            for item in (trace.header.labels_and_guards if trace.header else []) + trace.labels_and_guards:
+                if isinstance(item, Label):
+                    labels.append(item)
+        for trace in traces:
+            with self.subTest(trace=trace.uuid):
+                for guard in trace.labels_and_guards:
+                    if not isinstance(guard, Guard):
+                        continue
+                    bridge = next((bridge for bridge in all_bridges if bridge.id == guard.id), None)
+                    if bridge is None:
+                        self.assertIsNone(guard.bridge)
+                    else:
+                        self.assertEqual(guard.bridge.node.uuid, bridge.uuid)
+                if not isinstance(trace.jump, DoneWithThisFrame):
+                    label = next(label for label in labels if label.id == trace.jump.id)
+                    self.assertIs(trace.jump.jump_to_edge.node, label)
+
+    def test_clear_resets_verdicts_and_costs(self):
+        entries, _ = self.build_from_log(SYNTHETIC_LOG)
+        self.assertGreater(sum(subtree_suboptimality_cost(entry) for entry in entries), 0)
+        clear_sub_optimality(entries)
+        self.assertEqual(count_suboptimality(entries), 0)
+        self.assertEqual(sum(subtree_suboptimality_cost(entry) for entry in entries), 0)
+
+    def test_mmap_index_matches_sequential_parse(self):
+        expected = self.decided(*self.build_from_log(SYNTHETIC_LOG), edges_computed=True)
+        with LogIndex(SYNTHETIC_LOG) as index:
+            self.assertEqual(self.decided(*index.build_trace_trees()), expected)
+
+    def test_mmap_index_only_splits_lines_on_newlines(self):
+        # Both can end up in the info of a loop or in a debug_merge_point.
+        text = self.deep_chain_log(3).replace("(f;x.py:1)", "(f\x0c\u2028;x.py:1)")
+        text = text.replace("[p0, i1]\n+14: finish", "[p0, i1]\n+10: debug_merge_point(0, 0, 'a\x1c\x85\u2029b')\n+14: finish")
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "log"
+            path.write_text(text, encoding="utf-8")
+            expected = self.decided(*self.build_from_log(path), edges_computed=True)
+            with LogIndex(path) as index:
+                entries, all_bridges = index.build_trace_trees()
+            self.assertEqual(self.decided(entries, all_bridges), expected)
+        self.assertIn("f\x0c\u2028;x.py:1", entries[0].info)
+
+    def test_parallel_parse_matches_sequential_parse(self):
+        expected = self.decided(*self.build_from_log(SYNTHETIC_LOG), edges_computed=True)
+        with LogIndex(SYNTHETIC_LOG) as index:
+            self.assertEqual(self.decided(*index.build_trace_trees(2)), expected)
+        with open(SYNTHETIC_LOG) as fp:
+            self.assertEqual(self.decided(*parse_and_build_trace_trees(fp, workers=2)), expected)
+
+    def test_cached_forest_matches_sequential_parse(self):
+        expected = self.decided(*self.build_from_log(SYNTHETIC_LOG), edges_computed=True)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            built = load_or_build_trace_trees(SYNTHETIC_LOG, cache_dir)
+            self.assertEqual(len(list(pathlib.Path(cache_dir).iterdir())), 1)
+            cached = load_or_build_trace_trees(SYNTHETIC_LOG, cache_dir)
+            self.assertEqual(self.decided(*built, edges_computed=True), expected)
+            self.assertEqual(self.decided(*cached, edges_computed=True), expected)
+
+    def test_reorder_cached_forest(self):
+        fresh, _ = self.build_from_log(SYNTHETIC_LOG)
+        expected = [subtree_suboptimality_cost(entry) for entry in fresh]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch("parser.FOREST_CACHE_VERSION", 1):
+                load_or_build_trace_trees(SYNTHETIC_LOG, cache_dir)
+            # Written in the old layout, so rebuilt.
+            load_or_build_trace_trees(SYNTHETIC_LOG, cache_dir)
+            entries, all_bridges = load_or_build_trace_trees(SYNTHETIC_LOG, cache_dir)
+        repr(entries)
+        decide_sub_optimality(entries)
+        self.assertEqual([subtree_suboptimality_cost(entry) for entry in entries], expected)
+        reordered, counts = reorder_to_fixpoint(entries, max_inversions=1)
+        self.assertEqual(counts[0], 8)
+        reordered = reorder_to_decrease_suboptimality_bottom_up(entries + all_bridges, entries, requires_invertible_guard=True)
+        decide_sub_optimality(reordered)
+
+    def test_bottom_up_reorders_are_independent(self):
+        def shape(entries):
+            return json.dumps([entry.serialize() for entry in entries])
+
+        first, first_bridges = self.build_from_log(SYNTHETIC_LOG)
+        second, second_bridges = self.build_from_log(SYNTHETIC_LOG)
+        original = shape(first)
+        reordered = reorder_to_decrease_suboptimality_bottom_up(first + first_bridges, first, requires_invertible_guard=True)
+        self.assertNotEqual(shape(reordered), original)
+        # The second forest gets the same inversion, not a no-op.
+        again = reorder_to_decrease_suboptimality_bottom_up(second + second_bridges, second, requires_invertible_guard=True)
+        self.assertEqual(shape(again), shape(reordered))
+        self.assertEqual(shape(first), original)
+        # And so does another round on the reordered forest.
+        decide_sub_optimality(reordered)
+        twice = reorder_to_decrease_suboptimality_bottom_up(first + first_bridges, reordered, requires_invertible_guard=True)
+        self.assertNotEqual(shape(twice), shape(reordered))
+
+    @unittest.skipUnless(HAVE_NUMPY, "needs NumPy")
+    def test_csr_passes_match_object_passes(self):
+        from forest_csr import ForestCSR
+        with open(SYNTHETIC_LOG) as fp:
+            entries, all_bridges = parse_and_build_trace_trees(fp)
+        csr = ForestCSR(entries)
+        csr.compute_edge_weights()
+        csr.decide_sub_optimality()
+        compute_edges(entries, entries + all_bridges)
+        decide_sub_optimality(entries)
+        self.assertEqual(csr.edge_weight.tolist(), [guard.bridge.weight for guard in csr.edge_guards])
+        self.assertEqual(csr.jump_weight.tolist(), [node.jump.jump_to_edge.weight for node in csr.nodes])
+        self.assertEqual(csr.suboptimality_cost.tolist(), [node.suboptimality_cost for node in csr.nodes])
+        self.assertEqual(csr.mismatches(), [])
+        self.assertEqual(csr.count_suboptimality(), count_suboptimality(entries))
+
+    def test_compressed_file_objects(self):
+        expected = self.decided(*self.build_from_log(SYNTHETIC_LOG), edges_computed=True)
+        data = SYNTHETIC_LOG.read_bytes()
+        compressed = gzip.compress(data)
+        for name, fp in (("plain", io.BytesIO(data)), ("gzip", io.BytesIO(compressed)), ("file", open(SYNTHETIC_LOG, "rb"))):
+            with self.subTest(name), fp:
+                self.assertEqual(self.decided(*parse_and_build_trace_trees(fp)), expected)
+                self.assertFalse(fp.closed)
+        # Still being written: the whole lines come out, then the error once, then nothing.
+        lines = []
+        with DecompressedLogReader(io.BytesIO(compressed[:len(compressed) // 2]), "gzip") as reader:
+            with self.assertRaises(EOFError):
+                for line in reader:
+                    lines.append(line)
+            self.assertEqual(list(reader), [])
+        self.assertGreater(len(lines), 1)
+        self.assertTrue(data.decode().startswith("".join(lines)))
+
+    def test_column_passes_match_object_passes(self):
+        entries, _ = self.build_from_log(SYNTHETIC_LOG)
+        columns = ForestColumns.from_log(SYNTHETIC_LOG)
+        columns.compute_edges()
+        columns.decide_sub_optimality()
+        self.assertEqual(columns.count_suboptimality(), count_suboptimality(entries))
+        self.assertEqual([str(view) for view in columns.entries()], [str(entry) for entry in entries])
+        column_entries, _ = columns.to_trace_trees()
+        self.assertEqual([str(entry) for entry in column_entries], [str(entry) for entry in entries])
+        self.assertEqual([subtree_suboptimality_cost(entry) for entry in column_entries],
+                         [subtree_suboptimality_cost(entry) for entry in entries])
+
+    def test_hot_only_keeps_hot_verdicts(self):
+        entries, _ = self.build_from_log(SYNTHETIC_LOG)
+        full = nodes_by_uuid(entries)
+        for options in ({"hot_threshold": 500000}, {"hot_top_k": 5}, {"hot_threshold": 900000, "hot_top_k": 2}):
+            with self.subTest(**options), LogIndex(SYNTHETIC_LOG) as index:
+                hot_uuids = {section.uuid for section in index.hot_sections(**options)}
+                hot_entries, hot_bridges = index.build_trace_trees(**options)
+                self.assertLess(len(hot_uuids), len(hot_entries) + len(hot_bridges))
+                self.decided(hot_entries, hot_bridges)
+                hot = nodes_by_uuid(hot_entries)
+                for uuid in hot_uuids & full.keys():
+                    self.assertIn(uuid, hot)
+                    self.assertEqual(getattr(hot[uuid].is_suboptimal_cause, "id", None), getattr(full[uuid].is_suboptimal_cause, "id", None))
+
+    # Loop 0 is entered once and then iterates 18M times. Its first guard fails
+    # 9M times into a bridge, which has its own inner loop that runs 20M times and
+    # fails 15M times into another bridge.
+    LOOP_ENTERED_ONCE_LOG = """
+        [1] {jit-log-opt-loop
+        # Loop 0 (f;x.py:1) : loop with 4 ops
+        [p0, i1]
+        +7: label(p0, i1, descr=TargetToken(1000))
+        +14: guard_true(i1, descr=<Guard0x100>) [p0]
+        +21: guard_false(i1, descr=<Guard0x200>) [p0]
+        +28: jump(p0, i1, descr=TargetToken(1000))
+        +35: --end of the loop--
+        [2] jit-log-opt-loop}
+        [3] {jit-log-opt-bridge
+        # bridge out of Guard 0x100 with 3 ops
+        [p0, i1]
+        +7: label(p0, i1, descr=TargetToken(2000))
+        +14: guard_class(p0, descr=<Guard0x300>) [p0]
+        +21: jump(p0, i1, descr=TargetToken(2000))
+        +28: --end of the loop--
+        [4] jit-log-opt-bridge}
+        [5] {jit-log-opt-bridge
+        # bridge out of Guard 0x300 with 1 ops
+        [p0, i1]
+        +7: jump(p0, i1, descr=TargetToken(1000))
+        +14: --end of the loop--
+        [6] jit-log-opt-bridge}
+        [7] {jit-backend-counts
+        entry 0:1
+        TargetToken(1000):18000001
+        AfterGuardAt(256):9000001
+        AfterGuardAt(512):1000001
+        ExitOfToken(0:0):1000000
+        bridge 256:9000000
+        TargetToken(2000):20000000
+        AfterGuardAt(768):5000000
+        ExitOfToken(256:0):5000000
+        bridge 768:15000000
+        ExitOfToken(768:0):15000000
+        [8] jit-backend-counts}
+    """
+
+    def test_hot_only_parses_loops_entered_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_log(directory, self.LOOP_ENTERED_ONCE_LOG)
+            entries, _ = self.build_from_log(path)
+            self.assertEqual(count_suboptimality(entries), 2)
+            with LogIndex(path) as index:
+                self.assertEqual(index.flow_counts()[SECTION_LOOP, 0], 18000001)
+                # The bridge with the inner loop is the hottest, the loop is only
+                # parsed because that bridge hangs off it.
+                for options in ({"hot_threshold": 100}, {"hot_top_k": 1}):
+                    with self.subTest(**options):
+                        hot_entries, hot_bridges = index.build_trace_trees(**options)
+                        self.decided(hot_entries, hot_bridges)
+                        self.assertEqual(count_suboptimality(hot_entries), 2)
+                        hot = nodes_by_uuid(hot_entries)
+                        for uuid in (0, 1):
+                            self.assertNotIsInstance(hot[uuid].jump, DoneWithThisFrame)
+
+    def all_path_counts(self, entries: list[Trace]) -> list[int]:
+        """
+        The counts of every path hottest_paths can find, by walking all of them.
+        """
+        label_owners = {}
+        for node in nodes_by_uuid(entries).values():
+            for idx, item in enumerate(node.labels_and_guards):
+                if isinstance(item, Label):
+                    label_owners.setdefault(id(item), (node, idx))
+        counts = []
+        def walk(node, start, on_path, count):
+            for idx in range(start, len(node.labels_and_guards)):
+                item = node.labels_and_guards[idx]
+                if isinstance(item, Label):
+                    on_path = on_path | {id(item)}
+                elif isinstance(item, Guard) and item.bridge is not None:
+                    walk(item.bridge.node, 0, on_path, min(count, item.bridge.weight))
+            count = min(count, node.jump.jump_to_edge.weight)
+            if id(node.jump.jump_to_edge.node) in label_owners and id(node.jump.jump_to_edge.node) not in on_path:
+                walk(*label_owners[id(node.jump.jump_to_edge.node)], on_path, count)
+            else:
+                counts.append(count)
+        for entry in entries:
+            walk(entry, 0, frozenset(), max([entry.enter_count, 0] + [item.after_count for item in entry.labels_and_guards if isinstance(item, Label)]))
+        return sorted(counts, reverse=True)
+
+    def test_hottest_paths_are_the_hottest(self):
+        entries, _ = self.build_from_log(SYNTHETIC_LOG)
+        expected = self.all_path_counts(entries)
+        paths = hottest_paths(entries, 20)
+        self.assertEqual([path.count for path in paths], expected[:20])
+        self.assertTrue(any(isinstance(step, Jump) for path in hottest_paths(entries, len(expected)) for step in path.steps))
+
+    def test_hottest_paths_through_loop_entered_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            entries, _ = self.build_from_log(write_log(directory, self.LOOP_ENTERED_ONCE_LOG))
+        paths = hottest_paths(entries, 5)
+        # Into the bridge, into the second one and back to the top of the loop; the
+        # inner loop of the bridge; the loop itself.
+        self.assertEqual([path.count for path in paths], [9000000, 5000000, 1000000])
+        self.assertEqual([trace.uuid for trace in paths[0].traces], [0, 1, 2])
+        self.assertEqual(paths[0].jump.jump_to_edge.node.id, 1000)
+
+    def test_persistent_inversion_only_copies_the_path(self):
+        def shape(entries):
+            return json.dumps([entry.serialize() for entry in entries])
+
+        def reachable(entries):
+            seen = {}
+            stack = list(entries)
+            while stack:
+                node = stack.pop()
+                if id(node) not in seen:
+                    seen[id(node)] = node
+                    stack.extend(guard.bridge.node for guard in node.labels_and_guards if isinstance(guard, Guard) and guard.bridge is not None)
+            return seen
+
+        entries, _ = self.build_from_log(SYNTHETIC_LOG)
+        original = shape(entries)
+        # The first one the top-down reorderer would invert gives the same forest.
+        path, split = next(inversion_candidates(entries, breadth_first=True))
+        inverted = invert_guard_persistently(entries, path, split)
+        in_place, _ = self.build_from_log(SYNTHETIC_LOG)
+        self.assertEqual(shape(inverted), shape(reorder_to_decrease_suboptimality_top_down(in_place, requires_invertible_guard=True)))
+        self.assertEqual(shape(entries), original)
+        # Deep down, only the nodes on the path and the swapped-out bridge are new.
+        path, split = max(inversion_candidates(entries), key=lambda candidate: len(candidate[0]))
+        inverted = invert_guard_persistently(entries, path, split)
+        self.assertEqual(shape(entries), original)
+        old = reachable(entries)
+        self.assertEqual(len(reachable(inverted).keys() - old.keys()), len(path) + 1)
+        self.assertEqual([entry is old_entry for entry, old_entry in zip(inverted, entries)],
+                         [idx != path[0] for idx in range(len(entries))])
+
+    def test_shape_digests_match_serialized_shapes(self):
+        entries, _ = self.build_from_log(SYNTHETIC_LOG)
+        forests = [entries]
+        for forest in list(forests):
+            for path, split in inversion_candidates(forest):
+                inverted = invert_guard_persistently(forest, path, split)
+                forests.append(inverted)
+                forests.extend(invert_guard_persistently(inverted, *candidate) for candidate in inversion_candidates(inverted))
+        memo = {}
+        digests = {}
+        for forest in forests:
+            shape, _ = shape_digests(forest, memo)
+            self.assertEqual(shape, shape_digests(forest)[0])
+            digests.setdefault(shape, set()).add(json.dumps([entry.serialize() for entry in forest]))
+        # Some inversions lead to the same forest, and those get the same digest.
+        self.assertLess(len(digests), len(forests))
+        self.assertTrue(all(len(shapes) == 1 for shapes in digests.values()))
+        self.assertEqual(len(set.union(*digests.values())), len(digests))
+        with io.StringIO() as fp:
+            dump_digests(entries, fp)
+            fp.seek(0)
+            self.assertEqual(load_digests(fp), shape_digests(entries))
+
+    def test_beam_search_leaves_the_forest_alone(self):
+        entries, all_bridges = self.build_from_log(SYNTHETIC_LOG)
+        before = [str(node) for node in entries + all_bridges]
+        ranked = beam_search_inversions(entries, beam_width=4, depth=2, top_k=3)
+        self.assertEqual(len(ranked), 3)
+        self.assertEqual([str(node) for node in entries + all_bridges], before)
+        shapes = {json.dumps([entry.serialize() for entry in candidate.entries]) for candidate in ranked}
+        self.assertEqual(len(shapes), len(ranked))
+
+    def test_beam_search_keeps_the_forest_when_nothing_is_better(self):
+        # Inverting the guard makes its bridge the trunk, but the bridge jumps
+        # back less often than the loop gets past the guard.
+        log = """
+        [1] {jit-log-opt-loop
+        # Loop 0 (f;x.py:1) : loop with 4 ops
+        [p0, i1]
+        +7: label(p0, i1, descr=TargetToken(1000))
+        +14: guard_false(i1, descr=<Guard0x1>) [p0]
+        +21: guard_true(i1, descr=<Guard0x2>) [p0]
+        +28: jump(p0, i1, descr=TargetToken(1000))
+        +35: --end of the loop--
+        [2] jit-log-opt-loop}
+        [3] {jit-log-opt-bridge
+        # bridge out of Guard 0x1 with 1 ops
+        [p0, i1]
+        +7: jump(p0, i1, descr=TargetToken(1000))
+        +14: --end of the loop--
+        [4] jit-log-opt-bridge}
+        [5] {jit-log-opt-bridge
+        # bridge out of Guard 0x2 with 1 ops
+        [p0, i1]
+        +7: finish(p0, descr=<DoneWithThisFrameDescrRef object at 0x7f1>)
+        +14: --end of the loop--
+        [6] jit-log-opt-bridge}
+        [7] {jit-backend-counts
+        entry 0:1000
+        AfterGuardAt(1):550
+        AfterGuardAt(2):300
+        bridge 1:450
+        bridge 2:250
+        [8] jit-backend-counts}
+    """
+        with tempfile.TemporaryDirectory() as directory:
+            entries, _ = self.build_from_log(write_log(directory, log))
+        ranked = beam_search_inversions(entries, beam_width=4, depth=2, top_k=3)
+        self.assertEqual([candidate.cost for candidate in ranked], [450, 550, 550])
+        self.assertIs(ranked[0].entries, entries)
+        self.assertEqual(ranked[0].inversions, ())
+
+    def test_redecide_matches_full_decide(self):
+        def verdicts(entries):
+            return [str(entry) for entry in entries], [subtree_suboptimality_cost(entry) for entry in entries]
+
+        with tempfile.TemporaryDirectory() as directory:
+            loop_entered_once = write_log(directory, self.LOOP_ENTERED_ONCE_LOG)
+            for path in (SYNTHETIC_LOG, loop_entered_once):
+                for name in ("top_down", "bottom_up"):
+                    with self.subTest(path=path.name, reorderer=name):
+                        entries, all_bridges = self.build_from_log(path)
+                        dirty = []
+                        if name == "top_down":
+                            entries = reorder_to_decrease_suboptimality_top_down(entries, True, dirty)
+                        else:
+                            entries = reorder_to_decrease_suboptimality_bottom_up(entries + all_bridges, entries, True, dirty)
+                        self.assertTrue(dirty)
+                        redecide_sub_optimality(dirty)
+                        redecided = verdicts(entries)
+                        clear_sub_optimality(entries)
+                        decide_sub_optimality(entries)
+                        self.assertEqual(redecided, verdicts(entries))
+                with self.subTest(path=path.name, reorderer="fixpoint"):
+                    entries, _ = self.build_from_log(path)
+                    entries, _ = reorder_to_fixpoint(entries)
+                    redecided = verdicts(entries)
+                    clear_sub_optimality(entries)
+                    decide_sub_optimality(entries)
+                    self.assertEqual(redecided, verdicts(entries))
+
+    def deep_chain_log(self, depth: int) -> str:
+        """
+        A loop with a chain of depth bridges, each one out of a guard of the
+        previous one. Every guard's bridge is entered more than the jump is taken.
+        """
+        lines = [
+            "[1] {jit-log-opt-loop",
+            "# Loop 0 (f;x.py:1) : loop with 3 ops",
+            "[p0, i1]",
+            "+7: label(p0, i1, descr=TargetToken(1000))",
+            "+14: guard_true(i1, descr=<Guard0x1>) [p0]",
+            "+21: jump(p0, i1, descr=TargetToken(1000))",
+            "+28: --end of the loop--",
+            "[2] jit-log-opt-loop}",
+        ]
+        for guard in range(1, depth + 1):
+            lines += [
+                "[3] {jit-log-opt-bridge",
+                f"# bridge out of Guard {hex(guard)} with 2 ops",
+                "[p0, i1]",
+            ]
+            if guard < depth:
+                lines.append(f"+7: guard_true(i1, descr=<Guard{hex(guard + 1)}>) [p0]")
+            lines += [
+                "+14: finish(p0, descr=<DoneWithThisFrameDescrRef object at 0x7f1>)",
+                "+21: --end of the loop--",
+                "[4] jit-log-opt-bridge}",
+            ]
+        lines += ["[5] {jit-backend-counts", "entry 0:100"]
+        lines += [f"bridge {guard}:100" for guard in range(1, depth + 1)]
+        lines.append("[6] jit-backend-counts}")
+        return "\n".join(lines) + "\n"
+
+    def test_nodes_reachable_from_several_entries_are_counted_once(self):
+        entries, all_bridges = parse_and_build_trace_trees(io.StringIO(self.deep_chain_log(10)))
+        # Every bridge is also reachable from the loop.
+        compute_edges(entries + all_bridges, entries + all_bridges)
+        decide_sub_optimality(entries)
+        self.assertEqual(count_suboptimality(entries), 10)
+        self.assertEqual(count_suboptimality(entries + all_bridges), 10)
+        self.assertEqual(count_suboptimality(entries + entries), 10)
+
+    def test_passes_survive_deep_bridge_chains(self):
+        # Deeper than the default recursion limit, which the tests run at.
+        depth = 3 * sys.getrecursionlimit()
+        entries, all_bridges = parse_and_build_trace_trees(io.StringIO(self.deep_chain_log(depth)))
+        self.assertEqual(len(all_bridges), depth)
+        compute_edges(entries, entries + all_bridges)
+        decide_sub_optimality(entries)
+        # The loop and every bridge but the last one.
+        self.assertEqual(count_suboptimality(entries), depth)
+        self.assertEqual(subtree_suboptimality_cost(entries[0]), 100 * depth)
+        clear_sub_optimality(entries)
+        self.assertEqual(count_suboptimality(entries), 0)
+
+    def test_fixpoint_keeps_the_last_inversion_by_default(self):
+        # The first inversion on the synthetic log makes things worse.
+        entries, _ = self.build_from_log(SYNTHETIC_LOG)
+        before = [str(entry) for entry in entries]
+        reordered, counts = reorder_to_fixpoint(entries)
+        self.assertEqual(counts, [8, 9])
+        self.assertEqual(count_suboptimality(reordered), 9)
+        self.assertNotEqual([str(entry) for entry in reordered], before)
+
+    def test_fixpoint_only_keeps_inversions_that_help(self):
+        entries, all_bridges = self.build_from_log(SYNTHETIC_LOG)
+        before = [str(node) for node in entries + all_bridges]
+        tried = []
+        reordered, counts = reorder_to_fixpoint(entries, report=lambda step, count: tried.append(count), only_improvements=True)
+        self.assertEqual(tried, [8, 9])
+        self.assertEqual(counts, [8])
+        self.assertEqual([str(entry) for entry in reordered], before[:len(entries)])
+        self.assertEqual([str(node) for node in entries + all_bridges], before)
+        # Inverting the loop entered once does help, and then both ways agree.
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_log(directory, self.LOOP_ENTERED_ONCE_LOG)
+            entries, _ = self.build_from_log(path)
+            in_place, _ = self.build_from_log(path)
+        reordered, counts = reorder_to_fixpoint(entries, only_improvements=True)
+        self.assertEqual(counts, sorted(set(counts), reverse=True))
+        self.assertEqual(count_suboptimality(reordered), counts[-1])
+        self.assertGreater(len(counts), 1)
+        in_place, in_place_counts = reorder_to_fixpoint(in_place, max_inversions=len(counts) - 1)
+        self.assertEqual(in_place_counts, counts)
+        self.assertEqual([str(entry) for entry in in_place], [str(entry) for entry in reordered])
+
+    def test_follow_snapshots_a_log_cut_off_anywhere(self):
+        text = SYNTHETIC_LOG.read_text()
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "log"
+            for size in (700, 5000, 20000, len(text) - 10):
+                with self.subTest(size=size):
+                    path.write_text(text[:size])
+                    with open(path) as fp:
+                        lines = list(follow_log_lines(fp, poll_interval=0.01, idle_timeout=0.05))
+                    # The line PyPy may still be writing is left out.
+                    self.assertEqual("".join(lines), text[:text.rindex("\n", 0, size) + 1])
+                    forest = StreamingTraceForest()
+                    for _ in forest.consume(iter(lines)):
+                        pass
+                    entries, _ = forest.trace_trees(complete=False)
+                    complete = text[:text.rfind("--end of the loop--", 0, size) + 1]
+                    self.assertEqual(len(entries), complete.count("# Loop"))
+                    self.assertEqual(forest.counts_blocks_seen, 0)
+
+    def test_follow_keeps_sections_split_between_reads(self):
+        expected = self.decided(*self.build_from_log(SYNTHETIC_LOG), edges_computed=True)
+        with open(SYNTHETIC_LOG) as fp:
+            lines = list(fp)
+        for step in (1, 7, 100):
+            with self.subTest(step=step):
+                forest = StreamingTraceForest()
+                for start in range(0, len(lines), step):
+                    for _ in forest.consume(iter(lines[start:start + step])):
+                        pass
+                self.assertEqual(forest.counts_blocks_seen, 1)
+                self.assertEqual(self.decided(*forest.trace_trees()), expected)
+
+    FLOW_LOG = """
+        [1] {jit-log-opt-loop
+        # Loop 0 (f;x.py:1) : loop with 4 ops
+        [p0, i1]
+        +7: label(p0, i1, descr=TargetToken(1000))
+        +14: guard_true(i1, descr=<Guard0x100>) [p0]
+        +21: guard_class(p0, descr=<Guard0x200>) [p0]
+        +28: jump(p0, i1, descr=TargetToken(1000))
+        +35: --end of the loop--
+        [2] jit-log-opt-loop}
+        [3] {jit-log-opt-bridge
+        # bridge out of Guard 0x100 with 1 ops
+        [p0]
+        +7: finish(p0, descr=<DoneWithThisFrameDescrRef object at 0x7f1>)
+        +14: --end of the loop--
+        [4] jit-log-opt-bridge}
+        [5] {jit-backend-counts
+        entry 0:100
+        PriorToTargetToken(1000):100
+        TargetToken(1000):1000
+        AfterGuardAt(256):900
+        bridge 256:100
+        [6] jit-backend-counts}
+    """
+
+    def test_flow_solver_recovers_missing_jump_count(self):
+        """
+        The jump count is missing and the last guard has no count, so compute_edges
+        would guess 0. The label says 100 came in from outside and 1000 went
+        through, so the jump took the other 900. The bridge's finish takes all
+        of its 100.
+        """
+        for numpy in (True, False):
+            with self.subTest(numpy=numpy), mock.patch.dict(sys.modules, {} if numpy else {"numpy": None}):
+                entries, all_bridges = parse_and_build_trace_trees(io.StringIO(textwrap.dedent(self.FLOW_LOG).lstrip()))
+                solution = solve_flow_counts(entries, all_bridges)
+                self.assertEqual(entries[0].jump.enter_count, 900)
+                self.assertEqual(all_bridges[0].jump.enter_count, 100)
+                self.assertEqual(solution.filled_jumps, 2)
+                self.assertLess(solution.relative_residual, 1e-6)
+
+    def test_binary_shapefiles_round_trip(self):
+        for path in SHAPEFILES:
+            shapes = json.loads(path.read_text())
+            for with_offsets in (False, True):
+                with self.subTest(path=path.name, with_offsets=with_offsets):
+                    self.assertEqual(decode_shapes(encode_shapes(shapes, with_offsets)), shapes)
+
+    def test_indexed_lookups_match_recursive_search(self):
+        import random
+        import bench_decoder
+        for path in SHAPEFILES:
+            text = path.read_text()
+            decoder = Decoder(text)
+            root = decoder.parse_array()
+            self.assertEqual(shape_to_json(root), json.loads(text))
+            # Not parsed yet, the first find_loop_id does that.
+            unparsed = Decoder(text)
+            indexed = BinaryDecoder(encode_shapes(json.loads(text), with_offsets=True).decode("latin-1"))
+            ids = bench_decoder.trace_ids(json.loads(text))
+            for id_str in random.Random(0).sample(ids, min(len(ids), 50)) + ["-1"]:
+                with self.subTest(path=path.name, id=id_str):
+                    expected = shape_to_json(root.find_loop_id(id_str))
+                    self.assertEqual(shape_to_json(decoder.find_loop_id(id_str)), expected)
+                    self.assertEqual(shape_to_json(unparsed.find_loop_id(id_str)), expected)
+                    self.assertEqual(shape_to_json(indexed.find_loop_id(id_str)), expected)
+
+    def test_lazy_lookups_match_recursive_search(self):
+        import random
+        import bench_decoder
+        for path in SHAPEFILES:
+            text = path.read_text()
+            root = Decoder(text).parse_array()
+            lazy = LazyDecoder(text)
+            ids = bench_decoder.trace_ids(json.loads(text))
+            for id_str in random.Random(0).sample(ids, min(len(ids), 50)) + ["-1"]:
+                with self.subTest(path=path.name, id=id_str):
+                    expected = shape_to_json(root.find_loop_id(id_str))
+                    self.assertEqual(shape_to_json(lazy.find_loop_id(id_str)), expected)
+
+    def test_decoders_agree_on_random_shapefiles(self):
+        import contextlib
+        import importlib
+        import bench_decoder
+        # Importing it mustn't raise the recursion limit for the other tests.
+        with mock.patch("sys.setrecursionlimit") as setrecursionlimit:
+            importlib.reload(bench_decoder)
+        setrecursionlimit.assert_not_called()
+        with contextlib.redirect_stdout(io.StringIO()):
+            bench_decoder.fuzz(20, 0)
+
+
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()